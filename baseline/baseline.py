@@ -9,12 +9,27 @@ __all__ = (
     "generate_twi_blobs",
     "generate_twilight_near_sun",
     "standard_bf",
+    "cached_setup",
+    "MemoMaskBasisFunction",
+    "shared_mask",
+    "RewardProfiler",
+    "TimedBasisFunction",
+    "profile_rewards",
+    "MaskFirstMixin",
+    "MaskFirstBlobSurvey",
+    "MaskFirstGreedySurvey",
+    "mask_first",
 )
 
 import argparse
+import functools
+import hashlib
+import inspect
 import os
+import pickle
 import subprocess
 import sys
+import time
 
 import healpy as hp
 import numpy as np
@@ -52,6 +67,10 @@ iers.conf.auto_download = False
 # XXX--note this line probably shouldn't be in production
 iers.conf.auto_max_age = None
 
+# Nside for the preview profile (--preview); much faster than the default,
+# for triaging runs before doing them at full resolution
+PREVIEW_NSIDE = 16
+
 
 def example_scheduler(
     nside: int = DEFAULT_NSIDE,
@@ -86,6 +105,300 @@ def example_scheduler(
     return scheduler
 
 
+class MemoMaskBasisFunction(bf.BaseBasisFunction):
+    """Wrap a mask basis function so that it is only evaluated once per
+    conditions.mjd and ``indx`` (surveys pass all the pixels), no matter
+    how many surveys use it.
+
+    Parameters
+    ----------
+    basis_function : `rubin_scheduler.scheduler.basis_functions.BaseBasisFunction`
+        The mask to wrap. Its value must only depend on the conditions,
+        not on the observations (which are not passed on).
+    """
+
+    def __init__(self, basis_function):
+        super().__init__(nside=getattr(basis_function, "nside", None))
+        self.basis_function = basis_function
+        self.update_on_newobs = False
+        self.mjd_last = None
+        self.indx_last = None
+        self.value = None
+
+    def add_observations_array(self, observations_array, observations_hpid):
+        pass
+
+    def add_observation(self, observation, indx=None):
+        pass
+
+    def check_feasibility(self, conditions):
+        return self.basis_function.check_feasibility(conditions)
+
+    def label(self):
+        return self.basis_function.label()
+
+    def __call__(self, conditions, **kwargs):
+        indx = kwargs.get("indx")
+        if indx is not None:
+            indx = np.asarray(indx)
+        same_indx = (indx is None and self.indx_last is None) or (
+            indx is not None and self.indx_last is not None and np.array_equal(indx, self.indx_last)
+        )
+        if conditions.mjd != self.mjd_last or not same_indx:
+            self.value = self.basis_function(conditions, **kwargs)
+            self.mjd_last = conditions.mjd
+            self.indx_last = None if indx is None else indx.copy()
+        return self.value
+
+
+def shared_mask(shared_masks, mask_class, **kwargs):
+    """Get a mask basis function, shared between all the surveys that ask
+    for the same one.
+
+    Parameters
+    ----------
+    shared_masks : `dict`
+        The shared masks so far, keyed by class and kwargs; updated here.
+        If None, a new (unshared) mask is returned.
+    mask_class : `type`
+        The mask basis function class, e.g.
+        `rubin_scheduler.scheduler.basis_functions.PlanetMaskBasisFunction`.
+    **kwargs
+        Passed on to mask_class.
+
+    Returns
+    -------
+    mask : `rubin_scheduler.scheduler.basis_functions.BaseBasisFunction`
+        The mask; a `MemoMaskBasisFunction` if shared.
+    """
+    if shared_masks is None:
+        return mask_class(**kwargs)
+    key = (mask_class.__name__, tuple(sorted(kwargs.items())))
+    if key not in shared_masks:
+        shared_masks[key] = MemoMaskBasisFunction(mask_class(**kwargs))
+    return shared_masks[key]
+
+
+class RewardProfiler:
+    """Call counts and wall time of the survey reward and basis function
+    calls, per (survey_name, basis function class), and the reward time of
+    each survey per night.
+
+    Parameters
+    ----------
+    fileroot : `str`
+        Root of the output filenames.
+    """
+
+    def __init__(self, fileroot):
+        self.fileroot = fileroot
+        # (survey_name, name): [calls, wall time]
+        self.stats = {}
+        # (night, survey_name): [calls, wall time]
+        self.nightly = {}
+
+    def record(self, survey_name, name, conditions, wall_time):
+        """Add a call of name (a basis function class or a survey
+        method) for survey_name."""
+        stats = self.stats.setdefault((survey_name, name), [0, 0.0])
+        stats[0] += 1
+        stats[1] += wall_time
+        if name == "calc_reward_function":
+            stats = self.nightly.setdefault((getattr(conditions, "night", -1), survey_name), [0, 0.0])
+            stats[0] += 1
+            stats[1] += wall_time
+
+    def write(self, fileroot=None):
+        """Write the report, sorted by total time, and the per night time
+        series, as tab separated files.
+
+        Parameters
+        ----------
+        fileroot : `str`
+            Root of the output filenames. Default None, for self.fileroot.
+
+        Returns
+        -------
+        filenames : `list` [`str`]
+            The report and the per night time series.
+        """
+        if fileroot is None:
+            fileroot = self.fileroot
+        filenames = [fileroot + "reward_profile.tsv", fileroot + "reward_profile_nightly.tsv"]
+        with open(filenames[0], "w") as f:
+            f.write("survey_name\tname\tcalls\ttotal_s\tper_call_ms\n")
+            for (survey_name, name), (calls, total) in sorted(
+                self.stats.items(), key=lambda item: -item[1][1]
+            ):
+                f.write("%s\t%s\t%i\t%.3f\t%.4f\n" % (survey_name, name, calls, total, 1e3 * total / calls))
+        with open(filenames[1], "w") as f:
+            f.write("night\tsurvey_name\tcalls\ttotal_s\n")
+            for (night, survey_name), (calls, total) in sorted(self.nightly.items()):
+                f.write("%i\t%s\t%i\t%.3f\n" % (night, survey_name, calls, total))
+        print("Wrote reward profile to %s" % ", ".join(filenames))
+        return filenames
+
+
+class TimedBasisFunction:
+    """Wrap a basis function so that its calls are timed by a
+    `RewardProfiler`; everything else is passed through.
+
+    Parameters
+    ----------
+    basis_function : `rubin_scheduler.scheduler.basis_functions.BaseBasisFunction`
+        The basis function to time.
+    profiler : `RewardProfiler`
+        Profiler to record the calls with.
+    survey_name : `str`
+        Name of the survey the basis function is in.
+    """
+
+    def __init__(self, basis_function, profiler, survey_name):
+        self.basis_function = basis_function
+        self.profiler = profiler
+        self.survey_name = survey_name
+        self.name = type(basis_function).__name__
+        if isinstance(basis_function, MemoMaskBasisFunction):
+            self.name = type(basis_function.basis_function).__name__ + " (shared)"
+
+    def __getattr__(self, name):
+        # Only called for attributes not set here
+        if name == "basis_function":
+            raise AttributeError(name)
+        return getattr(self.basis_function, name)
+
+    def check_feasibility(self, conditions):
+        t0 = time.perf_counter()
+        result = self.basis_function.check_feasibility(conditions)
+        self.profiler.record(
+            self.survey_name, self.name + ".check_feasibility", conditions, time.perf_counter() - t0
+        )
+        return result
+
+    def __call__(self, conditions, **kwargs):
+        t0 = time.perf_counter()
+        result = self.basis_function(conditions, **kwargs)
+        self.profiler.record(self.survey_name, self.name, conditions, time.perf_counter() - t0)
+        return result
+
+
+class _TimedRewardFunction:
+    """Time the calc_reward_function calls of a survey."""
+
+    def __init__(self, reward_function, profiler, survey_name):
+        self.reward_function = reward_function
+        self.profiler = profiler
+        self.survey_name = survey_name
+
+    def __call__(self, conditions):
+        t0 = time.perf_counter()
+        result = self.reward_function(conditions)
+        self.profiler.record(self.survey_name, "calc_reward_function", conditions, time.perf_counter() - t0)
+        return result
+
+
+def profile_rewards(surveys, profiler):
+    """Time the reward calls of the surveys, and of all their basis
+    functions, with profiler.
+
+    Parameters
+    ----------
+    surveys : `list`
+        Surveys, or lists of surveys (as passed to `CoreScheduler`).
+        Surveys held by these (e.g. by a `LongGapSurvey`) are included.
+    profiler : `RewardProfiler`
+        Profiler to record the calls with.
+    """
+    for survey in surveys:
+        if isinstance(survey, list):
+            profile_rewards(survey, profiler)
+            continue
+        survey_name = getattr(survey, "survey_name", type(survey).__name__)
+        if hasattr(survey, "basis_functions"):
+            survey.basis_functions = [
+                TimedBasisFunction(basis_function, profiler, survey_name)
+                for basis_function in survey.basis_functions
+            ]
+        # Surveys inside this one
+        inner = [
+            val
+            for val in vars(survey).values()
+            if hasattr(val, "calc_reward_function") and not isinstance(val, _TimedRewardFunction)
+        ]
+        survey.calc_reward_function = _TimedRewardFunction(
+            survey.calc_reward_function, profiler, survey_name
+        )
+        profile_rewards(inner, profiler)
+
+
+class MaskFirstMixin:
+    """Mixin for surveys with reward maps (e.g. `BlobSurvey`) to evaluate
+    the masks (the zero-weight basis functions) before any of the weighted
+    basis functions.
+
+    If the masks cover the whole sky, the weighted sum is nan everywhere, so
+    that is returned without evaluating the weighted basis functions.
+    Otherwise the mask values are reused in the sum, and the reward is the
+    same as without the mixin.
+    """
+
+    def calc_reward_basic(self, conditions):
+        indx = np.arange(hp.nside2npix(self.nside))
+        mask_values = {}
+        masked = np.zeros(indx.size, dtype=bool)
+        for i, (basis_function, weight) in enumerate(zip(self.basis_functions, self.basis_weights)):
+            if weight != 0:
+                continue
+            mask_values[i] = basis_function(conditions, indx=indx)
+            # A masked pixel (nan or inf) times the zero weight is nan
+            masked |= ~np.isfinite(mask_values[i])
+            if masked.all():
+                return np.full(indx.size, np.nan)
+
+        reward = 0
+        for i, (basis_function, weight) in enumerate(zip(self.basis_functions, self.basis_weights)):
+            if i in mask_values:
+                basis_value = mask_values[i]
+            else:
+                basis_value = basis_function(conditions, indx=indx)
+            reward += basis_value * weight
+        return reward
+
+
+class MaskFirstBlobSurvey(MaskFirstMixin, BlobSurvey):
+    """`BlobSurvey` with `MaskFirstMixin`."""
+
+    pass
+
+
+class MaskFirstGreedySurvey(MaskFirstMixin, GreedySurvey):
+    """`GreedySurvey` with `MaskFirstMixin`."""
+
+    pass
+
+
+def mask_first(surveys):
+    """Make the blob and greedy surveys evaluate their masks before the
+    rest of their reward maps (see `MaskFirstMixin`).
+
+    Parameters
+    ----------
+    surveys : `list`
+        Surveys, or lists of surveys (as passed to `CoreScheduler`); they
+        are changed in place. Surveys held by these (e.g. by a
+        `LongGapSurvey`) are included.
+    """
+    mask_first_classes = {BlobSurvey: MaskFirstBlobSurvey, GreedySurvey: MaskFirstGreedySurvey}
+    for survey in surveys:
+        if isinstance(survey, list):
+            mask_first(survey)
+            continue
+        if type(survey) in mask_first_classes:
+            survey.__class__ = mask_first_classes[type(survey)]
+        # Surveys inside this one
+        mask_first([val for val in vars(survey).values() if hasattr(val, "calc_reward_function")])
+
+
 def standard_bf(
     nside,
     bandname="g",
@@ -105,6 +418,7 @@ def standard_bf(
     moon_distance=30.0,
     strict=True,
     wind_speed_maximum=20.0,
+    shared_masks=None,
 ):
     """Generate the standard basis functions that are shared by blob surveys
 
@@ -156,6 +470,9 @@ def standard_bf(
         are so few g-visits, it can be helpful to turn this up a
         little higher than the standard template_weight kwarg.
         Default 24 (unitless).
+    shared_masks : `dict`
+        Shared mask basis functions, from `shared_mask`; None to give
+        the surveys their own. Default None.
 
     Returns
     -------
@@ -288,14 +605,23 @@ def standard_bf(
     # The shared masks
     bfs.append(
         (
-            bf.MoonAvoidanceBasisFunction(nside=nside, moon_distance=moon_distance),
+            shared_mask(
+                shared_masks, bf.MoonAvoidanceBasisFunction, nside=nside, moon_distance=moon_distance
+            ),
             0.0,
         )
     )
-    bfs.append((bf.AvoidDirectWind(nside=nside, wind_speed_maximum=wind_speed_maximum), 0))
+    bfs.append(
+        (
+            shared_mask(
+                shared_masks, bf.AvoidDirectWind, nside=nside, wind_speed_maximum=wind_speed_maximum
+            ),
+            0,
+        )
+    )
     bandnames = [fn for fn in [bandname, bandname2] if fn is not None]
     bfs.append((bf.BandLoadedBasisFunction(bandnames=bandnames), 0))
-    bfs.append((bf.PlanetMaskBasisFunction(nside=nside), 0.0))
+    bfs.append((shared_mask(shared_masks, bf.PlanetMaskBasisFunction, nside=nside), 0.0))
 
     return bfs
 
@@ -332,6 +658,7 @@ def blob_for_long(
     blob_names=[],
     u_exptime=38.0,
     scheduled_respect=30.0,
+    shared_masks=None,
 ):
     """
     Generate surveys that take observations in blobs.
@@ -403,6 +730,9 @@ def blob_for_long(
         Add a detailer to make sure the number of expossures
         in a visit is always 1 for u observations.
         Default True.
+    shared_masks : `dict`
+        Shared mask basis functions, from `shared_mask`; None to give
+        the surveys their own. Default None.
     """
 
     BlobSurvey_params = {
@@ -450,6 +780,7 @@ def blob_for_long(
                 season=season,
                 season_start_hour=season_start_hour,
                 season_end_hour=season_end_hour,
+                shared_masks=shared_masks,
             )
         )
 
@@ -459,8 +790,13 @@ def blob_for_long(
         # Masks, give these 0 weight
         bfs.append(
             (
-                bf.AltAzShadowMaskBasisFunction(
-                    nside=nside, shadow_minutes=shadow_minutes, max_alt=max_alt, pad=3.0
+                shared_mask(
+                    shared_masks,
+                    bf.AltAzShadowMaskBasisFunction,
+                    nside=nside,
+                    shadow_minutes=shadow_minutes,
+                    max_alt=max_alt,
+                    pad=3.0,
                 ),
                 0.0,
             )
@@ -521,6 +857,7 @@ def gen_long_gaps_survey(
     g_template_weight=50.0,
     u_exptime=38.0,
     nexp=2,
+    shared_masks=None,
 ):
     """
     Paramterers
@@ -557,6 +894,9 @@ def gen_long_gaps_survey(
         Default 38.
     nexp : `int`
         Number of exposures per visit. Default 2.
+    shared_masks : `dict`
+        Shared mask basis functions, from `shared_mask`; None to give
+        the surveys their own. Default None.
     """
 
     surveys = []
@@ -582,9 +922,10 @@ def gen_long_gaps_survey(
             blob_names=blob_names,
             u_exptime=u_exptime,
             nexp=nexp,
+            shared_masks=shared_masks,
         )
         scripted = ScriptedSurvey(
-            [bf.AvoidDirectWind(nside=nside)],
+            [shared_mask(shared_masks, bf.AvoidDirectWind, nside=nside)],
             nside=nside,
             ignore_obs=["blob", "DDF", "twi", "pair"],
         )
@@ -609,6 +950,7 @@ def gen_greedy_surveys(
     stayband_weight=100.0,
     repeat_weight=-1.0,
     footprints=None,
+    shared_masks=None,
 ):
     """
     Make a quick set of greedy surveys
@@ -659,6 +1001,9 @@ def gen_greedy_surveys(
     stayband_weight : `float`
         The weight on basis function that tries to stay avoid band changes.
         Default 3.0 (uniteless).
+    shared_masks : `dict`
+        Shared mask basis functions, from `shared_mask`; None to give
+        the surveys their own. Default None.
     """
     # Define the extra parameters that are used in the greedy survey. I
     # think these are fairly set, so no need to promote to utility func kwargs
@@ -694,6 +1039,7 @@ def gen_greedy_surveys(
                 footprints=footprints,
                 n_obs_template=None,
                 strict=False,
+                shared_masks=shared_masks,
             )
         )
 
@@ -708,8 +1054,13 @@ def gen_greedy_surveys(
         # Masks, give these 0 weight
         bfs.append(
             (
-                bf.AltAzShadowMaskBasisFunction(
-                    nside=nside, shadow_minutes=shadow_minutes, max_alt=max_alt, pad=3.0
+                shared_mask(
+                    shared_masks,
+                    bf.AltAzShadowMaskBasisFunction,
+                    nside=nside,
+                    shadow_minutes=shadow_minutes,
+                    max_alt=max_alt,
+                    pad=3.0,
                 ),
                 0,
             )
@@ -764,6 +1115,7 @@ def generate_blobs(
     mjd_start=1,
     repeat_weight=-20,
     u_exptime=38.0,
+    shared_masks=None,
 ):
     """
     Generate surveys that take observations in blobs.
@@ -840,6 +1192,9 @@ def generate_blobs(
     scheduled_respect : `float`
         How much time to require there be before a pre-scheduled
         observation (minutes). Default 45.
+    shared_masks : `dict`
+        Shared mask basis functions, from `shared_mask`; None to give
+        the surveys their own. Default None.
     """
 
     BlobSurvey_params = {
@@ -888,6 +1243,7 @@ def generate_blobs(
                 season=season,
                 season_start_hour=season_start_hour,
                 season_end_hour=season_end_hour,
+                shared_masks=shared_masks,
             )
         )
 
@@ -947,8 +1303,13 @@ def generate_blobs(
         # Masks, give these 0 weight
         bfs.append(
             (
-                bf.AltAzShadowMaskBasisFunction(
-                    nside=nside, shadow_minutes=shadow_minutes, max_alt=max_alt, pad=3.0
+                shared_mask(
+                    shared_masks,
+                    bf.AltAzShadowMaskBasisFunction,
+                    nside=nside,
+                    shadow_minutes=shadow_minutes,
+                    max_alt=max_alt,
+                    pad=3.0,
                 ),
                 0.0,
             )
@@ -1018,6 +1379,7 @@ def generate_twi_blobs(
     scheduled_respect=15.0,
     repeat_weight=-1.0,
     night_pattern=None,
+    shared_masks=None,
 ):
     """
     Generate surveys that take observations in blobs.
@@ -1086,6 +1448,9 @@ def generate_twi_blobs(
         are so few u-visits, it can be helpful to turn this up a
         little higher than the standard template_weight kwarg.
         Default 24 (unitless).
+    shared_masks : `dict`
+        Shared mask basis functions, from `shared_mask`; None to give
+        the surveys their own. Default None.
     """
 
     BlobSurvey_params = {
@@ -1135,6 +1500,7 @@ def generate_twi_blobs(
                 season=season,
                 season_start_hour=season_start_hour,
                 season_end_hour=season_end_hour,
+                shared_masks=shared_masks,
             )
         )
 
@@ -1166,7 +1532,9 @@ def generate_twi_blobs(
         # Masks, give these 0 weight
         bfs.append(
             (
-                bf.AltAzShadowMaskBasisFunction(
+                shared_mask(
+                    shared_masks,
+                    bf.AltAzShadowMaskBasisFunction,
                     nside=nside,
                     shadow_minutes=shadow_minutes,
                     max_alt=max_alt,
@@ -1220,6 +1588,7 @@ def ddf_surveys(
     nside=None,
     expt=29.2,
     nexp=2,
+    setup_cache_dir=None,
 ):
     """Generate surveys for DDF observations
 
@@ -1235,11 +1604,21 @@ def ddf_surveys(
         Default None.
     expt : `float`
         Exposure time for DDF visits. Default 29.2.
+    setup_cache_dir : `str`
+        Directory to cache the DDF script in (see `cached_setup`).
+        Default None.
     """
     nsnaps = [1, 2, 2, 2, 2, 2]
     if nexp == 1:
         nsnaps = [1, 1, 1, 1, 1, 1]
-    obs_array = generate_ddf_scheduled_obs(offseason_length=offseason_length, expt=expt, nsnaps=nsnaps)
+    obs_array = cached_setup(
+        setup_cache_dir,
+        "ddf_scheduled_obs",
+        generate_ddf_scheduled_obs,
+        offseason_length=offseason_length,
+        expt=expt,
+        nsnaps=nsnaps,
+    )
     euclid_obs = np.where(
         (obs_array["scheduler_note"] == "DD:EDFS_b") | (obs_array["scheduler_note"] == "DD:EDFS_a")
     )[0]
@@ -1273,16 +1652,40 @@ def ecliptic_target(nside=DEFAULT_NSIDE, dist_to_eclip=40.0, dec_max=30.0, mask=
         Any additional mask to apply, should be a
         HEALpix mask with matching nside. Default None.
     """
+    # The map without the mask is memoized
+    result = _ecliptic_target_map(nside, float(dist_to_eclip), float(dec_max)).copy()
+
+    if mask is not None:
+        result *= mask
 
+    return result
+
+
+@functools.lru_cache(maxsize=None)
+def _ecliptic_pole():
+    """Unit vector (ICRS) of the pole of the barycentric true ecliptic.
+
+    The ecliptic latitude of a direction is the arcsin of its dot product
+    with this, so this is the only astropy transformation needed.
+    """
+    pole = SkyCoord(lon=0.0 * u.rad, lat=np.pi / 2.0 * u.rad, frame="barycentrictrueecliptic").icrs
+    return np.array(pole.cartesian.xyz.value)
+
+
+@functools.lru_cache(maxsize=None)
+def _ecliptic_target_map(nside, dist_to_eclip, dec_max):
+    """`ecliptic_target` map, without a mask; read-only, as it is shared."""
     ra, dec = _hpid2_ra_dec(nside, np.arange(hp.nside2npix(nside)))
     result = np.zeros(ra.size)
-    coord = SkyCoord(ra=ra * u.rad, dec=dec * u.rad)
-    eclip_lat = coord.barycentrictrueecliptic.lat.radian
+    # Rotate the pixels into the ecliptic frame, only as far as the latitude
+    pole = _ecliptic_pole()
+    sin_eclip_lat = (
+        np.cos(dec) * np.cos(ra) * pole[0] + np.cos(dec) * np.sin(ra) * pole[1] + np.sin(dec) * pole[2]
+    )
+    eclip_lat = np.arcsin(np.clip(sin_eclip_lat, -1.0, 1.0))
     good = np.where((np.abs(eclip_lat) < np.radians(dist_to_eclip)) & (dec < np.radians(dec_max)))
     result[good] += 1
-
-    if mask is not None:
-        result *= mask
+    result.flags.writeable = False
 
     return result
 
@@ -1313,6 +1716,8 @@ def generate_twilight_near_sun(
     ignore_obs=["DD", "pair", "long", "blob", "greedy"],
     band_dist_weight=0.3,
     time_to_12deg=25.0,
+    setup_cache_dir=None,
+    shared_masks=None,
 ):
     """Generate a survey for observing NEO objects in twilight
 
@@ -1365,9 +1770,17 @@ def generate_twilight_near_sun(
     time_to_sunrise : `float`
         Do not execute if time to sunrise is greater than (minutes).
         Default 25.
+    setup_cache_dir : `str`
+        Directory to cache the ecliptic target map in
+        (see `cached_setup`). Default None.
+    shared_masks : `dict`
+        Shared mask basis functions, from `shared_mask`; None to give
+        the surveys their own. Default None.
     """
     survey_name = "twilight_near_sun"
-    footprint = ecliptic_target(nside=nside, mask=footprint_mask)
+    footprint = cached_setup(
+        setup_cache_dir, "ecliptic_target", ecliptic_target, nside=nside, mask=footprint_mask
+    )
     constant_fp = ConstantFootprint(nside=nside)
     for bandname in bands:
         constant_fp.set_footprint(bandname, footprint)
@@ -1414,7 +1827,9 @@ def generate_twilight_near_sun(
         )
         bfs.append(
             (
-                bf.AltAzShadowMaskBasisFunction(
+                shared_mask(
+                    shared_masks,
+                    bf.AltAzShadowMaskBasisFunction,
                     nside=nside,
                     shadow_minutes=shadow_minutes,
                     max_alt=max_alt,
@@ -1424,9 +1839,16 @@ def generate_twilight_near_sun(
                 0,
             )
         )
-        bfs.append((bf.MoonAvoidanceBasisFunction(nside=nside, moon_distance=moon_distance), 0))
+        bfs.append(
+            (
+                shared_mask(
+                    shared_masks, bf.MoonAvoidanceBasisFunction, nside=nside, moon_distance=moon_distance
+                ),
+                0,
+            )
+        )
         bfs.append((bf.BandLoadedBasisFunction(bandnames=bandname), 0))
-        bfs.append((bf.PlanetMaskBasisFunction(nside=nside), 0))
+        bfs.append((shared_mask(shared_masks, bf.PlanetMaskBasisFunction, nside=nside), 0))
         bfs.append(
             (
                 bf.SolarElongationMaskBasisFunction(min_elong=0.0, max_elong=max_elong, nside=nside),
@@ -1533,10 +1955,136 @@ def run_sched(
         event_table=event_table,
         snapshot_dir=snapshot_dir,
     )
+    if getattr(scheduler, "reward_profiler", None) is not None:
+        scheduler.reward_profiler.write()
 
     return observatory, scheduler, observations
 
 
+def _hash_setup_code(sha1, func, seen=None):
+    """Update sha1 with the bytecode (and constants) of func, if it is
+    defined in this module, and of the functions in this module that it
+    refers to; functions from rubin_scheduler are covered by its version."""
+    func = inspect.unwrap(func)
+    if seen is None:
+        seen = set()
+    if not inspect.isfunction(func) or func.__module__ != __name__ or func in seen:
+        return
+    seen.add(func)
+    codes = [func.__code__]
+    while len(codes) > 0:
+        code = codes.pop()
+        sha1.update(code.co_code)
+        for const in code.co_consts:
+            if inspect.iscode(const):
+                codes.append(const)
+            else:
+                sha1.update(repr(const).encode())
+        for global_name in code.co_names:
+            val = func.__globals__.get(global_name)
+            if callable(val):
+                _hash_setup_code(sha1, val, seen=seen)
+
+
+def _hash_setup_param(sha1, val):
+    """Update sha1 with a parameter value; arrays (and dicts/lists of
+    them) are hashed by value."""
+    if isinstance(val, np.ndarray):
+        sha1.update(str(val.dtype).encode())
+        sha1.update(str(val.shape).encode())
+        sha1.update(np.ascontiguousarray(val).tobytes())
+    elif isinstance(val, dict):
+        for key in sorted(val):
+            sha1.update(repr(key).encode())
+            _hash_setup_param(sha1, val[key])
+    elif isinstance(val, (list, tuple)):
+        sha1.update(type(val).__name__.encode())
+        for item in val:
+            _hash_setup_param(sha1, item)
+    else:
+        sha1.update(repr(val).encode())
+
+
+def cached_setup(cache_dir, name, func, **params):
+    """Run ``func(**params)``, caching the result on disk.
+
+    The setup products of `gen_scheduler` (footprints, the DDF script,
+    ToO events, ...) are deterministic given their parameters, so they
+    are saved the first time and loaded after that.
+
+    Parameters
+    ----------
+    cache_dir : `str`
+        Directory for the cache. If None, ``func`` is just called.
+    name : `str`
+        Name for the cached product; used in the filename.
+    func : callable
+        Function that generates the product.
+    **params
+        Keyword arguments for ``func``. Together with ``name``, the
+        rubin_scheduler version and the code of ``func`` (and of the
+        functions in this module it calls), these key the cache; arrays
+        are hashed by value.
+
+    Returns
+    -------
+    result
+        ``func(**params)``. Arrays (and tuples of arrays) are saved as
+        .npy files and loaded memory-mapped (copy-on-write); anything
+        else is pickled.
+    """
+    if cache_dir is None:
+        return func(**params)
+
+    sha1 = hashlib.sha1(f"{name}_{rubin_scheduler.__version__}".encode())
+    _hash_setup_code(sha1, func)
+    _hash_setup_param(sha1, params)
+    froot = os.path.join(cache_dir, f"{name}_{sha1.hexdigest()}")
+
+    # look for it
+    if os.path.exists(froot + ".pkl"):
+        with open(froot + ".pkl", "rb") as f:
+            return pickle.load(f)
+    if os.path.exists(froot + ".npy"):
+        return np.load(froot + ".npy", mmap_mode="c", allow_pickle=False)
+    if os.path.exists(froot + "_0.npy"):
+        result = []
+        while os.path.exists(f"{froot}_{len(result)}.npy"):
+            result.append(np.load(f"{froot}_{len(result)}.npy", mmap_mode="c", allow_pickle=False))
+        return tuple(result)
+
+    result = func(**params)
+    os.makedirs(cache_dir, exist_ok=True)
+    # Write to temp files first so that concurrent runs never
+    # see a partial file
+    tmp = f".{os.getpid()}.tmp"
+    if isinstance(result, np.ndarray) and result.dtype != object:
+        with open(froot + ".npy" + tmp, "wb") as f:
+            np.save(f, result)
+        os.replace(froot + ".npy" + tmp, froot + ".npy")
+    elif (
+        isinstance(result, tuple)
+        and len(result) > 0
+        and all([isinstance(item, np.ndarray) and item.dtype != object for item in result])
+    ):
+        # item 0 last, since it marks the product as there
+        for i in list(range(1, len(result))) + [0]:
+            with open(f"{froot}_{i}.npy" + tmp, "wb") as f:
+                np.save(f, result[i])
+            os.replace(f"{froot}_{i}.npy" + tmp, f"{froot}_{i}.npy")
+    else:
+        with open(froot + ".pkl" + tmp, "wb") as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(froot + ".pkl" + tmp, froot + ".pkl")
+
+    return result
+
+
+def _current_area_maps(nside):
+    """The `CurrentAreaMap` footprints and labels."""
+    return CurrentAreaMap(nside=nside).return_maps()
+
+
 def gen_scheduler(args):
     survey_length = args.survey_length  # Days
     out_dir = args.out_dir
@@ -1544,10 +2092,15 @@ def gen_scheduler(args):
     nexp = args.nexp
     dbroot = args.dbroot
     nside = args.nside
+    preview = getattr(args, "preview", False)
+    if preview:
+        nside = PREVIEW_NSIDE
     mjd_plus = args.mjd_plus
     split_long = args.split_long
     snapshot_dir = args.snapshot_dir
     too = not args.no_too
+    # Cache for the deterministic setup products; None to not cache
+    setup_cache_dir = getattr(args, "setup_cache_dir", None)
 
     # Parameters that were previously command-line
     # arguments.
@@ -1573,6 +2126,8 @@ def gen_scheduler(args):
     mjd_start = SURVEY_START_MJD + mjd_plus
 
     fileroot, extra_info = set_run_info(dbroot=dbroot, file_end="v4.3.1_", out_dir=out_dir)
+    if preview:
+        fileroot += "preview_"
 
     pattern_dict = {
         1: [True],
@@ -1588,8 +2143,9 @@ def gen_scheduler(args):
     ei_night_pattern = pattern_dict[ei_night_pattern]
     reverse_ei_night_pattern = [not val for val in ei_night_pattern]
 
-    sky = CurrentAreaMap(nside=nside)
-    footprints_hp_array, labels = sky.return_maps()
+    footprints_hp_array, labels = cached_setup(
+        setup_cache_dir, "current_area_map", _current_area_maps, nside=nside
+    )
 
     wfd_indx = np.where((labels == "lowdust") | (labels == "virgo"))[0]
     wfd_footprint = footprints_hp_array["r"] * 0
@@ -1609,7 +2165,10 @@ def gen_scheduler(args):
     sun_moon_info = almanac.get_sun_moon_positions(mjd_start)
     sun_ra_start = sun_moon_info["sun_RA"].copy()
 
-    footprints = make_rolling_footprints(
+    footprints = cached_setup(
+        setup_cache_dir,
+        "rolling_footprints",
+        make_rolling_footprints,
         fp_hp=footprints_hp,
         mjd_start=mjd_start,
         sun_ra_start=sun_ra_start,
@@ -1624,12 +2183,17 @@ def gen_scheduler(args):
 
     gaps_night_pattern = [True] + [False] * nights_off
 
+    # Masks that only depend on the conditions are shared between the
+    # surveys, so each is evaluated once per decision
+    shared_masks = {}
+
     long_gaps = gen_long_gaps_survey(
         nside=nside,
         footprints=footprints,
         night_pattern=gaps_night_pattern,
         u_exptime=u_exptime,
         nexp=nexp,
+        shared_masks=shared_masks,
     )
 
     # Set up the DDF surveys to dither
@@ -1653,9 +2217,10 @@ def gen_scheduler(args):
         euclid_detailers=euclid_detailers,
         nside=nside,
         nexp=nexp,
+        setup_cache_dir=setup_cache_dir,
     )
 
-    greedy = gen_greedy_surveys(nside, nexp=nexp, footprints=footprints)
+    greedy = gen_greedy_surveys(nside, nexp=nexp, footprints=footprints, shared_masks=shared_masks)
     neo = generate_twilight_near_sun(
         nside,
         night_pattern=ei_night_pattern,
@@ -1665,6 +2230,8 @@ def gen_scheduler(args):
         max_airmass=ei_am,
         max_elong=ei_elong_req,
         min_area=ei_area_req,
+        setup_cache_dir=setup_cache_dir,
+        shared_masks=shared_masks,
     )
     blobs = generate_blobs(
         nside,
@@ -1672,6 +2239,7 @@ def gen_scheduler(args):
         footprints=footprints,
         mjd_start=mjd_start,
         u_exptime=u_exptime,
+        shared_masks=shared_masks,
     )
     twi_blobs = generate_twi_blobs(
         nside,
@@ -1680,6 +2248,7 @@ def gen_scheduler(args):
         wfd_footprint=wfd_footprint,
         repeat_night_weight=repeat_night_weight,
         night_pattern=reverse_ei_night_pattern,
+        shared_masks=shared_masks,
     )
 
     roman_surveys = [
@@ -1689,7 +2258,9 @@ def gen_scheduler(args):
 
     if too:
         too_scale = 1.0
-        sim_ToOs, event_table = gen_all_events(scale=too_scale, nside=nside)
+        sim_ToOs, event_table = cached_setup(
+            setup_cache_dir, "too_events", gen_all_events, scale=too_scale, nside=nside
+        )
         camera_rot_limits = [-80.0, 80.0]
         detailer_list = []
         detailer_list.append(
@@ -1716,7 +2287,18 @@ def gen_scheduler(args):
         event_table = None
         fileroot = fileroot.replace("baseline", "no_too")
 
+    # Skip the weighted basis functions of surveys that are fully masked
+    if getattr(args, "mask_first", False):
+        mask_first(surveys)
+
+    # Time the reward calls, if asked; not done otherwise, so no overhead
+    reward_profiler = None
+    if getattr(args, "profile_rewards", False):
+        reward_profiler = RewardProfiler(fileroot)
+        profile_rewards(surveys, reward_profiler)
+
     scheduler = CoreScheduler(surveys, nside=nside)
+    scheduler.reward_profiler = reward_profiler
 
     if args.setup_only:
         return scheduler
@@ -1759,6 +2341,13 @@ def sched_argparser():
         default=DEFAULT_NSIDE,
         help="Nside should be set to default (32) except for tests.",
     )
+    parser.add_argument(
+        "--preview",
+        dest="preview",
+        action="store_true",
+        help=f"Preview profile: run at nside {PREVIEW_NSIDE}, for triage only.",
+    )
+    parser.set_defaults(preview=False)
     parser.add_argument(
         "--mjd_plus",
         type=float,
@@ -1772,6 +2361,26 @@ def sched_argparser():
         help="Split long ToO exposures into standard visit lengths",
     )
     parser.add_argument("--snapshot_dir", type=str, default="", help="Directory for scheduler snapshots.")
+    parser.add_argument(
+        "--profile_rewards",
+        dest="profile_rewards",
+        action="store_true",
+        help="Time the survey reward + basis function calls; written out at the end of the run.",
+    )
+    parser.set_defaults(profile_rewards=False)
+    parser.add_argument(
+        "--mask_first",
+        dest="mask_first",
+        action="store_true",
+        help="Evaluate the masks first; the rest of the reward maps is skipped where fully masked.",
+    )
+    parser.set_defaults(mask_first=False)
+    parser.add_argument(
+        "--setup_cache_dir",
+        type=str,
+        default=None,
+        help="Directory to cache the scheduler setup products (footprints, DDF script, ...) in.",
+    )
     parser.set_defaults(split_long=False)
     parser.add_argument("--no_too", dest="no_too", action="store_true")
     parser.set_defaults(no_too=False)
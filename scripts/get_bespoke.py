@@ -6,16 +6,23 @@ from types import SimpleNamespace
 from astropy.time import Time
 import sys
 import importlib
-from rubin_scheduler.scheduler.utils import SchemaConverter, restore_scheduler
+import pickle
+import hashlib
+import traceback
+import rubin_scheduler
+from rubin_scheduler.scheduler.utils import SchemaConverter, ObservationArray, restore_scheduler
 from rubin_scheduler.scheduler.schedulers import SimpleBandSched
 from rubin_scheduler.scheduler.model_observatory import ModelObservatory
 from rubin_scheduler.scheduler import sim_runner
+from result_cache import get_cache_key
 
-__all__ = ['get_bespoke']
+__all__ = ['get_bespoke', 'get_bespoke_branches']
 
 ###############################################################################
 def get_bespoke(baseline_py_path, sim_to_cut_path, cutoff_date, cutoff_date_format,
-                outdir, scheduler_args, illum_limit=40, exists_only=False
+                outdir, scheduler_args, illum_limit=40, exists_only=False,
+                snapshot_dir=None, checkpoint_nights=None, stream_nights=None,
+                horizon_night=None
                 ):
     """
     generate a new sqlite database, taking observations from database at
@@ -43,6 +50,29 @@ def get_bespoke(baseline_py_path, sim_to_cut_path, cutoff_date, cutoff_date_form
     * exists_only: bool: set to True only look for a simulation and return path
                          if it exists already. otherwise return None.
                          default: False
+    * snapshot_dir: str: directory to cache the restored scheduler and
+                         observatory in, keyed by the contents of the sim to
+                         cut, the cutoff, the baseline .py, scheduler_args
+                         and the rubin_scheduler version;
+                         a cached snapshot is loaded instead of replaying all
+                         the visits upto the cutoff. None for no caching.
+                         default: None
+    * checkpoint_nights: float: save the state of the simulation (scheduler,
+                                observatory, new visits) every so many nights,
+                                next to the new database; a re-run continues
+                                from the latest checkpoint. None for no
+                                checkpoints. default: None
+    * stream_nights: float: write the new database as the simulation runs:
+                            the visits upto the cutoff are copied in (within
+                            sqlite) at the start, and the new visits are
+                            appended every so many nights; the database is
+                            at out_path + '.partial' until it is done. None
+                            to write everything at the end. default: None
+    * horizon_night: float: simulate only upto this night of the survey (as
+                            in the night column), e.g. the last time point
+                            the metrics need, instead of the full survey;
+                            the horizon is added to the filename. None for
+                            the full survey. default: None
 
     returns
     -------
@@ -52,78 +82,517 @@ def get_bespoke(baseline_py_path, sim_to_cut_path, cutoff_date, cutoff_date_form
     # ---------------------------------------------------------
     cutoff_mjd = Time(f'{cutoff_date}T12:00:00', format=cutoff_date_format).mjd
     # fname to save
-    fname = f"bespoke_{sim_to_cut_path.split('/')[-1].split('.db')[0]}_"
-    fname += f"{baseline_py_path.split('/')[-1].split('.py')[0]}-sched_cutoff{cutoff_mjd}.db"
+    out_path = f'{outdir}/' + _bespoke_fname(baseline_py_path=baseline_py_path,
+                                             sim_to_cut_path=sim_to_cut_path,
+                                             cutoff_mjd=cutoff_mjd,
+                                             horizon_night=horizon_night)
 
     # lets see if the db exists already
-    if os.path.exists(f'{outdir}/{fname}'):
-        print(f'## bespoke sim exists already: {outdir}/{fname}\n')
-        return f'{outdir}/{fname}'
+    if os.path.exists(out_path):
+        print(f'## bespoke sim exists already: {out_path}\n')
+        return out_path
     if exists_only:
-        print(f'## bespoke sim DOESNT doesnt exist: {outdir}/{fname}\n')
+        print(f'## bespoke sim DOESNT doesnt exist: {out_path}\n')
         return None
     # first get the visits upto the cutoff date
+    obs_in = _load_obs_in(sim_to_cut_path, cutoff_mjd)
+    # other things needed to restore scheduler
+    gen_scheduler = _get_gen_scheduler(baseline_py_path)
+    args = _get_args(scheduler_args, obs_in)
+    # also create the band scheduler
+    band_sched = SimpleBandSched(illum_limit=illum_limit)
+    # look for a checkpoint from an earlier run
+    checkpoint = None if checkpoint_nights is None else \
+                    _load_checkpoint(out_path, stream_nights=stream_nights)
+    if checkpoint is not None:
+        scheduler, observatory = checkpoint['scheduler'], checkpoint['observatory']
+    else:
+        # now restore the scheduler to the cutoff
+        scheduler, observatory = _restore(gen_scheduler=gen_scheduler, args=args,
+                                          band_sched=band_sched, obs_in=obs_in,
+                                          snapshot_fname=_snapshot_fname(
+                                                snapshot_dir=snapshot_dir,
+                                                baseline_py_path=baseline_py_path,
+                                                sim_to_cut_path=sim_to_cut_path,
+                                                cutoff_mjd=cutoff_mjd,
+                                                scheduler_args=scheduler_args,
+                                                illum_limit=illum_limit)
+                                          )
+    # run the sims + save
+    _run_and_save(scheduler=scheduler, observatory=observatory, band_sched=band_sched,
+                  survey_length=_sim_length(args.survey_length, obs_in, horizon_night),
+                  out_path=out_path,
+                  sim_to_cut_path=sim_to_cut_path, cutoff_mjd=cutoff_mjd,
+                  checkpoint_nights=checkpoint_nights, checkpoint=checkpoint,
+                  stream_nights=stream_nights)
+
+    return out_path
+
+###############################################################################
+def get_bespoke_branches(baseline_py_path, sim_to_cut_path, cutoff_dates, cutoff_date_format,
+                         outdir, scheduler_args, illum_limit=40, max_children=1,
+                         snapshot_dir=None, checkpoint_nights=None, stream_nights=None,
+                         horizon_night=None
+                         ):
+    """
+    generate bespoke sims (as in get_bespoke) for many cutoff dates from the
+    same sim to cut. the scheduler is restored once, at the earliest cutoff,
+    and then advanced through the later cutoffs with only the visits in
+    between; at each cutoff, a child process is forked (sharing the restored
+    scheduler copy-on-write) to run the rest of the survey.
+
+    required inputs
+    ---------------
+    * baseline_py_path: str: path to the .py file that generated the baseline
+                             opsim database
+    * sim_to_cut_path: str: path to the database for which to keep observations
+                            up to the cutoff dates
+    * cutoff_dates: list: cutoff dates, e.g. in mjd or isot format
+    * cutoff_date_format: str: format for cutoff_dates, e.g. 'mjd', 'isot'
+    * outdir: str: output directory
+    * scheduler_args: str: dictionary with arguments to pass to gen_scheduler
+
+    optional inputs
+    ---------------
+    * illum_limit: float: param needed for SimpleBandSched. default: 40
+    * max_children: int: max number of sims to run at a time. default: 1
+    * snapshot_dir: str: directory to cache the restored scheduler and
+                         observatory at each cutoff in; as in get_bespoke.
+                         default: None
+    * checkpoint_nights: float: checkpoint each sim every so many nights;
+                                as in get_bespoke. default: None
+    * stream_nights: float: append the new visits to each database every so
+                            many nights; as in get_bespoke. default: None
+    * horizon_night: float: simulate only upto this night of the survey; as
+                            in get_bespoke. default: None
+
+    returns
+    -------
+    * list: paths to the new databases, in the order of cutoff_dates
+
+    """
+    # ---------------------------------------------------------
+    cutoff_mjds = [Time(f'{cutoff_date}T12:00:00', format=cutoff_date_format).mjd
+                   for cutoff_date in cutoff_dates]
+    out_paths = [f'{outdir}/' + _bespoke_fname(baseline_py_path=baseline_py_path,
+                                               sim_to_cut_path=sim_to_cut_path,
+                                               cutoff_mjd=cutoff_mjd,
+                                               horizon_night=horizon_night)
+                 for cutoff_mjd in cutoff_mjds]
+    # lets see which dbs exist already
+    todo = []
+    for cutoff_mjd, out_path in zip(cutoff_mjds, out_paths):
+        if os.path.exists(out_path):
+            print(f'## bespoke sim exists already: {out_path}\n')
+        else:
+            todo.append((cutoff_mjd, out_path))
+    if len(todo) == 0:
+        return out_paths
+    todo = sorted(todo)
+
+    # get the visits upto the latest cutoff date - once
+    all_obs_in = _load_obs_in(sim_to_cut_path, todo[-1][0])
+    gen_scheduler = _get_gen_scheduler(baseline_py_path)
+    band_sched = SimpleBandSched(illum_limit=illum_limit)
+
+    # now step through the cutoffs; fork off a sim at each
+    restored, children, failed = None, {}, []
+    for cutoff_mjd, out_path in todo:
+        obs_in = all_obs_in[all_obs_in['mjd'] <= cutoff_mjd]
+        args = _get_args(scheduler_args, obs_in)
+        scheduler, observatory = _restore(gen_scheduler=gen_scheduler, args=args,
+                                          band_sched=band_sched, obs_in=obs_in,
+                                          snapshot_fname=_snapshot_fname(
+                                                snapshot_dir=snapshot_dir,
+                                                baseline_py_path=baseline_py_path,
+                                                sim_to_cut_path=sim_to_cut_path,
+                                                cutoff_mjd=cutoff_mjd,
+                                                scheduler_args=scheduler_args,
+                                                illum_limit=illum_limit),
+                                          restored=restored
+                                          )
+        restored = (scheduler, observatory, obs_in['ID'].max())
+        # wait for a sim to finish if we're at the limit
+        while len(children) >= max(max_children, 1):
+            _wait_child(children, failed)
+        # flush so that the child doesnt repeat buffered output
+        sys.stdout.flush()
+        pid = os.fork()
+        if pid == 0:
+            # child: run the rest of the survey from here; never return
+            status = 1
+            try:
+                checkpoint = None if checkpoint_nights is None else \
+                    _load_checkpoint(out_path, stream_nights=stream_nights)
+                _run_and_save(scheduler=scheduler, observatory=observatory,
+                              band_sched=band_sched,
+                              survey_length=_sim_length(args.survey_length, obs_in,
+                                                        horizon_night),
+                              out_path=out_path, sim_to_cut_path=sim_to_cut_path,
+                              cutoff_mjd=cutoff_mjd, checkpoint_nights=checkpoint_nights,
+                              checkpoint=checkpoint, stream_nights=stream_nights)
+                status = 0
+            except BaseException:
+                # os._exit below would swallow the traceback otherwise
+                traceback.print_exc()
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(status)
+        print(f'## forked {pid} for {out_path}')
+        children[pid] = out_path
+    # wait for the rest
+    while len(children) > 0:
+        _wait_child(children, failed)
+    if len(failed) > 0:
+        raise ValueError(f'## bespoke sims failed: {failed}')
+
+    return out_paths
+
+###############################################################################
+def _bespoke_fname(baseline_py_path, sim_to_cut_path, cutoff_mjd, horizon_night=None):
+    """
+    filename for the bespoke database.
+    """
+    fname = f"bespoke_{sim_to_cut_path.split('/')[-1].split('.db')[0]}_"
+    fname += f"{baseline_py_path.split('/')[-1].split('.py')[0]}-sched_cutoff{cutoff_mjd}"
+    if horizon_night is not None:
+        fname += f"_horizon{horizon_night:g}"
+    return f'{fname}.db'
+
+###############################################################################
+def _load_obs_in(sim_to_cut_path, cutoff_mjd, chunk_size=100000):
+    """
+    visits upto cutoff_mjd as an ObservationArray, to restore the scheduler
+    with. only the columns that map to its fields are read, chunk_size rows
+    at a time, straight into the (preallocated) array; fields with no column
+    are left at their defaults.
+    """
+    converter = SchemaConverter()
     conn = sqlite3.connect(sim_to_cut_path)
-    query = f"select * from observations where observationStartMJD <= {cutoff_mjd}"
-    observations = pd.read_sql(query, conn)
+    db_cols = [row[1] for row in conn.execute('pragma table_info(observations)')]
+    n_obs = conn.execute('select count(*) from observations where observationStartMJD <= ?',
+                         (cutoff_mjd,)).fetchone()[0]
+    obs_in = ObservationArray(n=n_obs)
+    # (field, column) for the fields we can fill; inv_map is obs -> opsim
+    fields = [(field, converter.inv_map.get(field, field)) for field in obs_in.dtype.names]
+    fields = [(field, col) for field, col in fields if col in db_cols]
+    chunk_dtype = [(field, obs_in.dtype[field]) for field, _ in fields]
+    cols = ', '.join([f'"{col}"' for _, col in fields])
+    cursor = conn.execute(f'select {cols} from observations where observationStartMJD <= ? ' +
+                          'order by rowid', (cutoff_mjd,))
+    start = 0
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if len(rows) == 0:
+            break
+        try:
+            chunk = np.array(rows, dtype=chunk_dtype)
+        except (TypeError, ValueError):
+            # e.g. nulls; convert column by column (nulls -> nan for floats)
+            chunk = np.empty(len(rows), dtype=chunk_dtype)
+            for i, (field, _) in enumerate(fields):
+                chunk[field] = np.array([row[i] for row in rows], dtype=obs_in.dtype[field])
+        for field, _ in fields:
+            obs_in[field][start:start + len(rows)] = chunk[field]
+        start += len(rows)
     conn.close()
-    # ok so we have the observations up until the cutoff
-    # add bogus columns ..
-    cols_to_add = ['note', 'cloud_extinction']
-    for col in cols_to_add:
-        observations[col] = np.zeros_like(observations['observationId'])
-    # need to convert opsim column names to those needed for scheduler
-    converter = SchemaConverter()
-    obs_in = converter.opsimdf2obs(observations)
-    # other things needed to restore scheduler
-    # lets pull in the functions used in generating the baseline
+    # opsim has angles in degrees; the scheduler in radians. angles_rad2deg
+    # has the opsim column names
+    for field, col in fields:
+        if col in converter.angles_rad2deg:
+            obs_in[field] = np.radians(obs_in[field])
+    return obs_in
+
+###############################################################################
+def _get_gen_scheduler(baseline_py_path):
+    """
+    gen_scheduler from the .py that generated the baseline; importing it also
+    makes its module available to unpickle snapshots.
+    """
     sys.path.append(os.path.dirname(baseline_py_path))
     baseline_py = importlib.import_module(
                         baseline_py_path.split('/')[-1].split('.py')[0]
                         )
-    gen_scheduler = getattr(baseline_py, 'gen_scheduler')
-    # scheduler args
+    return getattr(baseline_py, 'gen_scheduler')
+
+###############################################################################
+def _get_args(scheduler_args, obs_in):
+    """
+    args for gen_scheduler, to simulate the rest of the survey after the
+    visits in obs_in.
+    """
     args = SimpleNamespace(**scheduler_args)
-    args.survey_length = args.survey_length - observations['night'].max() + 1
+    args.survey_length = args.survey_length - obs_in['night'].max() + 1
     print(f'## working on simulating {args.survey_length} nights.')
     # we only want the scheduler so lets just update the arg for that
     args.setup_only = True
     args.verbose = True
     print(f'args = {args}')
-    # now create the scheduler
-    scheduler = gen_scheduler(args)
-    # also create the band scheduler
-    band_sched = SimpleBandSched(illum_limit=illum_limit)
-    # now the model observatory
-    observatory = ModelObservatory(nside=scheduler.nside,
-                                   mjd_start=observations['observationStartMJD'].min(),
-                                   sim_to_o=None)
-    # now restore rescheduler to the obsID we cut at
-    scheduler, observatory = restore_scheduler(observation_id=observations['observationId'].max(),
-                                               scheduler=scheduler,
-                                               observatory=observatory,
-                                               in_obs=obs_in,
-                                               band_sched=band_sched, fast=True)
+    return args
+
+###############################################################################
+def _sim_length(survey_length, obs_in, horizon_night=None):
+    """
+    number of nights to simulate after the visits in obs_in: survey_length
+    (the rest of the survey, from _get_args), or upto horizon_night if that
+    comes first.
+    """
+    if horizon_night is None:
+        return survey_length
+    return max(min(survey_length, horizon_night - obs_in['night'].max() + 1), 0)
+
+###############################################################################
+def _snapshot_fname(snapshot_dir, baseline_py_path, sim_to_cut_path, cutoff_mjd,
+                    scheduler_args, illum_limit):
+    """
+    path for the snapshot of the scheduler restored at cutoff_mjd; None if
+    snapshot_dir is None.
+    """
+    if snapshot_dir is None:
+        return None
+    with open(baseline_py_path, 'rb') as f:
+        baseline_py_hash = hashlib.sha1(f.read()).hexdigest()
+    key = get_cache_key(snapshot_dir, [sim_to_cut_path], cutoff_mjd=cutoff_mjd,
+                        baseline_py_hash=baseline_py_hash,
+                        # pickles from another version may not be compatible
+                        rubin_scheduler_version=rubin_scheduler.__version__,
+                        # where the setup products are cached doesnt
+                        # change the scheduler
+                        scheduler_args=sorted([item for item in scheduler_args.items()
+                                               if item[0] != 'setup_cache_dir']),
+                        illum_limit=illum_limit)
+    return f'{snapshot_dir}/restored_{key}.pickle'
+
+###############################################################################
+def _restore(gen_scheduler, args, band_sched, obs_in, snapshot_fname=None,
+             restored=None):
+    """
+    scheduler + observatory restored to the end of obs_in. read from
+    snapshot_fname if it exists (and saved there otherwise). if restored, a
+    (scheduler, observatory, last observationId) tuple restored to an earlier
+    point, is given, only the visits after that are replayed.
+    """
+    if snapshot_fname is not None and os.path.exists(snapshot_fname):
+        print(f'## reading restored scheduler from {snapshot_fname} ...')
+        with open(snapshot_fname, 'rb') as f:
+            return pickle.load(f)
+
+    if restored is None:
+        # now create the scheduler
+        scheduler = gen_scheduler(args)
+        # now the model observatory
+        observatory = ModelObservatory(nside=scheduler.nside,
+                                       mjd_start=obs_in['mjd'].min(),
+                                       sim_to_o=None)
+    else:
+        scheduler, observatory, last_id = restored
+        obs_in = obs_in[obs_in['ID'] > last_id]
+    if len(obs_in) > 0:
+        # now restore rescheduler to the obsID we cut at
+        scheduler, observatory = restore_scheduler(observation_id=obs_in['ID'].max(),
+                                                   scheduler=scheduler,
+                                                   observatory=observatory,
+                                                   in_obs=obs_in,
+                                                   band_sched=band_sched, fast=True)
+    if snapshot_fname is not None:
+        # write to a temp file first so that a concurrent reader never
+        # sees a partial file
+        with open(f'{snapshot_fname}.{os.getpid()}', 'wb') as f:
+            pickle.dump((scheduler, observatory), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f'{snapshot_fname}.{os.getpid()}', snapshot_fname)
+        print(f'## saved restored scheduler as {snapshot_fname}')
+
+    return scheduler, observatory
+
+###############################################################################
+def _run_and_save(scheduler, observatory, band_sched, survey_length, out_path,
+                  sim_to_cut_path, cutoff_mjd, checkpoint_nights=None, checkpoint=None,
+                  stream_nights=None):
+    """
+    run the scheduler for survey_length nights and save the visits in
+    sim_to_cut_path upto cutoff_mjd (copied within sqlite) + the new visits
+    at out_path. with checkpoint_nights, a checkpoint is saved every so many
+    nights; a checkpoint (from _load_checkpoint) to continue from can be
+    given. with stream_nights, the new visits are appended to the database
+    every so many nights instead of being kept in memory.
+    """
+    observations_new, nights_done = [], 0
+    if checkpoint is not None:
+        scheduler, observatory = checkpoint['scheduler'], checkpoint['observatory']
+        observations_new, nights_done = checkpoint['observations_new'], checkpoint['nights_done']
+        print(f'## continuing from the checkpoint at {nights_done} nights.')
+    # run the sim in chunks, to checkpoint and/or write out after each
+    chunk_nights = min([survey_length] + [nights for nights in [checkpoint_nights, stream_nights]
+                                          if nights is not None])
+    converter = SchemaConverter()
+    partial_path = f'{out_path}.partial'
+    if stream_nights is not None:
+        if checkpoint is not None and 'n_rows' in checkpoint:
+            # _load_checkpoint made sure that the partial db is there
+            conn = sqlite3.connect(partial_path)
+            # drop anything appended after the checkpoint
+            conn.execute('delete from observations where rowid > ?', (checkpoint['n_rows'],))
+            conn.commit()
+        else:
+            conn = _start_partial(partial_path, sim_to_cut_path=sim_to_cut_path,
+                                  cutoff_mjd=cutoff_mjd)
+            if len(observations_new) > 0:
+                _append_visits(conn, converter.obs2opsim(np.concatenate(observations_new)))
+        observations_new = []
     # run the sims
-    _, _, observations_new = sim_runner(observatory, scheduler,
-                                        sim_duration=args.survey_length,
-                                        filename=None,
-                                        delete_past=True,
-                                        n_visit_limit=None,
-                                        verbose=True,
-                                        extra_info=None,
-                                        band_scheduler=band_sched,
-                                        event_table=None,
-                                        snapshot_dir=None,
-                                        record_rewards=False
-                                        )
-    # now concatenate
-    conn = sqlite3.connect(f'{outdir}/{fname}')
-    observations = observations.drop(columns=cols_to_add, errors='ignore')
-    pd.concat([observations,
-               converter.obs2opsim(observations_new)
-               ], ignore_index=True).to_sql('observations', conn,
-                                            index=False, if_exists='replace')
+    last_checkpoint = nights_done
+    while nights_done < survey_length:
+        sim_duration = min(chunk_nights, survey_length - nights_done)
+        observatory, scheduler, observations_chunk = sim_runner(observatory, scheduler,
+                                                                sim_duration=sim_duration,
+                                                                filename=None,
+                                                                delete_past=True,
+                                                                n_visit_limit=None,
+                                                                verbose=True,
+                                                                extra_info=None,
+                                                                band_scheduler=band_sched,
+                                                                event_table=None,
+                                                                snapshot_dir=None,
+                                                                record_rewards=False
+                                                                )
+        nights_done += sim_duration
+        if observations_chunk is not None and len(observations_chunk) > 0:
+            if stream_nights is not None:
+                _append_visits(conn, converter.obs2opsim(observations_chunk))
+            else:
+                observations_new.append(observations_chunk)
+        if checkpoint_nights is not None and nights_done < survey_length and \
+                                    nights_done - last_checkpoint >= checkpoint_nights:
+            checkpoint = {'scheduler': scheduler, 'observatory': observatory,
+                          'observations_new': observations_new, 'nights_done': nights_done,
+                          'stream_nights': stream_nights}
+            if stream_nights is not None:
+                checkpoint['n_rows'] = conn.execute('select max(rowid) from observations'
+                                                    ).fetchone()[0]
+            _save_checkpoint(out_path, checkpoint)
+            last_checkpoint = nights_done
+
+    if stream_nights is None:
+        # now concatenate
+        conn = _start_partial(partial_path, sim_to_cut_path=sim_to_cut_path,
+                              cutoff_mjd=cutoff_mjd)
+        if len(observations_new) > 0:
+            _append_visits(conn, converter.obs2opsim(np.concatenate(observations_new)))
     conn.close()
+    os.replace(partial_path, out_path)
+    # reward timings, if the scheduler was set up to profile them
+    if getattr(scheduler, 'reward_profiler', None) is not None:
+        scheduler.reward_profiler.write(f'{out_path}.')
+    # done; dont need the checkpoints anymore
+    for fname in _checkpoint_fnames(out_path):
+        if os.path.exists(fname):
+            os.remove(fname)
 
-    return f'{outdir}/{fname}'
\ No newline at end of file
+###############################################################################
+def _start_partial(partial_path, sim_to_cut_path, cutoff_mjd):
+    """
+    start the database at partial_path with the visits in sim_to_cut_path
+    upto cutoff_mjd, copied within sqlite. returns the connection to it.
+    """
+    if os.path.exists(partial_path):
+        os.remove(partial_path)
+    conn = sqlite3.connect(partial_path)
+    conn.execute('attach database ? as cut', (sim_to_cut_path,))
+    conn.execute('create table observations as select * from cut.observations ' +
+                 'where observationStartMJD <= ?', (cutoff_mjd,))
+    conn.commit()
+    conn.execute('detach database cut')
+    return conn
+
+###############################################################################
+def _append_visits(conn, visits):
+    """
+    append the visits (DataFrame) to the observations table; columns that
+    the table doesnt have yet are added.
+    """
+    cols = [row[1] for row in conn.execute('pragma table_info(observations)')]
+    for col in visits.columns:
+        if col in cols:
+            continue
+        if pd.api.types.is_bool_dtype(visits[col]) or pd.api.types.is_integer_dtype(visits[col]):
+            col_type = 'INTEGER'
+        elif pd.api.types.is_float_dtype(visits[col]):
+            col_type = 'REAL'
+        else:
+            col_type = 'TEXT'
+        conn.execute(f'alter table observations add column "{col}" {col_type}')
+    visits.to_sql('observations', conn, index=False, if_exists='append')
+    conn.commit()
+
+###############################################################################
+def _checkpoint_fnames(out_path):
+    """
+    paths for the latest and the previous checkpoints of the sim for out_path.
+    """
+    return [f'{out_path}.checkpoint.pickle', f'{out_path}.checkpoint_prev.pickle']
+
+###############################################################################
+def _save_checkpoint(out_path, checkpoint):
+    """
+    save the checkpoint dict for the sim for out_path; the previous one is
+    kept as a fallback.
+    """
+    latest, prev = _checkpoint_fnames(out_path)
+    # write to a temp file first so that a preempted job never leaves a
+    # partial checkpoint
+    with open(f'{latest}.{os.getpid()}', 'wb') as f:
+        pickle.dump(checkpoint, f, protocol=pickle.HIGHEST_PROTOCOL)
+    if os.path.exists(latest):
+        os.replace(latest, prev)
+    os.replace(f'{latest}.{os.getpid()}', latest)
+    print(f'## saved checkpoint at {checkpoint["nights_done"]} nights as {latest}')
+
+###############################################################################
+def _load_checkpoint(out_path, stream_nights=None):
+    """
+    the latest readable checkpoint for the sim for out_path; None if there
+    isnt one. a checkpoint written while streaming keeps its new visits only
+    in the (.partial) database, so it is only used if that database is there
+    and stream_nights is the same as when it was written; otherwise it is
+    thrown away, and the sim starts over.
+    """
+    for fname in _checkpoint_fnames(out_path):
+        if not os.path.exists(fname):
+            continue
+        try:
+            with open(fname, 'rb') as f:
+                checkpoint = pickle.load(f)
+        except Exception as e:
+            print(f'## couldnt read checkpoint {fname}: {e}')
+            continue
+        if 'n_rows' in checkpoint:
+            if not os.path.exists(f'{out_path}.partial'):
+                print(f'## ignoring checkpoint {fname}: {out_path}.partial, with the ' +
+                      'visits streamed before it, is missing.')
+                return None
+            if checkpoint.get('stream_nights') != stream_nights:
+                print(f'## ignoring checkpoint {fname}: written with stream_nights = ' +
+                      f'{checkpoint.get("stream_nights")}, not {stream_nights}.')
+                return None
+        print(f'## read checkpoint from {fname}')
+        return checkpoint
+    return None
+
+###############################################################################
+def _wait_child(children, failed):
+    """
+    wait for one of the forked sims (dict of pid: out_path) to finish; its
+    out_path is added to failed if it didnt succeed.
+    """
+    pid, status = os.wait()
+    out_path = children.pop(pid, None)
+    if out_path is None:
+        return
+    exit_code = os.waitstatus_to_exitcode(status)
+    if exit_code != 0:
+        # negative for a signal, e.g. -9 if killed
+        print(f'## sim for {out_path} failed (exit code {exit_code}).')
+        failed.append(out_path)
+    else:
+        print(f'## sim for {out_path} done.')
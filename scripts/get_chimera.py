@@ -3,16 +3,24 @@ import sqlite3
 import os
 from astropy.time import Time
 
-__all__ = ['get_chimera']
+__all__ = ['get_cutoff_mjd', 'get_chimera']
+
+###############################################################################
+def get_cutoff_mjd(cutoff_date, cutoff_date_format):
+    """
+    mjd for the cutoff date; noon UTC on the date, i.e., between nights.
+    """
+    return Time(f'{cutoff_date}T12:00:00', format=cutoff_date_format).mjd
 
 ###############################################################################
 def get_chimera(baseline_path, sim_to_cut_path, cutoff_date, cutoff_date_format,
-                outdir
+                outdir, mode='sql', chunk_size=100000
                 ):
     """
     generate a new sqlite database, taking observations from database at
     sim_to_cut_path <= cutoff date, and appending the baseline observations
-    after the cutoff.
+    after the cutoff. for a list of cutoff dates, one database is generated
+    for each, with each source read only once.
 
     required inputs
     ---------------
@@ -20,26 +28,53 @@ def get_chimera(baseline_path, sim_to_cut_path, cutoff_date, cutoff_date_format,
                           past the cutoff date)
     * sim_to_cut_path: str: path to the database for which to keep observations
                             up to the cutoff date
-    * cutoff_date: str: cutoff date, e.g. in mjd or isot format
+    * cutoff_date: str or list: cutoff date(s), e.g. in mjd or isot format
     * cutoff_date_format: str: format for cutoff_date, e.g. 'mjd', 'isot'
     * outdir: str: output directory
 
+    optional inputs
+    ---------------
+    * mode: str: 'sql' to build the new database within sqlite (attaching
+                 the two sources; nothing is loaded into memory); 'pandas'
+                 to read both into pandas, concatenate and write out;
+                 'virtual' to only write a small database that points to the
+                 two sources (see opsim_db.connect_opsim for reading it).
+                 with many cutoff dates, 'sql' copies each source in chunks
+                 into all the new databases, scanning it once.
+                 default: 'sql'
+    * chunk_size: int: number of rowids to copy at a time for many cutoff
+                       dates with mode='sql'. default: 100000
+
     returns
     -------
-    * path to the new database
+    * path to the new database; list of paths for a list of cutoff dates
 
     """
     # ---------------------------------------------------------
-    cutoff_mjd = Time(f'{cutoff_date}T12:00:00', format=cutoff_date_format).mjd
-    # fname to save
-    fname = f"chimera_{sim_to_cut_path.split('/')[-1].split('.db')[0]}_"
-    fname += f"{baseline_path.split('/')[-1].split('.db')[0]}_cutoff{cutoff_mjd}.db"
+    if not isinstance(cutoff_date, str):
+        return _get_chimeras(baseline_path=baseline_path, sim_to_cut_path=sim_to_cut_path,
+                             cutoff_dates=cutoff_date, cutoff_date_format=cutoff_date_format,
+                             outdir=outdir, mode=mode, chunk_size=chunk_size)
+    cutoff_mjd = get_cutoff_mjd(cutoff_date, cutoff_date_format)
+    fname = _chimera_fname(baseline_path=baseline_path, sim_to_cut_path=sim_to_cut_path,
+                           cutoff_mjd=cutoff_mjd, mode=mode)
 
     # lets see if the db exists already
     if os.path.exists(f'{outdir}/{fname}'):
         print(f'## chimera sim exists already: {outdir}/{fname}\n')
         return f'{outdir}/{fname}'
 
+    if mode == 'sql':
+        _write_chimera_sql(baseline_path=baseline_path, sim_to_cut_path=sim_to_cut_path,
+                           cutoff_mjd=cutoff_mjd, out_path=f'{outdir}/{fname}')
+        return f'{outdir}/{fname}'
+    elif mode == 'virtual':
+        _write_chimera_virtual(baseline_path=baseline_path, sim_to_cut_path=sim_to_cut_path,
+                               cutoff_mjd=cutoff_mjd, out_path=f'{outdir}/{fname}')
+        return f'{outdir}/{fname}'
+    elif mode != 'pandas':
+        raise ValueError(f'## unknown mode: {mode}')
+
     # first get the visits upto the cutoff date
     conn = sqlite3.connect(sim_to_cut_path)
     query = f"select * from observations where observationStartMJD <= {cutoff_mjd}"
@@ -60,4 +95,207 @@ def get_chimera(baseline_path, sim_to_cut_path, cutoff_date, cutoff_date_format,
                                                     )
     conn.close()
 
-    return f'{outdir}/{fname}'
\ No newline at end of file
+    return f'{outdir}/{fname}'
+
+###############################################################################
+def _chimera_fname(baseline_path, sim_to_cut_path, cutoff_mjd, mode):
+    """
+    filename for the chimera database.
+    """
+    fname = f"chimera_{sim_to_cut_path.split('/')[-1].split('.db')[0]}_"
+    fname += f"{baseline_path.split('/')[-1].split('.db')[0]}_cutoff{cutoff_mjd}"
+    fname += '_virtual.db' if mode == 'virtual' else '.db'
+    return fname
+
+###############################################################################
+def _get_chimeras(baseline_path, sim_to_cut_path, cutoff_dates, cutoff_date_format,
+                  outdir, mode, chunk_size):
+    """
+    get_chimera for a list of cutoff dates; only the databases that dont
+    exist already are generated, reading each source once.
+    """
+    out_paths, todo = [], {}
+    for cutoff_date in cutoff_dates:
+        cutoff_mjd = get_cutoff_mjd(cutoff_date, cutoff_date_format)
+        out_paths.append(f'{outdir}/' + _chimera_fname(baseline_path=baseline_path,
+                                                       sim_to_cut_path=sim_to_cut_path,
+                                                       cutoff_mjd=cutoff_mjd, mode=mode))
+        if os.path.exists(out_paths[-1]):
+            print(f'## chimera sim exists already: {out_paths[-1]}\n')
+        else:
+            todo[cutoff_mjd] = out_paths[-1]
+
+    if len(todo) == 0:
+        return out_paths
+    if mode == 'virtual' or len(todo) == 1:
+        # nothing to share between the cutoffs
+        for cutoff_date in cutoff_dates:
+            get_chimera(baseline_path=baseline_path, sim_to_cut_path=sim_to_cut_path,
+                        cutoff_date=cutoff_date, cutoff_date_format=cutoff_date_format,
+                        outdir=outdir, mode=mode)
+    elif mode == 'sql':
+        _write_chimeras_stream(baseline_path=baseline_path, sim_to_cut_path=sim_to_cut_path,
+                               cutoff_mjds=list(todo), out_paths=list(todo.values()),
+                               chunk_size=chunk_size)
+    elif mode == 'pandas':
+        # read the visits needed for any of the cutoffs - once
+        conn = sqlite3.connect(sim_to_cut_path)
+        query = f"select * from observations where observationStartMJD <= {max(todo)}"
+        df1 = pd.read_sql(query, conn)
+        conn.close()
+        conn = sqlite3.connect(baseline_path)
+        query = f"select * from observations where observationStartMJD > {min(todo)}"
+        df2 = pd.read_sql(query, conn)
+        conn.close()
+        # now write each chimera
+        for cutoff_mjd, out_path in todo.items():
+            conn = sqlite3.connect(out_path)
+            pd.concat([df1[df1['observationStartMJD'] <= cutoff_mjd],
+                       df2[df2['observationStartMJD'] > cutoff_mjd]
+                       ], ignore_index=True).to_sql('observations', conn,
+                                                    index=False,
+                                                    if_exists='replace'
+                                                    )
+            conn.close()
+    else:
+        raise ValueError(f'## unknown mode: {mode}')
+
+    return out_paths
+
+###############################################################################
+def _write_chimeras_stream(baseline_path, sim_to_cut_path, cutoff_mjds, out_paths,
+                           chunk_size):
+    """
+    write chimera databases for many cutoffs with one scan of each source,
+    all within sqlite: chunk_size rowids at a time are copied into an
+    in-memory temp table, which is then appended (with INSERT ... SELECT) to
+    every database it belongs in. the tables are set up as in
+    _write_chimera_sql, so the schema is the same as for a single cutoff.
+    """
+    # write to temp files first so that a crash never leaves partial
+    # databases that look like finished ones
+    tmp_paths = [f'{out_path}.{os.getpid()}.tmp' for out_path in out_paths]
+    for tmp_path in tmp_paths:
+        _start_chimera(tmp_path, baseline_path=baseline_path,
+                       sim_to_cut_path=sim_to_cut_path).close()
+
+    conn = sqlite3.connect(':memory:')
+    conn.execute('pragma temp_store = memory')
+    conn.execute('attach database ? as cut', (sim_to_cut_path,))
+    conn.execute('attach database ? as base', (baseline_path,))
+    # as many of the new databases as sqlite lets us attach at a time; for
+    # more, the sources are scanned once per batch
+    batch_size = max(conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED) - 2, 1)
+    for start in range(0, len(tmp_paths), batch_size):
+        batch = list(zip(cutoff_mjds, tmp_paths))[start:start + batch_size]
+        for i, (_, tmp_path) in enumerate(batch):
+            conn.execute(f'attach database ? as out{i}', (tmp_path,))
+            # bulk-load settings; the file is not in use until it is renamed
+            conn.execute(f'pragma out{i}.journal_mode = off')
+            conn.execute(f'pragma out{i}.synchronous = off')
+        batch_mjds = [cutoff_mjd for cutoff_mjd, _ in batch]
+        # the cut sim upto the latest cutoff; the baseline after the earliest
+        for schema, where, bound in [('cut', 'observationStartMJD <= ?', max(batch_mjds)),
+                                     ('base', 'observationStartMJD > ?', min(batch_mjds))]:
+            cols = ', '.join([f'"{row[1]}"' for row in
+                              conn.execute(f'pragma {schema}.table_info(observations)')])
+            conn.execute(f'create temp table chunk as select {cols} ' +
+                         f'from {schema}.observations where 0')
+            min_rowid, max_rowid = conn.execute(f'select min(rowid), max(rowid) ' +
+                                                f'from {schema}.observations').fetchone()
+            for rowid in range(min_rowid or 0, (max_rowid or -1) + 1, chunk_size):
+                conn.execute(f'insert into temp.chunk select {cols} from {schema}.observations ' +
+                             f'where rowid >= ? and rowid < ? and {where} order by rowid',
+                             (rowid, rowid + chunk_size, bound))
+                for i, cutoff_mjd in enumerate(batch_mjds):
+                    conn.execute(f'insert into out{i}.observations ({cols}) ' +
+                                 f'select {cols} from temp.chunk where {where}', (cutoff_mjd,))
+                conn.execute('delete from temp.chunk')
+            conn.execute('drop table temp.chunk')
+        conn.commit()
+        for i in range(len(batch)):
+            conn.execute(f'detach database out{i}')
+    conn.close()
+
+    for tmp_path, out_path in zip(tmp_paths, out_paths):
+        os.replace(tmp_path, out_path)
+
+###############################################################################
+def _start_chimera(tmp_path, baseline_path, sim_to_cut_path):
+    """
+    start a chimera database at tmp_path: an empty observations table with
+    the cut sim's columns (as CREATE TABLE AS makes them) + any that only the
+    baseline has. returns the connection to it.
+    """
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    # bulk-load settings; the file is not in use until it is renamed
+    conn.execute('pragma journal_mode = off')
+    conn.execute('pragma synchronous = off')
+    conn.execute('attach database ? as cut', (sim_to_cut_path,))
+    conn.execute('attach database ? as base', (baseline_path,))
+    conn.execute('create table observations as select * from cut.observations where 0')
+    # add any columns that only the baseline has
+    cols = [row[1] for row in conn.execute('pragma main.table_info(observations)')]
+    for name, col_type in [row[1:3] for row in conn.execute('pragma base.table_info(observations)')]:
+        if name not in cols:
+            conn.execute(f'alter table observations add column "{name}" {col_type}')
+    conn.commit()
+    conn.execute('detach database cut')
+    conn.execute('detach database base')
+    return conn
+
+###############################################################################
+def _write_chimera_sql(baseline_path, sim_to_cut_path, cutoff_mjd, out_path):
+    """
+    write the chimera database at out_path with INSERT ... SELECT from the two
+    attached sources. columns are matched by name, and the table has all the
+    columns in either source (as with pd.concat).
+    """
+    # write to a temp file first so that a crash never leaves a partial
+    # database that looks like a finished one
+    tmp_path = f'{out_path}.{os.getpid()}.tmp'
+    conn = _start_chimera(tmp_path, baseline_path=baseline_path,
+                          sim_to_cut_path=sim_to_cut_path)
+    conn.execute('attach database ? as cut', (sim_to_cut_path,))
+    conn.execute('attach database ? as base', (baseline_path,))
+    # visits upto the cutoff date, then after it
+    for schema, where in [('cut', 'observationStartMJD <= ?'),
+                          ('base', 'observationStartMJD > ?')]:
+        cols = ', '.join([f'"{row[1]}"' for row in
+                          conn.execute(f'pragma {schema}.table_info(observations)')])
+        conn.execute(f'insert into observations ({cols}) select {cols} ' +
+                     f'from {schema}.observations where {where} order by rowid', (cutoff_mjd,))
+    conn.commit()
+    conn.close()
+    os.replace(tmp_path, out_path)
+
+###############################################################################
+def _write_chimera_virtual(baseline_path, sim_to_cut_path, cutoff_mjd, out_path):
+    """
+    write a virtual chimera database at out_path: just the two sources + the
+    cuts on them, which opsim_db.connect_opsim turns into an observations view.
+    """
+    # rowids of the baseline rows are offset past those of the cut sim's rows
+    conn = sqlite3.connect(sim_to_cut_path)
+    rowid_offset = conn.execute('select max(rowid) from observations ' +
+                                'where observationStartMJD <= ?', (cutoff_mjd,)).fetchone()[0]
+    conn.close()
+
+    tmp_path = f'{out_path}.{os.getpid()}.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    conn.execute('create table virtual_sources (source_order integer, path text, ' +
+                 'constraint_sql text, rowid_offset integer)')
+    conn.executemany('insert into virtual_sources values (?, ?, ?, ?)',
+                     [(0, os.path.abspath(sim_to_cut_path),
+                       f'observationStartMJD <= {cutoff_mjd}', 0),
+                      (1, os.path.abspath(baseline_path),
+                       f'observationStartMJD > {cutoff_mjd}',
+                       0 if rowid_offset is None else rowid_offset)
+                      ])
+    conn.commit()
+    conn.close()
+    os.replace(tmp_path, out_path)
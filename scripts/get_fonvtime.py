@@ -3,8 +3,16 @@ from rubin_sim import maf
 import healpy as hp
 import numpy as np
 import os
+from get_pixel_index import get_visit_pixels, get_pixel_index, select_index_rows
+from result_cache import get_cache_key, cache_load, cache_save
+from opsim_db import get_virtual_sources, connect_opsim
 
-__all__ = ['FONvTime', 'get_fonvtime']
+__all__ = ['FONvTime', 'get_pixel_counts',
+           'get_fonvtime', 'get_fonvtime_split', 'get_fonvtime_chimera']
+
+# version of the fonv outputs; bump whenever a change to the metric changes
+# its values, so that cached results are not reused
+FONV_VERSION = 3
 
 ###############################################################################
 # fonov vector metric; from
@@ -12,12 +20,17 @@ __all__ = ['FONvTime', 'get_fonvtime']
 class FONvTime(maf.metrics.BaseMetric):
     """Given a vector metric with number of observations over time, convert to
     FONv over time.
+
+    Only the top n_pix_needed values in each time column are needed, so these
+    are selected with np.partition (rather than a full sort), chunk_size time
+    columns at a time to keep the working copy small.
     """
     # ---------------------------------------------------------
-    def __init__(self, asky=18000.0, stat=np.median, **kwargs):
+    def __init__(self, asky=18000.0, stat=np.median, chunk_size=256, **kwargs):
         super().__init__(**kwargs)
         self.asky = asky
         self.stat = stat
+        self.chunk_size = chunk_size
         # This should get full vector metric passed
         # with masked values set to zero
         self.mask_val = 0 
@@ -27,21 +40,29 @@ class FONvTime(maf.metrics.BaseMetric):
         # Should be able to add a check on data_slice dim,
         # then just promote it to an (N,1) array if
         # it's a single map. 
-        n_pix_heal = data_slice["metricdata"][:,0].size
+        data = np.asarray(data_slice["metricdata"])
+        n_pix_heal = data[:,0].size
         nside = hp.npix2nside(n_pix_heal)
         pix_area = hp.nside2pixarea(nside, degrees=True)
         n_pix_needed = int(np.ceil(self.asky/pix_area))
-        # sort by value
-        data = data_slice["metricdata"].copy()
-        data.sort(axis=0)
-        # Crop down to the desired sky area
-        data = data[n_pix_heal-n_pix_needed:, :]
-        result = self.stat(data, axis=0)
-        return result
+        # index of the first of the top n_pix_needed values in sorted order
+        kth = max(n_pix_heal - n_pix_needed, 0)
+        if kth == 0:
+            # need the whole sky; no need to select (or copy) anything
+            return self.stat(data, axis=0)
+        result = []
+        for start in range(0, data.shape[1], self.chunk_size):
+            # select the top values for this block of time columns; the rows
+            # from kth on are the n_pix_needed largest, in no particular order
+            block = np.partition(data[:, start:start + self.chunk_size], kth, axis=0)
+            # Crop down to the desired sky area
+            result.append(self.stat(block[kth:, :], axis=0))
+        return np.concatenate(result)
 
 ###############################################################################
 def get_fonvtime(constraint, nside, time_points, opsim_path, outdir,
-                 save_data=False, output_tag=None
+                 save_data=False, output_tag=None, engine='maf', index_dir=None,
+                 cache_dir=None, cache_max_gb=None, use_camera=True
                  ):
     """
     required inputs
@@ -58,6 +79,21 @@ def get_fonvtime(constraint, nside, time_points, opsim_path, outdir,
                        default: False
     * output_tag: str: tag to put in the output file; signifies combo of db,
                        constraint, etc. default: None
+    * engine: str: 'maf' to run the metric via MAF; 'numpy' to get the
+                   accumulated counts via get_pixel_counts instead.
+                   default: 'maf'
+    * index_dir: str: directory for the persistent visit to pixel indexes
+                      (numpy engine only); None to map the visits afresh.
+                      default: None
+    * cache_dir: str: directory for the result cache; results there are
+                      keyed by the database contents and all the inputs, so
+                      the output_tag files are not trusted when this is given.
+                      None to not use the cache. default: None
+    * cache_max_gb: float: max size of the result cache (GB); None for no
+                           limit. default: None
+    * use_camera: bool: set to False to count each visit over its whole
+                        field of view disc instead of the camera footprint
+                        (HealpixSlicer's use_camera). default: True
 
     returns
     -------
@@ -67,31 +103,624 @@ def get_fonvtime(constraint, nside, time_points, opsim_path, outdir,
     # ---------------------------------------------------------
     if save_data and output_tag is None:
         raise ValueError(f'## must specificy output_tag if save_data=True')
+    if engine not in ['maf', 'numpy']:
+        raise ValueError(f'## unknown engine: {engine}')
     
     # set up the output filename
-    fname = f'{outdir}/fonv_{output_tag}_nside{nside}.npz'
+    fname = f'{outdir}/fonv_{output_tag}_{_nside_tag(nside, use_camera)}.npz'
 
     # lets also make a subdir for maf outputs
     subdir = f'{outdir}/maf/'
     os.makedirs(subdir, exist_ok=True)
 
-    # look for the output file
-    if os.path.exists(fname):
+    # look for the result in the cache, or else the output file
+    if cache_dir is not None:
+        key = get_cache_key(cache_dir, [opsim_path], kind='fonv', version=FONV_VERSION,
+                            engine=engine, constraint=constraint, nside=nside,
+                            time_points=np.asarray(time_points), use_camera=use_camera)
+        fonv = cache_load(cache_dir, key)
+        if fonv is not None:
+            return fonv
+    elif os.path.exists(fname):
         print(f'## reading data from {fname} ...\n')
         return np.load(fname)['fnovtime']
+
+    if engine == 'numpy':
+        visits = _read_visits(opsim_path, constraint,
+                              cols=['rowid', 'fieldRA', 'fieldDec', 'rotSkyPos', 'night'])
+        indptr, pixels = _get_visit_pixels(opsim_path=opsim_path, visits=visits,
+                                           nside=nside, index_dir=index_dir,
+                                           use_camera=use_camera)
+        # (+ the total over all nights, for _maf_counts)
+        counts = get_pixel_counts(indptr=indptr, pixels=pixels, nights=visits['night'],
+                                  nside=nside, time_points=np.append(time_points, np.inf))
+        fonv = FONvTime().run({'metricdata': _maf_counts(counts[:, :-1], counts[:, -1])})
     else:
         # run the metric
-        slicer = maf.slicers.HealpixSlicer(nside=nside, use_cache=False)
+        slicer = maf.slicers.HealpixSlicer(nside=nside, use_cache=False, use_camera=use_camera)
         metric = maf.metrics.AccumulateCountMetric(bins=time_points, col='visitExposureTime')
         summary_metrics = [FONvTime()]
         
         bundle = maf.MetricBundle(metric, slicer, constraint, summary_metrics=summary_metrics)
-        bundle_grp = maf.MetricBundleGroup([bundle], opsim_path, out_dir=subdir)
-        bundle_grp.run_all()
+        db_con = _maf_db_con(opsim_path)
+        try:
+            bundle_grp = maf.MetricBundleGroup([bundle], db_con, out_dir=subdir)
+            bundle_grp.run_all()
+        finally:
+            _close_maf_db_con(db_con)
+        fonv = bundle.summary_values['FONvTime']
+
+    if save_data:
+        print(f'## saved data as {fname}\n')
+        np.savez_compressed(fname, fnovtime=fonv)
+    if cache_dir is not None:
+        cache_save(cache_dir, key, fonv, max_gb=cache_max_gb,
+                   desc={'opsim_path': opsim_path, 'constraint': constraint, 'nside': nside})
+
+    return fonv
+   
+
+###############################################################################
+def get_fonvtime_split(nside, time_points, opsim_path, outdir,
+                       base_constraint="scheduler_note not like '%DD%'",
+                       split_col='filter', split_vals='ugrizy',
+                       all_tag='allfilts', save_data=False, output_tag=None,
+                       engine='maf', save_counts=False, index_dir=None,
+                       index_parents=None, cache_dir=None, cache_max_gb=None,
+                       use_camera=True
+                       ):
+    """
+    get the fonv vector metric for the visits passing base_constraint as well
+    as for each of the subsets split_col == val for val in split_vals - all
+    from one read of the database and one slicing of the visits, instead of
+    one get_fonvtime call (i.e., one read + one slicing) per constraint.
+
+    required inputs
+    ---------------
+    * nside: int: healpix resolution parameter
+    * time_points: arr: time points at which to get fnov.
+    * opsim_path: str: path to the opsim database
+    * outdir: str: output directory
+
+    optional inputs
+    ---------------
+    * base_constraint: str: sql constraint for all visits.
+                            default: "scheduler_note not like '%DD%'"
+    * split_col: str: column to split the visits on. default: 'filter'
+    * split_vals: iterable: values of split_col to get the metric for.
+                            default: 'ugrizy'
+    * all_tag: str: key (and file tag) for the metric without the split.
+                    default: 'allfilts'
+    * save_data: bool: set to True to save the metric values.
+                       default: False
+    * output_tag: str: tag to put in the output files; signifies combo of db,
+                       etc; the split tags are appended to it. default: None
+    * engine: str: 'maf' to run the metric via MAF; 'numpy' to get the
+                   accumulated counts via get_pixel_counts instead.
+                   default: 'maf'
+    * save_counts: bool: set to True to also save the accumulated counts per
+                         pixel (numpy engine only); these are what
+                         get_fonvtime_chimera builds chimera curves from.
+                         default: False
+    * index_dir: str: directory for the persistent visit to pixel indexes
+                      (numpy engine only); None to map the visits afresh.
+                      default: None
+    * index_parents: list: parents to borrow index rows from; see
+                           get_pixel_index. default: None
+    * cache_dir: str: directory for the result cache; results there are
+                      keyed by the database contents and all the inputs, so
+                      the output_tag files are not trusted when this is given.
+                      None to not use the cache. default: None
+    * cache_max_gb: float: max size of the result cache (GB); None for no
+                           limit. default: None
+    * use_camera: bool: set to False to count each visit over its whole
+                        field of view disc instead of the camera footprint
+                        (HealpixSlicer's use_camera). default: True
+
+    returns
+    -------
+    * dict: fonv vector metric values, keyed by all_tag and by each of
+            split_vals
+
+    """
+    # ---------------------------------------------------------
+    if save_data and output_tag is None:
+        raise ValueError(f'## must specificy output_tag if save_data=True')
+    if engine not in ['maf', 'numpy']:
+        raise ValueError(f'## unknown engine: {engine}')
+    if save_counts and (output_tag is None or engine != 'numpy'):
+        raise ValueError(f'## save_counts needs output_tag and the numpy engine')
+
+    tags = [all_tag] + list(split_vals)
+    # set up the output filenames; same as get_fonvtime would for each tag
+    fnames = {tag: f'{outdir}/fonv_{output_tag}_{tag}_{_nside_tag(nside, use_camera)}.npz'
+              for tag in tags}
+
+    # lets also make a subdir for maf outputs
+    subdir = f'{outdir}/maf/'
+    os.makedirs(subdir, exist_ok=True)
+
+    # look for the results in the cache, or else the output files
+    if cache_dir is not None:
+        keys = {tag: get_cache_key(cache_dir, [opsim_path], kind='fonv',
+                                   version=FONV_VERSION, engine=engine,
+                                   constraint=_tag_constraint(base_constraint, split_col,
+                                                              tag, all_tag),
+                                   nside=nside, time_points=np.asarray(time_points),
+                                   use_camera=use_camera)
+                for tag in tags}
+        out = {tag: cache_load(cache_dir, keys[tag]) for tag in tags}
+        if all([out[tag] is not None for tag in tags]):
+            return out
+    elif all([os.path.exists(fnames[tag]) for tag in tags]):
+        print(f'## reading data from {fnames[all_tag]} etc ...\n')
+        return {tag: np.load(fnames[tag])['fnovtime'] for tag in tags}
+
+    if engine == 'numpy':
+        metric_values, totals = _split_counts_numpy(nside=nside, time_points=time_points,
+                                                    opsim_path=opsim_path,
+                                                    base_constraint=base_constraint,
+                                                    split_col=split_col,
+                                                    split_vals=split_vals,
+                                                    all_tag=all_tag, index_dir=index_dir,
+                                                    index_parents=index_parents,
+                                                    use_camera=use_camera)
+        if save_counts:
+            for tag in tags:
+                _save_counts(outdir=outdir, output_tag=output_tag, tag=tag, nside=nside,
+                             time_points=time_points, counts=metric_values[tag],
+                             use_camera=use_camera, cache_dir=cache_dir,
+                             opsim_path=opsim_path,
+                             constraint=_tag_constraint(base_constraint, split_col,
+                                                        tag, all_tag))
+        metric_values = {tag: _maf_counts(metric_values[tag], totals[tag]) for tag in tags}
+    else:
+        metric_values = _split_counts_maf(nside=nside, time_points=time_points,
+                                          opsim_path=opsim_path,
+                                          base_constraint=base_constraint,
+                                          split_col=split_col, split_vals=split_vals,
+                                          all_tag=all_tag, use_camera=use_camera)
 
+    # now the summary metric
+    summary_metric = FONvTime()
+    out = {}
+    for tag in tags:
+        out[tag] = summary_metric.run({'metricdata': metric_values[tag]})
         if save_data:
-            print(f'## saved data as {fname}\n')
-            np.savez_compressed(fname, fnovtime=bundle.summary_values['FONvTime'])
+            print(f'## saved data as {fnames[tag]}')
+            np.savez_compressed(fnames[tag], fnovtime=out[tag])
+        if cache_dir is not None:
+            cache_save(cache_dir, keys[tag], out[tag], max_gb=cache_max_gb,
+                       desc={'opsim_path': opsim_path, 'tag': tag, 'nside': nside})
+
+    return out
+
+###############################################################################
+def get_fonvtime_chimera(baseline_path, sim_to_cut_path, cutoff_mjd, nside,
+                         time_points, outdir, counts_dir, counts_tag,
+                         base_constraint="scheduler_note not like '%DD%'",
+                         split_col='filter', split_vals='ugrizy',
+                         all_tag='allfilts', save_data=False, output_tag=None,
+                         index_dir=None, cache_dir=None, cache_max_gb=None,
+                         use_camera=True
+                         ):
+    """
+    get the fonv vector metrics (as in get_fonvtime_split) for the chimera of
+    the sim at sim_to_cut_path (up to cutoff_mjd) and the baseline (after
+    cutoff_mjd) - without reading the chimera database. the accumulated
+    counts for the sim to cut are read from counts_dir (saved by
+    get_fonvtime_split with save_counts=True; computed + saved here if not
+    there), so only the baseline visits after the cutoff (and the cut sim's
+    visits within one time step before it) need to be read and mapped.
+
+    required inputs
+    ---------------
+    * baseline_path: str: path to the baseline database
+    * sim_to_cut_path: str: path to the database cut at the cutoff date
+    * cutoff_mjd: float: cutoff mjd; as in get_chimera
+    * nside: int: healpix resolution parameter
+    * time_points: arr: time points at which to get fnov.
+    * outdir: str: output directory
+    * counts_dir: str: directory with the accumulated counts for the sim to cut
+    * counts_tag: str: output_tag the counts for the sim to cut are saved with
+
+    optional inputs
+    ---------------
+    * base_constraint, split_col, split_vals, all_tag: as in get_fonvtime_split
+    * save_data: bool: set to True to save the metric values.
+                       default: False
+    * output_tag: str: tag to put in the output files. default: None
+    * index_dir: str: directory for the persistent visit to pixel indexes
+                      (numpy engine only); None to map the visits afresh.
+                      default: None
+    * cache_dir: str: directory for the result cache; results there are
+                      keyed by the database contents and all the inputs, so
+                      the output_tag files are not trusted when this is given.
+                      None to not use the cache. default: None
+    * cache_max_gb: float: max size of the result cache (GB); None for no
+                           limit. default: None
+    * use_camera: bool: set to False to count each visit over its whole
+                        field of view disc instead of the camera footprint
+                        (HealpixSlicer's use_camera). default: True
+
+    returns
+    -------
+    * dict: fonv vector metric values, keyed by all_tag and by each of
+            split_vals
+
+    """
+    # ---------------------------------------------------------
+    if save_data and output_tag is None:
+        raise ValueError(f'## must specificy output_tag if save_data=True')
+
+    tags = [all_tag] + list(split_vals)
+    fnames = {tag: f'{outdir}/fonv_{output_tag}_{tag}_{_nside_tag(nside, use_camera)}.npz'
+              for tag in tags}
+    constraints = {tag: _tag_constraint(base_constraint, split_col, tag, all_tag)
+                   for tag in tags}
+    # look for the results in the cache, or else the output files
+    if cache_dir is not None:
+        keys = {tag: get_cache_key(cache_dir, [sim_to_cut_path, baseline_path],
+                                   kind='fonv_chimera', version=FONV_VERSION,
+                                   cutoff_mjd=cutoff_mjd, constraint=constraints[tag],
+                                   nside=nside, time_points=np.asarray(time_points),
+                                   use_camera=use_camera)
+                for tag in tags}
+        out = {tag: cache_load(cache_dir, keys[tag]) for tag in tags}
+        if all([out[tag] is not None for tag in tags]):
+            return out
+    elif all([os.path.exists(fnames[tag]) for tag in tags]):
+        print(f'## reading data from {fnames[all_tag]} etc ...\n')
+        return {tag: np.load(fnames[tag])['fnovtime'] for tag in tags}
+
+    metric_values, totals = _chimera_counts(baseline_path=baseline_path,
+                                            sim_to_cut_path=sim_to_cut_path,
+                                            cutoff_mjd=cutoff_mjd, nside=nside,
+                                            time_points=time_points, counts_dir=counts_dir,
+                                            counts_tag=counts_tag,
+                                            base_constraint=base_constraint,
+                                            split_col=split_col, split_vals=split_vals,
+                                            all_tag=all_tag, index_dir=index_dir,
+                                            cache_dir=cache_dir, use_camera=use_camera)
+
+    # now the summary metric
+    summary_metric = FONvTime()
+    out = {}
+    for tag in tags:
+        out[tag] = summary_metric.run({'metricdata': _maf_counts(metric_values[tag],
+                                                                 totals[tag])})
+        if save_data:
+            print(f'## saved data as {fnames[tag]}')
+            np.savez_compressed(fnames[tag], fnovtime=out[tag])
+        if cache_dir is not None:
+            cache_save(cache_dir, keys[tag], out[tag], max_gb=cache_max_gb,
+                       desc={'opsim_path': sim_to_cut_path, 'baseline_path': baseline_path,
+                             'cutoff_mjd': cutoff_mjd, 'tag': tag, 'nside': nside})
+
+    return out
+
+###############################################################################
+def _chimera_counts(baseline_path, sim_to_cut_path, cutoff_mjd, nside, time_points,
+                    counts_dir, counts_tag, base_constraint, split_col, split_vals,
+                    all_tag, index_dir=None, cache_dir=None, use_camera=True):
+    """
+    accumulated counts per pixel for get_fonvtime_chimera: those saved for the
+    sim to cut, upto where they are exact, + those from the visits read here.
+    returns the same as _split_counts_numpy on the chimera database.
+    """
+    tags = [all_tag] + list(split_vals)
+    constraints = {tag: _tag_constraint(base_constraint, split_col, tag, all_tag)
+                   for tag in tags}
+    # accumulated counts for the sim to cut, over the whole survey
+    cut_counts = {tag: _load_counts(outdir=counts_dir, output_tag=counts_tag, tag=tag,
+                                    nside=nside, time_points=time_points,
+                                    use_camera=use_camera, cache_dir=cache_dir,
+                                    opsim_path=sim_to_cut_path,
+                                    constraint=constraints[tag])
+                  for tag in tags}
+    if any([cut_counts[tag] is None for tag in tags]):
+        print(f'## no saved counts for {counts_tag}; getting them ...')
+        cut_counts, _ = _split_counts_numpy(nside=nside, time_points=time_points,
+                                            opsim_path=sim_to_cut_path,
+                                            base_constraint=base_constraint,
+                                            split_col=split_col, split_vals=split_vals,
+                                            all_tag=all_tag, index_dir=index_dir,
+                                            use_camera=use_camera)
+        os.makedirs(counts_dir, exist_ok=True)
+        for tag in tags:
+            _save_counts(outdir=counts_dir, output_tag=counts_tag, tag=tag, nside=nside,
+                         time_points=time_points, counts=cut_counts[tag],
+                         use_camera=use_camera, cache_dir=cache_dir,
+                         opsim_path=sim_to_cut_path,
+                         constraint=constraints[tag])
+
+    # the saved counts are exact for the sim to cut up to the first time point
+    # at/after the first night with visits past the cutoff
+    conn = connect_opsim(sim_to_cut_path)
+    first_night_after = conn.execute(
+        f"select min(night) from observations where observationStartMJD > {cutoff_mjd}"
+        ).fetchone()[0]
+    conn.close()
+    edges = np.asarray(time_points)[1:]
+    if first_night_after is None:
+        n_cols_exact = edges.size
+    else:
+        n_cols_exact = int(np.searchsorted(edges, first_night_after, side='left'))
+
+    # visits we need to map: the cut sim's visits between the last exact time
+    # point and the cutoff, and the baseline's visits after the cutoff
+    and_constraint = '' if base_constraint in [None, ''] else f' and ({base_constraint})'
+    pre_constraint = f'observationStartMJD <= {cutoff_mjd}'
+    if n_cols_exact > 0:
+        pre_constraint += f' and night > {edges[n_cols_exact - 1]}'
+    cols = ['rowid', 'fieldRA', 'fieldDec', 'rotSkyPos', 'night', split_col]
+    pre = _read_visits(sim_to_cut_path, pre_constraint + and_constraint, cols=cols)
+    post = _read_visits(baseline_path,
+                        f'observationStartMJD > {cutoff_mjd}' + and_constraint, cols=cols)
+    # (skipping empty reads, which dont have the column dtypes)
+    visits = {col: np.concatenate([part[col] for part in [pre, post] if part[col].size > 0]
+                                  or [pre[col]])
+              for col in cols}
+    # map each from its own database's index
+    pre_indptr, pre_pixels = _get_visit_pixels(opsim_path=sim_to_cut_path, visits=pre,
+                                               nside=nside, index_dir=index_dir,
+                                               use_camera=use_camera)
+    post_indptr, post_pixels = _get_visit_pixels(opsim_path=baseline_path, visits=post,
+                                                 nside=nside, index_dir=index_dir,
+                                                 use_camera=use_camera)
+    indptr = np.concatenate([pre_indptr, post_indptr[1:] + pre_indptr[-1]])
+    pixels = np.concatenate([pre_pixels, post_pixels])
 
-        return bundle.summary_values['FONvTime']
-   
\ No newline at end of file
+    # now put things together
+    metric_values, totals = {}, {}
+    for tag in tags:
+        mask = None if tag == all_tag else visits[split_col] == tag
+        # the last column is the total over all nights
+        counts = get_pixel_counts(indptr=indptr, pixels=pixels, nights=visits['night'],
+                                  nside=nside, time_points=np.append(time_points, np.inf),
+                                  visit_mask=mask)
+        if n_cols_exact > 0:
+            counts[:, :n_cols_exact] += cut_counts[tag][:, :n_cols_exact]
+            counts[:, n_cols_exact:] += cut_counts[tag][:, [n_cols_exact - 1]]
+        metric_values[tag], totals[tag] = counts[:, :-1], counts[:, -1]
+
+    return metric_values, totals
+
+###############################################################################
+def _nside_tag(nside, use_camera):
+    return f'nside{nside}' if use_camera else f'disc_nside{nside}'
+
+def _counts_fname(outdir, output_tag, tag, nside, use_camera):
+    return f'{outdir}/fonvcounts_{output_tag}_{tag}_{_nside_tag(nside, use_camera)}.npz'
+
+def _counts_cache_key(cache_dir, opsim_path, constraint, nside, time_points, use_camera):
+    return get_cache_key(cache_dir, [opsim_path], kind='counts', version=FONV_VERSION,
+                         constraint=constraint, nside=nside,
+                         time_points=np.asarray(time_points), use_camera=use_camera)
+
+def _save_counts(outdir, output_tag, tag, nside, time_points, counts, use_camera=True,
+                 cache_dir=None, opsim_path=None, constraint=None):
+    """
+    save accumulated counts per pixel, alongside the time points they are for;
+    also to the result cache if cache_dir is given.
+    """
+    fname = _counts_fname(outdir, output_tag, tag, nside, use_camera)
+    np.savez(fname, counts=counts.astype(np.int32), time_points=time_points)
+    print(f'## saved counts as {fname}')
+    if cache_dir is not None:
+        cache_save(cache_dir,
+                   _counts_cache_key(cache_dir, opsim_path, constraint, nside, time_points,
+                                     use_camera),
+                   counts.astype(np.int32),
+                   desc={'opsim_path': opsim_path, 'tag': tag, 'nside': nside})
+
+def _load_counts(outdir, output_tag, tag, nside, time_points, use_camera=True,
+                 cache_dir=None, opsim_path=None, constraint=None):
+    """
+    load accumulated counts saved by _save_counts; None if there arent any for
+    these time points. only the result cache is trusted if cache_dir is given.
+    """
+    if cache_dir is not None:
+        counts = cache_load(cache_dir,
+                            _counts_cache_key(cache_dir, opsim_path, constraint, nside,
+                                              time_points, use_camera))
+        return None if counts is None else counts.astype(np.int64)
+    fname = _counts_fname(outdir, output_tag, tag, nside, use_camera)
+    if not os.path.exists(fname):
+        return None
+    data = np.load(fname)
+    if not np.array_equal(data['time_points'], time_points):
+        return None
+    return data['counts'].astype(np.int64)
+
+###############################################################################
+def _maf_db_con(opsim_path):
+    """
+    what to give MAF to read a database: the path for a regular database; a
+    connection with the observations view for a virtual one.
+    """
+    if get_virtual_sources(opsim_path) is None:
+        return opsim_path
+    return connect_opsim(opsim_path)
+
+def _close_maf_db_con(db_con):
+    """
+    close what _maf_db_con gave, if it is a connection.
+    """
+    if not isinstance(db_con, str):
+        db_con.close()
+
+###############################################################################
+def _tag_constraint(base_constraint, split_col, tag, all_tag):
+    """
+    the full sql constraint for a get_fonvtime_split tag.
+    """
+    if tag == all_tag:
+        return base_constraint
+    return f"{base_constraint} and {split_col}='{tag}'"
+
+###############################################################################
+def _split_counts_maf(nside, time_points, opsim_path, base_constraint,
+                      split_col, split_vals, all_tag, use_camera=True):
+    """
+    accumulated counts per pixel for get_fonvtime_split, via the MAF slicer
+    and metric, as MetricBundle gives them to FONvTime: with the metric's
+    badval (masked in a bundle) replaced by FONvTime's mask_val.
+    returns dict with (npix, len(time_points) - 1) arrays.
+    """
+    # set up the metric + slicer
+    slicer = maf.slicers.HealpixSlicer(nside=nside, use_cache=False, use_camera=use_camera)
+    metric = maf.metrics.AccumulateCountMetric(bins=time_points, col='visitExposureTime')
+    # read in the visits - once
+    cols = list(set(list(metric.col_name_arr) + list(slicer.columns_needed) + [split_col]))
+    db_con = _maf_db_con(opsim_path)
+    try:
+        sim_data = maf.get_sim_data(db_con, base_constraint, cols)
+    finally:
+        _close_maf_db_con(db_con)
+    # slice them - once
+    slicer.setup_slicer(sim_data)
+    # masks for each of the subsets
+    masks = {all_tag: np.ones(len(sim_data), dtype=bool)}
+    for val in split_vals:
+        masks[val] = sim_data[split_col] == val
+
+    # now run the metric for each pixel and each subset
+    tags = [all_tag] + list(split_vals)
+    metric_values = {tag: np.zeros((slicer.nslice, len(time_points) - 1)) for tag in tags}
+    for i, slice_i in enumerate(slicer):
+        idxs = np.asarray(slice_i['idxs'], dtype=int)
+        if idxs.size == 0:
+            continue
+        for tag in tags:
+            sub_idxs = idxs[masks[tag][idxs]]
+            if sub_idxs.size == 0:
+                continue
+            values = metric.run(sim_data[sub_idxs], slice_point=slice_i['slice_point'])
+            metric_values[tag][i] = np.where(values == metric.badval, FONvTime().mask_val,
+                                             values)
+
+    return metric_values
+
+###############################################################################
+def _split_counts_numpy(nside, time_points, opsim_path, base_constraint,
+                        split_col, split_vals, all_tag, index_dir=None,
+                        index_parents=None, use_camera=True):
+    """
+    accumulated counts per pixel for get_fonvtime_split, via get_visit_pixels
+    and get_pixel_counts. returns dict with (npix, len(time_points) - 1) arrays
+    and dict with the (npix) total counts over all nights; see _maf_counts.
+    """
+    visits = _read_visits(opsim_path, base_constraint,
+                          cols=['rowid', 'fieldRA', 'fieldDec', 'rotSkyPos', 'night',
+                                split_col])
+    # map visits to pixels - once
+    indptr, pixels = _get_visit_pixels(opsim_path=opsim_path, visits=visits, nside=nside,
+                                       index_dir=index_dir, index_parents=index_parents,
+                                       use_camera=use_camera)
+    metric_values, totals = {}, {}
+    masks = {all_tag: None}
+    for val in split_vals:
+        masks[val] = visits[split_col] == val
+    for tag in masks:
+        # the last column is the total over all nights
+        counts = get_pixel_counts(indptr=indptr, pixels=pixels, nights=visits['night'],
+                                  nside=nside, time_points=np.append(time_points, np.inf),
+                                  visit_mask=masks[tag])
+        metric_values[tag], totals[tag] = counts[:, :-1], counts[:, -1]
+    return metric_values, totals
+
+###############################################################################
+def _read_visits(opsim_path, constraint, cols):
+    """
+    read the specified columns for the visits passing the sql constraint, in
+    the order they are in the database. returns dict of arrays.
+    """
+    query = f"select {', '.join(cols)} from observations"
+    if constraint is not None and constraint != '':
+        query += f" where {constraint}"
+    conn = connect_opsim(opsim_path)
+    rows = conn.execute(query).fetchall()
+    conn.close()
+    if len(rows) == 0:
+        return {col: np.array([]) for col in cols}
+    return {col: np.array(vals) for col, vals in zip(cols, zip(*rows))}
+
+###############################################################################
+def _get_visit_pixels(opsim_path, visits, nside, index_dir=None, index_parents=None,
+                      use_camera=True):
+    """
+    visit to pixel mapping for visits from _read_visits (with rowid); taken
+    from the database's persistent index if index_dir is given.
+    """
+    if index_dir is None:
+        return get_visit_pixels(ra=visits['fieldRA'], dec=visits['fieldDec'], nside=nside,
+                                rot_sky_pos=visits['rotSkyPos'] if use_camera else None)
+    index = get_pixel_index(opsim_path, nside=nside, index_dir=index_dir,
+                            use_camera=use_camera, parents=index_parents)
+    return select_index_rows(index, visits['rowid'])
+
+###############################################################################
+def get_pixel_counts(indptr, pixels, nights, nside, time_points, visit_mask=None):
+    """
+    get the accumulated number of visits in each pixel at each time point:
+    column j has the number of visits with night <= time_points[j + 1]. (see
+    _maf_counts for what AccumulateCountMetric gives on a HealpixSlicer.)
+
+    required inputs
+    ---------------
+    * indptr, pixels: arr: visit to pixel mapping from get_visit_pixels
+    * nights: arr: night for each visit
+    * nside: int: healpix resolution parameter
+    * time_points: arr: time points (nights) at which to get the counts.
+
+    optional inputs
+    ---------------
+    * visit_mask: arr: bool mask for the visits to count; None to count all.
+                       default: None
+
+    returns
+    -------
+    * array: (npix, len(time_points) - 1) accumulated counts
+
+    """
+    # ---------------------------------------------------------
+    npix = hp.nside2npix(nside)
+    nbins = len(time_points) - 1
+    # first time bin each visit contributes to
+    visit_bin = np.searchsorted(np.asarray(time_points)[1:], nights, side='left')
+    keep = visit_bin < nbins
+    if visit_mask is not None:
+        keep &= visit_mask
+    # now expand to one entry per (visit, pixel)
+    n_pix_per_visit = np.diff(indptr)
+    keep = np.repeat(keep, n_pix_per_visit)
+    flat = pixels[keep] * nbins + np.repeat(visit_bin, n_pix_per_visit)[keep]
+    # count the visits per pixel per time bin + accumulate
+    counts = np.bincount(flat, minlength=npix * nbins).reshape(npix, nbins)
+    return np.cumsum(counts, axis=1)
+
+###############################################################################
+def _maf_counts(counts, totals):
+    """
+    accumulated counts from get_pixel_counts as AccumulateCountMetric gives
+    them (with its badval as FONvTime's mask_val), so that the fonv curves
+    from the numpy engine are the same as from MAF. for k of a pixel's n
+    visits by a time point, the metric gives min(k + 1, n) - and badval for
+    k = 0 or n = 1 - since it indexes its running count with k, clipped to
+    n - 1, rather than k - 1.
+
+    required inputs
+    ---------------
+    * counts: arr: (npix, ntimes) accumulated counts
+    * totals: arr: (npix) number of visits in each pixel over all nights
+
+    returns
+    -------
+    * array: (npix, ntimes) counts
+
+    """
+    # ---------------------------------------------------------
+    totals = np.asarray(totals)[:, np.newaxis]
+    return np.where((counts == 0) | (totals == 1), FONvTime().mask_val,
+                    np.minimum(counts + 1, totals))
@@ -0,0 +1,286 @@
+import healpy as hp
+import numpy as np
+import hashlib
+import fcntl
+import json
+import os
+from rubin_scheduler.utils import LsstCameraFootprint
+from opsim_db import get_virtual_sources, connect_opsim
+
+__all__ = ['FOV_RADIUS', 'get_visit_pixels', 'get_db_hash', 'get_pixel_index',
+           'select_index_rows']
+
+# radius (deg) used to map visits to healpix pixels; the HealpixSlicer default
+FOV_RADIUS = 2.45
+
+###############################################################################
+def get_visit_pixels(ra, dec, nside, radius=FOV_RADIUS, rot_sky_pos=None):
+    """
+    map each visit to the healpix pixels (ring ordering) whose centers are
+    within radius of the pointing and, if rot_sky_pos is given, inside the
+    rotated camera footprint - i.e., the pixels a HealpixSlicer (with its
+    default use_camera=True) would assign the visit to.
+
+    required inputs
+    ---------------
+    * ra: arr: pointing ra (degrees)
+    * dec: arr: pointing dec (degrees)
+    * nside: int: healpix resolution parameter
+
+    optional inputs
+    ---------------
+    * radius: float: radius of the field of view (degrees).
+                     default: FOV_RADIUS
+    * rot_sky_pos: arr: rotSkyPos (degrees) of each visit, to clip the disc
+                        to the camera footprint with; None to keep the whole
+                        disc (as a HealpixSlicer with use_camera=False).
+                        default: None
+
+    returns
+    -------
+    * indptr: arr: CSR row pointers; visit i covers pixels[indptr[i]:indptr[i+1]]
+    * pixels: arr: pixel ids for all the visits
+
+    """
+    # ---------------------------------------------------------
+    ra = np.asarray(ra, dtype=float)
+    dec = np.asarray(dec, dtype=float)
+    vecs = hp.ang2vec(ra, dec, lonlat=True).reshape(-1, 3)
+    pixels = [hp.query_disc(nside, vec, np.radians(radius)) for vec in vecs]
+    indptr = np.zeros(len(pixels) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(pix) for pix in pixels])
+    if len(pixels) == 0:
+        return indptr, np.array([], dtype=np.int64)
+    pixels = np.concatenate(pixels).astype(np.int64)
+    if rot_sky_pos is None:
+        return indptr, pixels
+
+    # now keep only the (visit, pixel) pairs with the pixel center in the
+    # camera footprint; the footprint test is elementwise, so all the pairs
+    # go in at once
+    n_pix_per_visit = np.diff(indptr)
+    pix_ra, pix_dec = hp.pix2ang(nside, pixels, lonlat=True)
+    camera = LsstCameraFootprint(units='degrees')
+    in_camera = np.zeros(pixels.size, dtype=bool)
+    in_camera[camera(pix_ra, pix_dec,
+                     np.repeat(ra, n_pix_per_visit), np.repeat(dec, n_pix_per_visit),
+                     np.repeat(np.asarray(rot_sky_pos, dtype=float), n_pix_per_visit))] = True
+    visit = np.repeat(np.arange(n_pix_per_visit.size), n_pix_per_visit)
+    indptr[1:] = np.cumsum(np.bincount(visit[in_camera], minlength=n_pix_per_visit.size))
+    return indptr, pixels[in_camera]
+
+###############################################################################
+def get_db_hash(opsim_path, hash_dir, block_size=2**24):
+    """
+    sha1 of the contents of the database at opsim_path. hashes are remembered
+    in hash_dir/db_hashes.json against the file's size and mtime, so a file is
+    only re-read if it has changed. for a virtual database, the hash also
+    covers the contents of its sources.
+
+    required inputs
+    ---------------
+    * opsim_path: str: path to the opsim database
+    * hash_dir: str: directory to remember the hashes in
+
+    optional inputs
+    ---------------
+    * block_size: int: number of bytes to read at a time. default: 2**24
+
+    returns
+    -------
+    * str: hex digest
+
+    """
+    # ---------------------------------------------------------
+    key = os.path.abspath(opsim_path)
+    stat = os.stat(opsim_path)
+    with _locked_hashes(hash_dir) as hashes:
+        entry = hashes.get(key)
+    if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+        # hash outside the lock, so that other runs can go on meanwhile
+        sha1 = hashlib.sha1()
+        with open(opsim_path, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                sha1.update(block)
+        entry = {'size': stat.st_size, 'mtime': stat.st_mtime, 'hash': sha1.hexdigest()}
+        # re-read under the lock so that entries added by others are kept
+        with _locked_hashes(hash_dir) as hashes:
+            hashes[key] = entry
+
+    sources = get_virtual_sources(opsim_path)
+    if sources is None:
+        return entry['hash']
+    sha1 = hashlib.sha1(entry['hash'].encode())
+    for source in sources:
+        sha1.update(get_db_hash(source['path'], hash_dir=hash_dir).encode())
+    return sha1.hexdigest()
+
+###############################################################################
+def get_pixel_index(opsim_path, nside, index_dir, radius=FOV_RADIUS, use_camera=True,
+                    parents=None):
+    """
+    get the visit to pixel mapping (as from get_visit_pixels) for all the
+    visits in the database, from a persistent index in index_dir keyed by the
+    database contents, nside and footprint. the index is built (and
+    saved) if it doesnt exist already; saved indexes are memory-mapped.
+
+    required inputs
+    ---------------
+    * opsim_path: str: path to the opsim database
+    * nside: int: healpix resolution parameter
+    * index_dir: str: directory for the indexes
+
+    optional inputs
+    ---------------
+    * radius: float: radius of the field of view (degrees).
+                     default: FOV_RADIUS
+    * use_camera: bool: set to False to keep the whole disc for each visit
+                        instead of clipping it to the camera footprint; see
+                        get_visit_pixels. default: True
+    * parents: list: list of (parent_path, sql constraint) for databases
+                     whose rows (passing the constraint, in order) make up
+                     the first rows of this database - e.g. the weather sim
+                     and the baseline for a chimera sim. rows are borrowed
+                     from the parents' indexes; only the rest are mapped.
+                     the sources of a virtual database are used if None.
+                     default: None
+
+    returns
+    -------
+    * dict: with rowids (sorted), indptr, pixels arrays
+
+    """
+    # ---------------------------------------------------------
+    os.makedirs(index_dir, exist_ok=True)
+    db_hash = get_db_hash(opsim_path, hash_dir=index_dir)
+    froot = f'{index_dir}/pixidx_{db_hash}_nside{nside}_disc{radius}'
+    if use_camera:
+        froot += '_camera'
+    keys = ['rowids', 'indptr', 'pixels']
+
+    # look for the index
+    if all([os.path.exists(f'{froot}_{key}.npy') for key in keys]):
+        return {key: np.load(f'{froot}_{key}.npy', mmap_mode='r') for key in keys}
+
+    if parents is None:
+        sources = get_virtual_sources(opsim_path)
+        if sources is not None:
+            parents = [(source['path'], source['constraint']) for source in sources]
+
+    # read the positions for all the visits
+    conn = connect_opsim(opsim_path)
+    rows = conn.execute('select rowid, fieldRA, fieldDec, rotSkyPos from observations ' +
+                        'order by rowid').fetchall()
+    conn.close()
+    rowids, ra, dec, rot = [np.array(vals) for vals in zip(*rows)] if len(rows) > 0 else \
+                                                    [np.array([]) for i in range(4)]
+    rowids = rowids.astype(np.int64)
+
+    # borrow what we can from the parents
+    borrowed_indptr, borrowed_pixels = [np.zeros(1, dtype=np.int64)], []
+    n_borrowed = 0
+    for parent_path, parent_constraint in ([] if parents is None else parents):
+        parent_index = get_pixel_index(parent_path, nside=nside, index_dir=index_dir,
+                                       radius=radius, use_camera=use_camera)
+        conn = connect_opsim(parent_path)
+        parent_rows = conn.execute(f'select rowid, fieldRA, fieldDec, rotSkyPos ' +
+                                   f'from observations where {parent_constraint} ' +
+                                   'order by rowid').fetchall()
+        conn.close()
+        if len(parent_rows) == 0:
+            continue
+        parent_rowids, parent_ra, parent_dec, parent_rot = [np.array(vals)
+                                                            for vals in zip(*parent_rows)]
+        n_rows = len(parent_rowids)
+        # make sure these really are the next rows in this database
+        if n_borrowed + n_rows > len(rowids) or \
+            not np.allclose(ra[n_borrowed:n_borrowed + n_rows], parent_ra) or \
+            not np.allclose(dec[n_borrowed:n_borrowed + n_rows], parent_dec) or \
+            (use_camera and not np.allclose(rot[n_borrowed:n_borrowed + n_rows], parent_rot)):
+            print(f'## rows from {parent_path} dont match {opsim_path}; not borrowing more.')
+            break
+        indptr, pixels = select_index_rows(parent_index, parent_rowids)
+        borrowed_indptr.append(indptr[1:] + borrowed_indptr[-1][-1])
+        borrowed_pixels.append(pixels)
+        n_borrowed += n_rows
+    if n_borrowed > 0:
+        print(f'## borrowed {n_borrowed} of {len(rowids)} rows from the parent indexes.')
+
+    # map the rest
+    indptr, pixels = get_visit_pixels(ra=ra[n_borrowed:], dec=dec[n_borrowed:],
+                                      nside=nside, radius=radius,
+                                      rot_sky_pos=rot[n_borrowed:] if use_camera else None)
+    index = {'rowids': rowids,
+             'indptr': np.concatenate(borrowed_indptr + [indptr[1:] + borrowed_indptr[-1][-1]]),
+             'pixels': np.concatenate(borrowed_pixels + [pixels]).astype(np.int64)
+             }
+    # now save; temp names first so that a concurrent reader never sees
+    # a partial index
+    for key in keys:
+        np.save(f'{froot}_{key}.{os.getpid()}.npy', index[key])
+    for key in keys:
+        os.replace(f'{froot}_{key}.{os.getpid()}.npy', f'{froot}_{key}.npy')
+    print(f'## saved pixel index as {froot}_*.npy')
+
+    return {key: np.load(f'{froot}_{key}.npy', mmap_mode='r') for key in keys}
+
+###############################################################################
+def select_index_rows(index, rowids):
+    """
+    get the visit to pixel mapping for a subset of the visits in an index
+    from get_pixel_index.
+
+    required inputs
+    ---------------
+    * index: dict: index from get_pixel_index
+    * rowids: arr: rowids of the visits to select; any order.
+
+    returns
+    -------
+    * indptr: arr: CSR row pointers, for the visits in the order of rowids
+    * pixels: arr: pixel ids for all the visits
+
+    """
+    # ---------------------------------------------------------
+    rows = np.searchsorted(index['rowids'], np.asarray(rowids, dtype=np.int64))
+    if np.any(rows >= len(index['rowids'])) or \
+                            np.any(index['rowids'][np.minimum(rows, len(index['rowids']) - 1)] != rowids):
+        raise ValueError('## some rowids are not in the index.')
+    starts = np.asarray(index['indptr'][rows])
+    n_pix_per_visit = np.asarray(index['indptr'][rows + 1]) - starts
+    indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(n_pix_per_visit)
+    # position of each selected entry in the index pixels array
+    positions = np.repeat(starts - indptr[:-1], n_pix_per_visit) + np.arange(indptr[-1])
+    return indptr, np.asarray(index['pixels'][positions])
+
+###############################################################################
+class _locked_hashes:
+    """
+    context manager for the remembered database hashes (a dict), holding a
+    lock on them so that concurrent runs dont clobber each others entries;
+    as result_cache._locked_manifest. the file is only rewritten if the dict
+    was changed.
+    """
+    def __init__(self, hash_dir):
+        os.makedirs(hash_dir, exist_ok=True)
+        self.fname = f'{hash_dir}/db_hashes.json'
+        self.lock_fname = f'{hash_dir}/db_hashes.lock'
+
+    def __enter__(self):
+        self.lock = open(self.lock_fname, 'w')
+        fcntl.flock(self.lock, fcntl.LOCK_EX)
+        self.hashes = {}
+        if os.path.exists(self.fname):
+            with open(self.fname, 'r') as f:
+                self.hashes = json.load(f)
+        self.hashes_in = json.dumps(self.hashes, sort_keys=True)
+        return self.hashes
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None and json.dumps(self.hashes, sort_keys=True) != self.hashes_in:
+            with open(f'{self.fname}.tmp', 'w') as f:
+                json.dump(self.hashes, f, indent=1)
+            os.replace(f'{self.fname}.tmp', self.fname)
+        fcntl.flock(self.lock, fcntl.LOCK_UN)
+        self.lock.close()
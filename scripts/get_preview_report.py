@@ -0,0 +1,139 @@
+import numpy as np
+import pickle
+from get_fonvtime import get_fonvtime_split
+from opsim_db import connect_opsim
+from run_pool import run_pool
+
+__all__ = ['get_nvisits_time', 'get_preview_report']
+
+###############################################################################
+def get_nvisits_time(opsim_path, time_points, constraint="scheduler_note not like '%DD%'"):
+    """
+    number of visits passing constraint upto each time point, binned on night
+    the same way as the counts for the vector metric.
+
+    required inputs
+    ---------------
+    * opsim_path: str: path to the opsim database
+    * time_points: arr: time points (nights) at which to get the counts.
+
+    optional inputs
+    ---------------
+    * constraint: str: sql constraint for the visits.
+                       default: "scheduler_note not like '%DD%'"
+
+    returns
+    -------
+    * arr: accumulated number of visits; len(time_points) - 1 values
+
+    """
+    # ---------------------------------------------------------
+    where = '' if constraint in [None, ''] else f' where {constraint}'
+    conn = connect_opsim(opsim_path)
+    nights = np.array([row[0] for row in conn.execute(f'select night from observations{where}')],
+                      dtype=float)
+    conn.close()
+    # as in get_pixel_counts: column j has the visits with night <= time_points[j + 1]
+    nbins = len(time_points) - 1
+    visit_bin = np.searchsorted(np.asarray(time_points)[1:], nights, side='left')
+    counts = np.bincount(visit_bin[visit_bin < nbins], minlength=nbins)
+    return np.cumsum(counts)
+
+###############################################################################
+def get_preview_report(pairs, nside, time_points, outdir, report_tag,
+                       base_constraint="scheduler_note not like '%DD%'",
+                       engine='maf', index_dir=None, cache_dir=None,
+                       cache_max_gb=None, workers=1, mem_per_worker_gb=None):
+    """
+    calibration report for preview (reduced nside) sims: the fonv vector
+    metric and the number of visits as a function of time for each preview
+    sim, against those for the full resolution sim with the same inputs.
+
+    required inputs
+    ---------------
+    * pairs: dict: db_tag: (path to the full sim, path to the preview sim)
+    * nside: int: healpix resolution parameter for the metric (the same for
+                  both sims)
+    * time_points: arr: time points at which to get the curves.
+    * outdir: str: output directory; the curves + summary are saved there
+    * report_tag: str: tag to put in the output files
+
+    optional inputs
+    ---------------
+    * base_constraint: str: sql constraint for all visits.
+                            default: "scheduler_note not like '%DD%'"
+    * engine: str: engine for the fonv metric; see get_fonvtime_split.
+                   default: 'maf'
+    * index_dir: str: directory for the visit to pixel indexes (numpy engine
+                      only). default: None
+    * cache_dir: str: directory for the result cache. default: None
+    * cache_max_gb: float: max size of the result cache (GB). default: None
+    * workers: int: number of processes to get the metrics with. default: 1
+    * mem_per_worker_gb: float: memory limit for each worker (GB).
+                                default: None
+
+    returns
+    -------
+    * dict: db_tag: {curve: {'max_abs_diff', 'max_rel_diff', 'mean_rel_diff'}}
+            for the fonv curves (all filters + each filter) and 'nvisits'
+
+    """
+    # ---------------------------------------------------------
+    jobs, keys = [], []
+    for db_tag in sorted(pairs):
+        for kind, opsim_path in zip(['full', 'preview'], pairs[db_tag]):
+            jobs.append((get_fonvtime_split, dict(nside=nside, time_points=time_points,
+                                                  opsim_path=opsim_path, outdir=outdir,
+                                                  base_constraint=base_constraint,
+                                                  engine=engine, index_dir=index_dir,
+                                                  cache_dir=cache_dir,
+                                                  cache_max_gb=cache_max_gb)))
+            keys.append((db_tag, kind))
+    curves = {db_tag: {} for db_tag in pairs}
+    for (db_tag, kind), fonvs in zip(keys, run_pool(jobs, workers=workers,
+                                                     mem_per_worker_gb=mem_per_worker_gb)):
+        curves[db_tag][kind] = dict(fonvs)
+        opsim_path = pairs[db_tag][0 if kind == 'full' else 1]
+        curves[db_tag][kind]['nvisits'] = get_nvisits_time(opsim_path, time_points=time_points,
+                                                           constraint=base_constraint)
+
+    # now compare
+    summary = {}
+    for db_tag in sorted(pairs):
+        summary[db_tag] = {}
+        for curve in curves[db_tag]['full']:
+            full = np.asarray(curves[db_tag]['full'][curve], dtype=float)
+            preview = np.asarray(curves[db_tag]['preview'][curve], dtype=float)
+            diff = np.abs(preview - full)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                rel_diff = np.where(full > 0, diff / full, np.nan)
+            summary[db_tag][curve] = {'max_abs_diff': _nanstat(np.nanmax, diff),
+                                      'max_rel_diff': _nanstat(np.nanmax, rel_diff),
+                                      'mean_rel_diff': _nanstat(np.nanmean, rel_diff)}
+
+    # save + print
+    fname = f'{outdir}/preview_report_{report_tag}.pickle'
+    with open(fname, 'wb') as f:
+        pickle.dump({'time_points': np.asarray(time_points), 'pairs': pairs,
+                     'curves': curves, 'summary': summary}, f)
+    lines = [f'{"db_tag":40s} {"curve":10s} {"max_abs_diff":>14s} ' +
+             f'{"max_rel_diff":>14s} {"mean_rel_diff":>14s}']
+    for db_tag in sorted(summary):
+        for curve, stats in summary[db_tag].items():
+            lines.append(f'{db_tag:40s} {curve:10s} {stats["max_abs_diff"]:14.4g} ' +
+                         f'{stats["max_rel_diff"]:14.4g} {stats["mean_rel_diff"]:14.4g}')
+    with open(fname.replace('.pickle', '.txt'), 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    print('\n'.join(lines))
+    print(f'## preview report saved in {fname} (+ .txt)')
+
+    return summary
+
+###############################################################################
+def _nanstat(func, vals):
+    """
+    func(vals), or nan if vals are all nan.
+    """
+    if np.all(np.isnan(vals)):
+        return np.nan
+    return func(vals)
@@ -0,0 +1,54 @@
+import sqlite3
+
+__all__ = ['get_virtual_sources', 'connect_opsim']
+
+###############################################################################
+def get_virtual_sources(opsim_path):
+    """
+    get the sources of a virtual opsim database (e.g. a virtual chimera from
+    get_chimera) - i.e., one with a sources table rather than its own
+    observations. returns a list of dicts with path, constraint and
+    rowid_offset for each source, in order; None if opsim_path is a regular
+    database.
+    """
+    conn = sqlite3.connect(opsim_path)
+    tables = [row[0] for row in conn.execute("select name from sqlite_master where type='table'")]
+    if 'virtual_sources' not in tables:
+        conn.close()
+        return None
+    rows = conn.execute('select path, constraint_sql, rowid_offset from virtual_sources ' +
+                        'order by source_order').fetchall()
+    conn.close()
+    return [{'path': row[0], 'constraint': row[1], 'rowid_offset': row[2]} for row in rows]
+
+###############################################################################
+def connect_opsim(opsim_path):
+    """
+    open a connection to an opsim database. for a virtual database, the
+    sources are attached and a temporary observations view, which UNIONs the
+    sources' rows, is set up - so that it can be queried like any other opsim
+    database. the view has a rowid column (offset for each source so that the
+    rowids are unique and increasing).
+    """
+    sources = get_virtual_sources(opsim_path)
+    conn = sqlite3.connect(opsim_path)
+    if sources is None:
+        return conn
+
+    # attach the sources + get all their columns, as pd.concat would
+    all_cols = []
+    source_cols = []
+    for i, source in enumerate(sources):
+        conn.execute('attach database ? as ?', (source['path'], f'src{i}'))
+        cols = [row[1] for row in conn.execute(f'pragma src{i}.table_info(observations)')]
+        all_cols += [col for col in cols if col not in all_cols]
+        source_cols.append(cols)
+    # now the view
+    selects = []
+    for i, source in enumerate(sources):
+        cols = [f'"{col}"' if col in source_cols[i] else f'null as "{col}"' for col in all_cols]
+        selects.append(f'select rowid + {source["rowid_offset"]} as rowid, {", ".join(cols)} ' +
+                       f'from src{i}.observations where {source["constraint"]}')
+    conn.execute(f'create temp view observations as {" union all ".join(selects)}')
+
+    return conn
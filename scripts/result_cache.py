@@ -0,0 +1,141 @@
+import numpy as np
+import hashlib
+import fcntl
+import json
+import time
+import os
+from get_pixel_index import get_db_hash
+
+__all__ = ['get_cache_key', 'cache_load', 'cache_save', 'cache_evict']
+
+###############################################################################
+def get_cache_key(cache_dir, opsim_paths, **params):
+    """
+    key for a cached result: sha1 over the contents of the databases the
+    result comes from and everything else it depends on.
+
+    required inputs
+    ---------------
+    * cache_dir: str: cache directory; database hashes are remembered here
+    * opsim_paths: list: paths to the databases the result is from
+    * params: anything else the result depends on, e.g. constraint, nside,
+              time_points, metric version. arrays are hashed by value.
+
+    returns
+    -------
+    * str: hex digest
+
+    """
+    # ---------------------------------------------------------
+    sha1 = hashlib.sha1()
+    for opsim_path in opsim_paths:
+        sha1.update(get_db_hash(opsim_path, hash_dir=cache_dir).encode())
+    for key in sorted(params):
+        val = params[key]
+        sha1.update(key.encode())
+        if isinstance(val, np.ndarray):
+            sha1.update(str(val.dtype).encode())
+            sha1.update(np.ascontiguousarray(val).tobytes())
+        else:
+            sha1.update(repr(val).encode())
+    return sha1.hexdigest()
+
+###############################################################################
+def cache_load(cache_dir, key):
+    """
+    get the cached array for key; None if it isnt cached. marks the entry as
+    used for the eviction.
+    """
+    fname = f'{cache_dir}/{key}.npz'
+    if not os.path.exists(fname):
+        return None
+    with _locked_manifest(cache_dir) as manifest:
+        if key in manifest:
+            manifest[key]['last_access'] = time.time()
+    print(f'## reading cached data from {fname} ...')
+    try:
+        with np.load(fname) as data:
+            return data['data']
+    except OSError:
+        # evicted by another run since the check above
+        print(f'## {fname} is gone; treating it as a miss.')
+        return None
+
+###############################################################################
+def cache_save(cache_dir, key, data, max_gb=None, desc=None):
+    """
+    cache the array data under key; then evict least recently used entries
+    if the cache is bigger than max_gb.
+
+    required inputs
+    ---------------
+    * cache_dir: str: cache directory
+    * key: str: key from get_cache_key
+    * data: arr: data to cache
+
+    optional inputs
+    ---------------
+    * max_gb: float: max size of the cache (GB); None for no limit.
+                     default: None
+    * desc: dict: description of the entry for the manifest. default: None
+
+    """
+    # ---------------------------------------------------------
+    os.makedirs(cache_dir, exist_ok=True)
+    fname = f'{cache_dir}/{key}.npz'
+    # write to a temp file first so that a concurrent reader never sees
+    # a partial file
+    np.savez_compressed(f'{cache_dir}/{key}.{os.getpid()}.npz', data=data)
+    os.replace(f'{cache_dir}/{key}.{os.getpid()}.npz', fname)
+    with _locked_manifest(cache_dir) as manifest:
+        manifest[key] = {'size': os.path.getsize(fname),
+                         'created': time.time(), 'last_access': time.time(),
+                         'desc': {} if desc is None else desc}
+    if max_gb is not None:
+        cache_evict(cache_dir, max_gb=max_gb)
+
+###############################################################################
+def cache_evict(cache_dir, max_gb):
+    """
+    remove the least recently used entries until the cache is at most max_gb;
+    also drops manifest entries whose files are gone.
+    """
+    max_bytes = max_gb * 1024**3
+    with _locked_manifest(cache_dir) as manifest:
+        for key in [key for key in manifest if not os.path.exists(f'{cache_dir}/{key}.npz')]:
+            manifest.pop(key)
+        total = np.sum([entry['size'] for entry in manifest.values()])
+        for key in sorted(manifest, key=lambda key: manifest[key]['last_access']):
+            if total <= max_bytes:
+                break
+            os.remove(f'{cache_dir}/{key}.npz')
+            total -= manifest.pop(key)['size']
+            print(f'## evicted {key} from the cache.')
+
+###############################################################################
+class _locked_manifest:
+    """
+    context manager for the cache manifest (a dict), holding a lock on it
+    so that concurrent runs dont clobber each others entries.
+    """
+    def __init__(self, cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.fname = f'{cache_dir}/manifest.json'
+        self.lock_fname = f'{cache_dir}/manifest.lock'
+
+    def __enter__(self):
+        self.lock = open(self.lock_fname, 'w')
+        fcntl.flock(self.lock, fcntl.LOCK_EX)
+        self.manifest = {}
+        if os.path.exists(self.fname):
+            with open(self.fname, 'r') as f:
+                self.manifest = json.load(f)
+        return self.manifest
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            with open(f'{self.fname}.tmp', 'w') as f:
+                json.dump(self.manifest, f, indent=1)
+            os.replace(f'{self.fname}.tmp', self.fname)
+        fcntl.flock(self.lock, fcntl.LOCK_UN)
+        self.lock.close()
@@ -6,9 +6,12 @@ import numpy as np
 import yaml
 import time
 from optparse import OptionParser
-from get_fonvtime import get_fonvtime
-from get_chimera import get_chimera
-from get_bespoke import get_bespoke
+from get_fonvtime import get_fonvtime_split, get_fonvtime_chimera
+from get_chimera import get_chimera, get_cutoff_mjd
+from get_bespoke import get_bespoke, get_bespoke_branches
+from get_pixel_index import get_pixel_index
+from run_pool import run_pool, run_pool_tracked
+from get_preview_report import get_preview_report
 import pickle
 ###############################################################################
 parser = OptionParser()
@@ -35,8 +38,37 @@ parser.add_option('--bespoke-metrics', dest='bespoke_metrics',
                   action='store_true', default=False,
                   help='flag to read in the generated bespoke sims + run metrics on them.'
                   )
+parser.add_option('--bespoke-all', dest='bespoke_all',
+                  action='store_true', default=False,
+                  help='flag to generate bespoke sims for all the weather sims (and ' +
+                  'all the cutoffs) on this node, running metrics on each as soon ' +
+                  'as it is ready.'
+                  )
+parser.add_option('--preview', dest='preview',
+                  action='store_true', default=False,
+                  help='flag to generate (and run metrics on) bespoke sims with the ' +
+                  'preview profile of the scheduler (reduced nside) instead; these go ' +
+                  'in their own directories.'
+                  )
+parser.add_option('--preview-report', dest='preview_report',
+                  action='store_true', default=False,
+                  help='flag to compare the preview bespoke sims against the full ' +
+                  'resolution ones (must have both already).'
+                  )
 parser.add_option('--cutoff', dest='cutoff_date',
-                  help='date for cutoff; YYYY-MM-DD format.'
+                  help='date for cutoff; YYYY-MM-DD format. can be a comma-separated ' +
+                  'list of dates for the chimera, bespoke-sim-only and bespoke-all stages.'
+                  )
+parser.add_option('--workers', dest='workers', type='int', default=1,
+                  help='number of processes to run the sims in parallel with ' +
+                  '(metric + chimera stages; bespoke sims for many cutoffs; ' +
+                  'bespoke-all jobs). default: 1'
+                  )
+parser.add_option('--max-retries', dest='max_retries', type='int', default=1,
+                  help='number of times to retry a failed bespoke-all job. default: 1'
+                  )
+parser.add_option('--mem-per-worker-gb', dest='mem_per_worker_gb', type='float',
+                  help='memory limit for each worker process (GB). default: None'
                   )
 # ---------------------------------------------------------
 start_time = time.time()
@@ -49,10 +81,20 @@ chimera = options.chimera
 bespoke_sim_only = options.bespoke_sim_only
 bespoke_opsim_fname = options.bespoke_opsim_fname
 bespoke_metrics = options.bespoke_metrics
-cutoff_date = options.cutoff_date
-if (chimera or bespoke_sim_only or bespoke_metrics) and cutoff_date is None:
+bespoke_all = options.bespoke_all
+preview = options.preview
+preview_report = options.preview_report
+cutoff_dates = None if options.cutoff_date is None else options.cutoff_date.split(',')
+cutoff_date = None if cutoff_dates is None else cutoff_dates[0]
+workers = options.workers
+mem_per_worker_gb = options.mem_per_worker_gb
+max_retries = options.max_retries
+if (chimera or bespoke_sim_only or bespoke_metrics or bespoke_all or preview_report) and \
+                                                                        cutoff_date is None:
     raise ValueError('## must specify cutoff_date when using chimera or ' +
                      'bespoke flags.')
+if bespoke_metrics and len(cutoff_dates) > 1:
+    raise ValueError('## only one cutoff_date can be used with bespoke_metrics.')
 if bespoke_sim_only and bespoke_opsim_fname is None:
     raise ValueError('## must specify bespoke_opsim_fname to run ' +
                      'bespoke_sim_only')
@@ -68,6 +110,10 @@ basepath = config['basepath']
 outdir = config['outdir']
 nside = config['nside']
 tag_to_look_for = config['tag_to_look_for']
+# engine for the fonv metric: 'maf' or 'numpy'
+fonv_engine = config.get('fonv_engine', 'maf')
+# how to build the chimera sims: 'sql', 'pandas' or 'virtual'
+chimera_mode = config.get('chimera_mode', 'sql')
 # set up time array for the vector metric
 timepts = config['timepts']
 time_points = np.arange(timepts[0], timepts[1], timepts[2])
@@ -76,6 +122,11 @@ del timepts
 # outdir for metrics
 outdir_metrics= f'{outdir}/metrics/'
 os.makedirs(outdir_metrics, exist_ok=True)
+# persistent visit to pixel indexes for the numpy engine
+index_dir = f'{outdir}/pixel_index/' if fonv_engine == 'numpy' else None
+# result cache for the fonv metrics; keyed by db contents + inputs
+cache_dir = f'{outdir_metrics}/cache/'
+cache_max_gb = config.get('fonv_cache_max_gb', None)
 # now run
 # ---------------------------------------------------------------
 if fonv_base:
@@ -88,7 +139,8 @@ if fonv_base:
     subdir = f'{outdir_metrics}/fonvs_base'
     os.makedirs(subdir, exist_ok=True)
     # ---------------------------------------------------------------
-    # loop over the two folders
+    # loop over the two folders; set up a job for each sim
+    jobs, db_tags = [], []
     for cat in ['baseline', 'weather']:
         dbpath = f'{basepath}/{cat}'
         for opsim_fname in [f for f in os.listdir(dbpath) if \
@@ -99,30 +151,30 @@ if fonv_base:
 
             # ---------------------------------------------------------------
             # median nvisits over survey area as a function of time
-            # all filters
-            constraint = "scheduler_note not like '%DD%'"
-            fonvs_time_all[db_tag] = get_fonvtime(constraint=constraint,
-                                                  nside=nside,
+            # all filters + by filter; visits read and sliced once
+            # (numpy engine: keep the accumulated counts for the chimera stage)
+            jobs.append((get_fonvtime_split, dict(nside=nside,
                                                   time_points=time_points,
                                                   opsim_path=opsim_path,
                                                   outdir=subdir,
                                                   save_data=save_data,
-                                                  output_tag=f'{db_tag}_allfilts'
-                                                  )
-            # ---------------------------------------------------------------
-            # now by filter
-            for filt in 'ugrizy':
-                constraint = f"scheduler_note not like '%DD%' and filter='{filt}'"
-                if filt not in fonvs_time_per_filter:
-                    fonvs_time_per_filter[filt] = {}
-                fonvs_time_per_filter[filt][db_tag] = get_fonvtime(constraint=constraint,
-                                                                   nside=nside,
-                                                                   time_points=time_points,
-                                                                   opsim_path=opsim_path,
-                                                                   outdir=subdir,
-                                                                   save_data=save_data,
-                                                                   output_tag=f'{db_tag}_{filt}'
-                                                                   )
+                                                  output_tag=db_tag,
+                                                  engine=fonv_engine,
+                                                  save_counts=fonv_engine == 'numpy',
+                                                  index_dir=index_dir,
+                                                  cache_dir=cache_dir,
+                                                  cache_max_gb=cache_max_gb
+                                                  )))
+            db_tags.append(db_tag)
+    # ---------------------------------------------------------------
+    # now run them + collect
+    for db_tag, fonvs in zip(db_tags, run_pool(jobs, workers=workers,
+                                               mem_per_worker_gb=mem_per_worker_gb)):
+        fonvs_time_all[db_tag] = fonvs['allfilts']
+        for filt in 'ugrizy':
+            if filt not in fonvs_time_per_filter:
+                fonvs_time_per_filter[filt] = {}
+            fonvs_time_per_filter[filt][db_tag] = fonvs[filt]
     # ---------------------------------------------------------------
     # now save
     fname = 'fonvs_vector_base.pickle'
@@ -157,97 +209,171 @@ if chimera:
     else:
         baseline_path = f'{basepath}/baseline/{baseline_path[0]}'
 
-    # loop over the weather sims
+    if index_dir is not None:
+        # every job needs the baseline index; make sure its there before
+        # the jobs start so that they dont all build it
+        get_pixel_index(baseline_path, nside=nside, index_dir=index_dir)
+
+    # loop over the weather sims; set up jobs for each sim
+    # (one chimera job per sim for all the cutoffs; one metric job per chimera)
+    chimera_jobs, metric_jobs, db_tags = [], [], []
     for cat in ['weather']:
         dbpath = f'{basepath}/{cat}'
         for opsim_fname in [f for f in os.listdir(dbpath) if f.endswith(tag_to_look_for)]:
             print(f'## working with {opsim_fname}')
-            db_tag = opsim_fname.split(tag_to_look_for)[0]
+            weather_tag = opsim_fname.split(tag_to_look_for)[0]
             opsim_path = f'{dbpath}/{opsim_fname}'
             # ---------------------------------------------------------------
-            # generate the chimera sim
-            opsim_path = get_chimera(baseline_path=baseline_path,
-                                     sim_to_cut_path=opsim_path,
-                                     cutoff_date=cutoff_date,
-                                     cutoff_date_format='isot',
-                                     outdir=outdir_chimera
-                                     )
-            # now run things for the sim
-            db_tag = f'chimera_cutoff{cutoff_date}_{db_tag}'
-            print(opsim_path)
-            # ---------------------------------------------------------------
-            # nvisits as a function of time
-            # all filters
-            constraint = "scheduler_note not like '%DD%'"
-            chimera_fonvs_time_all[db_tag] = get_fonvtime(constraint=constraint,
-                                                          nside=nside,
-                                                          time_points=time_points,
-                                                          opsim_path=opsim_path,
-                                                          outdir=subdir,
-                                                          save_data=save_data,
-                                                          output_tag=f'{db_tag}_allfilts'
-                                                          )
-            # ---------------------------------------------------------------
-            # now by filter
-            for filt in 'ugrizy':
-                constraint = f"scheduler_note not like '%DD%' and filter='{filt}'"
-                if filt not in chimera_fonvs_time_per_filter:
-                    chimera_fonvs_time_per_filter[filt] = {}
-                chimera_fonvs_time_per_filter[filt][db_tag] = get_fonvtime(constraint=constraint,
-                                                                           nside=nside,
-                                                                           time_points=time_points,
-                                                                           opsim_path=opsim_path,
-                                                                           outdir=subdir,
-                                                                           save_data=save_data,
-                                                                           output_tag=f'{db_tag}_{filt}'
-                                                                           )
+            # generate the chimera sims
+            chimera_jobs.append((get_chimera, dict(baseline_path=baseline_path,
+                                                   sim_to_cut_path=opsim_path,
+                                                   cutoff_date=cutoff_dates,
+                                                   cutoff_date_format='isot',
+                                                   outdir=outdir_chimera,
+                                                   mode=chimera_mode
+                                                   )))
+            for cutoff in cutoff_dates:
+                # now run things for the sim
+                db_tag = f'chimera_cutoff{cutoff}_{weather_tag}'
+                db_tags.append((cutoff, db_tag))
+                # ---------------------------------------------------------------
+                # nvisits as a function of time
+                # all filters + by filter; visits read and sliced once
+                if fonv_engine == 'numpy':
+                    # build on the weather sim's accumulated counts from the
+                    # fonvbase stage; only need to map the post-cutoff visits
+                    metric_jobs.append((get_fonvtime_chimera,
+                                        dict(baseline_path=baseline_path,
+                                             sim_to_cut_path=opsim_path,
+                                             cutoff_mjd=get_cutoff_mjd(cutoff, 'isot'),
+                                             nside=nside,
+                                             time_points=time_points,
+                                             outdir=subdir,
+                                             counts_dir=f'{outdir_metrics}/fonvs_base',
+                                             counts_tag=weather_tag,
+                                             save_data=save_data,
+                                             output_tag=db_tag,
+                                             index_dir=index_dir,
+                                             cache_dir=cache_dir,
+                                             cache_max_gb=cache_max_gb
+                                             )))
+                else:
+                    # path filled in below, once the chimera sim exists
+                    metric_jobs.append((get_fonvtime_split,
+                                        dict(nside=nside,
+                                             time_points=time_points,
+                                             opsim_path=None,
+                                             outdir=subdir,
+                                             save_data=save_data,
+                                             output_tag=db_tag,
+                                             engine=fonv_engine,
+                                             index_dir=index_dir,
+                                             cache_dir=cache_dir,
+                                             cache_max_gb=cache_max_gb
+                                             )))
+    # ---------------------------------------------------------------
+    # now run them + collect
+    chimera_paths = [path for paths in run_pool(chimera_jobs, workers=workers,
+                                                mem_per_worker_gb=mem_per_worker_gb)
+                     for path in paths]
+    for (func, kwargs), chimera_path in zip(metric_jobs, chimera_paths):
+        print(chimera_path)
+        if func is get_fonvtime_split:
+            kwargs['opsim_path'] = chimera_path
+    for (cutoff, db_tag), fonvs in zip(db_tags, run_pool(metric_jobs, workers=workers,
+                                                         mem_per_worker_gb=mem_per_worker_gb)):
+        if cutoff not in chimera_fonvs_time_all:
+            chimera_fonvs_time_all[cutoff] = {}
+            chimera_fonvs_time_per_filter[cutoff] = {filt: {} for filt in 'ugrizy'}
+        chimera_fonvs_time_all[cutoff][db_tag] = fonvs['allfilts']
+        for filt in 'ugrizy':
+            chimera_fonvs_time_per_filter[cutoff][filt][db_tag] = fonvs[filt]
     #  ---------------------------------------------------------------
-    # now save
-    fname = f'fonvs_vector_chimera_cutoff{cutoff_date}.pickle'
-    pickle.dump({'chimera_fonvs_time_all': chimera_fonvs_time_all,
-                 'chimera_fonvs_time_per_filter': chimera_fonvs_time_per_filter
-                 },
-                 open(f'{outdir_metrics}/{fname}', 'wb')
-                 )
-    print(f'## chimera fonvs dicts saved in {fname}.')
+    # now save; one file per cutoff
+    for cutoff in cutoff_dates:
+        fname = f'fonvs_vector_chimera_cutoff{cutoff}.pickle'
+        pickle.dump({'chimera_fonvs_time_all': chimera_fonvs_time_all[cutoff],
+                     'chimera_fonvs_time_per_filter': chimera_fonvs_time_per_filter[cutoff]
+                     },
+                     open(f'{outdir_metrics}/{fname}', 'wb')
+                     )
+        print(f'## chimera fonvs dicts saved in {fname}.')
     print(f'## time taken: {(time.time() - time0)/60:.2f} (min)')
     # ---------------------------------------------------------------
 
 # ---------------------------------------------------------------
-if bespoke_sim_only or bespoke_metrics:
+if bespoke_sim_only or bespoke_metrics or bespoke_all or preview_report:
     # ---------------------------------------------------------------
     time0 = time.time()
     print(f'## working on bespoke sims ...')
-    # outdir for bespoke sims
-    outdir_bespoke = f'{outdir}/bespoke/'
+    # outdir for bespoke sims; preview sims (+ their metrics) are kept apart
+    bespoke_tag = 'bespoke_preview' if preview else 'bespoke'
+    outdir_bespoke = f'{outdir}/{bespoke_tag}/'
     os.makedirs(outdir_bespoke, exist_ok=True)
 
     baseline_py_path = config['baseline_py_path']
     illum_limit = config['illum_limit']
     scheduler_args = config['scheduler_args']
+    # cache the scheduler setup products (footprints, ddf script, ..) so
+    # that each sim doesnt regenerate them
+    if scheduler_args.get('setup_cache_dir', None) is None:
+        scheduler_args = dict(scheduler_args, setup_cache_dir=f'{outdir_bespoke}/setup_cache/')
+    if preview:
+        scheduler_args = dict(scheduler_args, preview=True)
+    # checkpoint the sims every so many nights; a re-run continues from there
+    checkpoint_nights = config.get('bespoke_checkpoint_nights', None)
+    # write the new visits out every so many nights, rather than at the end
+    stream_nights = config.get('bespoke_stream_nights', None)
+    # simulate only upto this night; 'timepts' for the last time point of the
+    # vector metric (nothing after that is used). None for the full survey
+    horizon_night = config.get('bespoke_horizon', None)
+    if horizon_night == 'timepts':
+        horizon_night = float(np.ceil(time_points.max()))
 
     if bespoke_sim_only:
         print(f'## working with {bespoke_opsim_fname}')
         # ---------------------------------------------------------------
-        # generate the chimera sim
-        opsim_path = get_bespoke(baseline_py_path=baseline_py_path,
-                                 sim_to_cut_path=bespoke_opsim_fname,
-                                 cutoff_date=cutoff_date,
-                                 cutoff_date_format='isot',
-                                 outdir=outdir_bespoke,
-                                 scheduler_args=scheduler_args
-                                 )
+        # generate the bespoke sim(s); for many cutoffs, the scheduler is
+        # restored once and branched at each cutoff
+        if len(cutoff_dates) > 1:
+            opsim_paths = get_bespoke_branches(baseline_py_path=baseline_py_path,
+                                               sim_to_cut_path=bespoke_opsim_fname,
+                                               cutoff_dates=cutoff_dates,
+                                               cutoff_date_format='isot',
+                                               outdir=outdir_bespoke,
+                                               scheduler_args=scheduler_args,
+                                               max_children=workers,
+                                               snapshot_dir=f'{outdir_bespoke}/snapshots/',
+                                               checkpoint_nights=checkpoint_nights,
+                                               stream_nights=stream_nights,
+                                               horizon_night=horizon_night
+                                               )
+        else:
+            opsim_path = get_bespoke(baseline_py_path=baseline_py_path,
+                                     sim_to_cut_path=bespoke_opsim_fname,
+                                     cutoff_date=cutoff_date,
+                                     cutoff_date_format='isot',
+                                     outdir=outdir_bespoke,
+                                     scheduler_args=scheduler_args,
+                                     # restored schedulers for re-runs
+                                     snapshot_dir=f'{outdir_bespoke}/snapshots/',
+                                     checkpoint_nights=checkpoint_nights,
+                                     stream_nights=stream_nights,
+                                     horizon_night=horizon_night
+                                     )
         print(f'## time taken: {(time.time() - time0)/60:.2f} (min)')
         # ---------------------------------------------------------------
 
     if bespoke_metrics:
+        cutoff_mjd = get_cutoff_mjd(cutoff_date, 'isot')
         # outdir for the interim outputs
-        subdir = f'{outdir_metrics}/fonvs_bespoke/'
+        subdir = f'{outdir_metrics}/fonvs_{bespoke_tag}/'
         os.makedirs(subdir, exist_ok=True)
         # set up
         bespoke_fonvs_time_all, bespoke_fonvs_time_per_filter = {}, {}
         save_data = True
-        # loop over the weather sims
+        # loop over the weather sims; set up a job for each sim
+        jobs, db_tags = [], []
         for cat in ['weather']:
             dbpath = f'{basepath}/{cat}'
             for opsim_fname in [f for f in os.listdir(dbpath) if f.endswith(tag_to_look_for)]:
@@ -255,14 +381,16 @@ if bespoke_sim_only or bespoke_metrics:
                 db_tag = opsim_fname.split(tag_to_look_for)[0]
                 opsim_path = f'{dbpath}/{opsim_fname}'
                 # ---------------------------------------------------------------
-                # generate the chimera sim
+                # look for the bespoke sim
+                weather_path = opsim_path
                 opsim_path = get_bespoke(baseline_py_path=baseline_py_path,
                                         sim_to_cut_path=opsim_path,
                                         cutoff_date=cutoff_date,
                                         cutoff_date_format='isot',
                                         outdir=outdir_bespoke,
                                         scheduler_args=scheduler_args,
-                                        exists_only=True
+                                        exists_only=True,
+                                        horizon_night=horizon_night
                                         )
                 if opsim_path is None:
                     raise ValueError('## attempting to generate bespoke sim when shouldnt' +
@@ -273,33 +401,35 @@ if bespoke_sim_only or bespoke_metrics:
                 print(opsim_path)
                 # ---------------------------------------------------------------
                 # nvisits as a function of time
-                # all filters
-                constraint = "scheduler_note not like '%DD%'"
-                bespoke_fonvs_time_all[db_tag] = get_fonvtime(constraint=constraint,
-                                                            nside=nside,
-                                                            time_points=time_points,
-                                                            opsim_path=opsim_path,
-                                                            outdir=subdir,
-                                                            save_data=save_data,
-                                                            output_tag=f'{db_tag}_allfilts'
-                                                            )
-                # ---------------------------------------------------------------
-                # now by filter
-                for filt in 'ugrizy':
-                    constraint = f"scheduler_note not like '%DD%' and filter='{filt}'"
-                    if filt not in bespoke_fonvs_time_per_filter:
-                        bespoke_fonvs_time_per_filter[filt] = {}
-                    bespoke_fonvs_time_per_filter[filt][db_tag] = get_fonvtime(constraint=constraint,
-                                                                            nside=nside,
-                                                                            time_points=time_points,
-                                                                            opsim_path=opsim_path,
-                                                                            outdir=subdir,
-                                                                            save_data=save_data,
-                                                                            output_tag=f'{db_tag}_{filt}'
-                                                                            )
+                # all filters + by filter; visits read and sliced once
+                jobs.append((get_fonvtime_split,
+                             dict(nside=nside,
+                                  time_points=time_points,
+                                  opsim_path=opsim_path,
+                                  outdir=subdir,
+                                  save_data=save_data,
+                                  output_tag=db_tag,
+                                  engine=fonv_engine,
+                                  index_dir=index_dir,
+                                  cache_dir=cache_dir,
+                                  cache_max_gb=cache_max_gb,
+                                  # pre-cutoff rows are the weather sim's
+                                  index_parents=[(weather_path,
+                                                  f'observationStartMJD <= {cutoff_mjd}')]
+                                  )))
+                db_tags.append(db_tag)
+        # ---------------------------------------------------------------
+        # now run them + collect
+        for db_tag, fonvs in zip(db_tags, run_pool(jobs, workers=workers,
+                                                   mem_per_worker_gb=mem_per_worker_gb)):
+            bespoke_fonvs_time_all[db_tag] = fonvs['allfilts']
+            for filt in 'ugrizy':
+                if filt not in bespoke_fonvs_time_per_filter:
+                    bespoke_fonvs_time_per_filter[filt] = {}
+                bespoke_fonvs_time_per_filter[filt][db_tag] = fonvs[filt]
         #  ---------------------------------------------------------------
         # now save
-        fname = f'fonvs_vector_bespoke_cutoff{cutoff_date}.pickle'
+        fname = f'fonvs_vector_{bespoke_tag}_cutoff{cutoff_date}.pickle'
         pickle.dump({'bespoke_fonvs_time_all': bespoke_fonvs_time_all,
                     'bespoke_fonvs_time_per_filter': bespoke_fonvs_time_per_filter
                     },
@@ -309,4 +439,118 @@ if bespoke_sim_only or bespoke_metrics:
         print(f'## time taken: {(time.time() - time0)/60:.2f} (min)')
         # ---------------------------------------------------------------
 
+    if bespoke_all:
+        # outdir for the interim outputs
+        subdir = f'{outdir_metrics}/fonvs_{bespoke_tag}/'
+        os.makedirs(subdir, exist_ok=True)
+        save_data = True
+        # one job per weather sim, for all the cutoffs; for many cutoffs, the
+        # scheduler is restored once and branched at each cutoff (in turn)
+        jobs, weather_paths = {}, {}
+        for cat in ['weather']:
+            dbpath = f'{basepath}/{cat}'
+            for opsim_fname in [f for f in os.listdir(dbpath) if f.endswith(tag_to_look_for)]:
+                db_tag = opsim_fname.split(tag_to_look_for)[0]
+                weather_paths[db_tag] = f'{dbpath}/{opsim_fname}'
+                jobs[db_tag] = (get_bespoke_branches,
+                                dict(baseline_py_path=baseline_py_path,
+                                     sim_to_cut_path=weather_paths[db_tag],
+                                     cutoff_dates=cutoff_dates,
+                                     cutoff_date_format='isot',
+                                     outdir=outdir_bespoke,
+                                     scheduler_args=scheduler_args,
+                                     max_children=1,
+                                     snapshot_dir=f'{outdir_bespoke}/snapshots/',
+                                     checkpoint_nights=checkpoint_nights,
+                                     stream_nights=stream_nights,
+                                     horizon_night=horizon_night
+                                     ))
+
+        def metric_jobs(db_tag, opsim_paths):
+            # metric jobs for the bespoke sims of a weather sim, once they're ready
+            if db_tag not in weather_paths:
+                return None
+            new_jobs = {}
+            for cutoff, opsim_path in zip(cutoff_dates, opsim_paths):
+                cutoff_mjd = get_cutoff_mjd(cutoff, 'isot')
+                new_jobs[f'bespoke_cutoff{cutoff}_{db_tag}'] = \
+                    (get_fonvtime_split,
+                     dict(nside=nside,
+                          time_points=time_points,
+                          opsim_path=opsim_path,
+                          outdir=subdir,
+                          save_data=save_data,
+                          output_tag=f'bespoke_cutoff{cutoff}_{db_tag}',
+                          engine=fonv_engine,
+                          index_dir=index_dir,
+                          cache_dir=cache_dir,
+                          cache_max_gb=cache_max_gb,
+                          # pre-cutoff rows are the weather sim's
+                          index_parents=[(weather_paths[db_tag],
+                                          f'observationStartMJD <= {cutoff_mjd}')]
+                          ))
+            return new_jobs
+        # ---------------------------------------------------------------
+        # now run them + collect
+        results = run_pool_tracked(jobs, state_path=f'{outdir_bespoke}/bespoke_all_jobs.json',
+                                   workers=workers, mem_per_worker_gb=mem_per_worker_gb,
+                                   max_retries=max_retries, on_done=metric_jobs)
+        for cutoff in cutoff_dates:
+            bespoke_fonvs_time_all, bespoke_fonvs_time_per_filter = {}, {filt: {} for filt in 'ugrizy'}
+            for db_tag in weather_paths:
+                fonvs = results.get(f'bespoke_cutoff{cutoff}_{db_tag}')
+                if fonvs is None:
+                    print(f'## no metrics for bespoke_cutoff{cutoff}_{db_tag}; see the job states.')
+                    continue
+                bespoke_fonvs_time_all[f'bespoke_cutoff{cutoff}_{db_tag}'] = fonvs['allfilts']
+                for filt in 'ugrizy':
+                    bespoke_fonvs_time_per_filter[filt][f'bespoke_cutoff{cutoff}_{db_tag}'] = fonvs[filt]
+            #  ---------------------------------------------------------------
+            # now save
+            fname = f'fonvs_vector_{bespoke_tag}_cutoff{cutoff}.pickle'
+            pickle.dump({'bespoke_fonvs_time_all': bespoke_fonvs_time_all,
+                        'bespoke_fonvs_time_per_filter': bespoke_fonvs_time_per_filter
+                        },
+                        open(f'{outdir_metrics}/{fname}', 'wb')
+                        )
+            print(f'## bespoke fonvs dicts saved in {fname}.')
+        print(f'## time taken: {(time.time() - time0)/60:.2f} (min)')
+        # ---------------------------------------------------------------
+
+    if preview_report:
+        # compare the preview sims against the full resolution ones, for each
+        # weather sim and cutoff
+        subdir = f'{outdir_metrics}/preview_report/'
+        os.makedirs(subdir, exist_ok=True)
+        for cutoff in cutoff_dates:
+            pairs = {}
+            for cat in ['weather']:
+                dbpath = f'{basepath}/{cat}'
+                for opsim_fname in [f for f in os.listdir(dbpath) if f.endswith(tag_to_look_for)]:
+                    db_tag = opsim_fname.split(tag_to_look_for)[0]
+                    opsim_paths = [get_bespoke(baseline_py_path=baseline_py_path,
+                                               sim_to_cut_path=f'{dbpath}/{opsim_fname}',
+                                               cutoff_date=cutoff,
+                                               cutoff_date_format='isot',
+                                               outdir=f'{outdir}/{tag}/',
+                                               scheduler_args=scheduler_args,
+                                               exists_only=True,
+                                               horizon_night=horizon_night
+                                               )
+                                   for tag in ['bespoke', 'bespoke_preview']]
+                    if None in opsim_paths:
+                        print(f'## skipping {db_tag}; need both the full + preview sims.')
+                        continue
+                    pairs[db_tag] = tuple(opsim_paths)
+            if len(pairs) == 0:
+                print(f'## no full + preview pairs for cutoff {cutoff}.')
+                continue
+            get_preview_report(pairs=pairs, nside=nside, time_points=time_points,
+                               outdir=subdir, report_tag=f'bespoke_cutoff{cutoff}',
+                               engine=fonv_engine, index_dir=index_dir,
+                               cache_dir=cache_dir, cache_max_gb=cache_max_gb,
+                               workers=workers, mem_per_worker_gb=mem_per_worker_gb)
+        print(f'## time taken: {(time.time() - time0)/60:.2f} (min)')
+        # ---------------------------------------------------------------
+
 print(f'## overall time taken: {(time.time() - start_time)/60:.2f} (min)')
\ No newline at end of file
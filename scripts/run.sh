@@ -15,7 +15,7 @@ mkdir -p ${repopath}'/slurm_out'
 mkdir -p ${repopath}'/slurm_scripts'
 cd ${repopath}'/slurm_scripts'
 
-cutoff_date=2026-03-01
+cutoff_date=2026-03-01   # chimera stage can take a comma-separated list, e.g. 2026-03-01,2028-09-01
 # cutoff_date=2028-09-01
 
 config=${repopath}/scripts/config.yml
@@ -26,7 +26,10 @@ fonv_base_queue=0   # set to 1 to run fonv metric on basleine
 chimera_queue=0     # set to 1 to generate chimera sims and run fonv metric on them
 bespoke_sims_queue=0    # set to 1 to generate bespoke sims
 bespoke_metrics_queue=1 # set to 1 to run fonv metric on bespoke sims; must have bespoke sims already
+bespoke_all_queue=0     # set to 1 to generate bespoke sims for all weather sims + run fonv metric on them, in one job
+bespoke_all_workers=8   # number of sims to run at a time in the bespoke_all job
 various_interactive=0   # set to 1 to run things in interactive node
+workers=1   # number of processes for the metric + chimera stages on the interactive node
 
 # -----------------------------------------------------------------------------
 # run fnov on baseline - in queue
@@ -141,6 +144,43 @@ EOF
 fi
 
 
+# -----------------------------------------------------------------------------
+# bespoke sims generation for all weather sims + fnov metric - one job on a node;
+# job states in the bespoke outdir. failed sims are retried; re-submitting
+# continues from the checkpoints.
+# -----------------------------------------------------------------------------
+if [[ $bespoke_all_queue == 1 ]];
+then
+    jobname='bspall'
+    fname='bespoke_all_cutoff'${cutoff_date}
+    cat > ${fname}.sl << EOF
+#!/bin/bash
+#SBATCH --account=rubin:commissioning
+#SBATCH --partition=milano
+#SBATCH --job-name=${jobname}
+#SBATCH --output=${outpath}/${fname}_%j.out
+#SBATCH --nodes=1                       # Number of nodes
+#SBATCH --ntasks=1
+#SBATCH --cpus-per-task=${bespoke_all_workers}
+#SBATCH --mem-per-cpu=30g
+#SBATCH --time=48:00:00
+
+source ~/.bashrc
+conda activate ss
+
+export OMP_NUM_THREAD=1
+export USE_SIMPLE_THREADED_LEVEL3=1
+
+echo '## generating bespoke sims and running fonv metric on them ..'
+python ${repopath}/scripts/run.py --config=${config} \
+        --bespoke-all --cutoff=${cutoff_date} \
+        --workers=${bespoke_all_workers} --mem-per-worker-gb=28
+
+EOF
+    sbatch ${fname}.sl
+    echo submitted ${fname}.sl
+fi
+
 # -----------------------------------------------------------------------------
 # fnov metric on bespoke sims - queue option
 # -----------------------------------------------------------------------------
@@ -183,14 +223,14 @@ if [[ $various_interactive == 1 ]];
 then
     # run fonv metric on baseline
     echo '## runnig fonv metric on baseline ..'
-    python ${repopath}/scripts/run.py --config=${config} --fonvbase --cutoff=${cutoff_date} > ${outpath}/fonvbase.out
+    python ${repopath}/scripts/run.py --config=${config} --fonvbase --cutoff=${cutoff_date} --workers=${workers} > ${outpath}/fonvbase.out
 
     # generate chimera sims - and run metrics on them
     echo '## generating chimera sims and running fonv metric on them ..'
-    python ${repopath}/scripts/run.py --config=${config} --chimera --cutoff=${cutoff_date} > ${outpath}/chimera.out
+    python ${repopath}/scripts/run.py --config=${config} --chimera --cutoff=${cutoff_date} --workers=${workers} > ${outpath}/chimera.out
 
     # run metrics on bespoke sims
     echo '## running fonv metric on bespoke sims ..'
-    python ${repopath}/scripts/run.py --config=${config} --bespoke-metrics --cutoff=${cutoff_date} > ${outpath}/bespoke.out
+    python ${repopath}/scripts/run.py --config=${config} --bespoke-metrics --cutoff=${cutoff_date} --workers=${workers} > ${outpath}/bespoke.out
 
 fi
\ No newline at end of file
@@ -0,0 +1,203 @@
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+import resource
+import pickle
+import json
+import time
+import os
+
+__all__ = ['run_pool', 'run_pool_tracked']
+
+###############################################################################
+def run_pool(jobs, workers=1, mem_per_worker_gb=None):
+    """
+    run independent jobs, in a pool of worker processes if workers > 1.
+
+    required inputs
+    ---------------
+    * jobs: list: list of (func, kwargs) tuples; each job runs func(**kwargs).
+                  func must be importable (i.e., defined in a module).
+
+    optional inputs
+    ---------------
+    * workers: int: number of worker processes; 1 to run things serially
+                    in this process. default: 1
+    * mem_per_worker_gb: float: address space limit for each worker (GB); a
+                                worker going over it raises MemoryError
+                                (rather than the node running out).
+                                None for no limit. default: None
+
+    returns
+    -------
+    * list: func(**kwargs) for each job, in the order of jobs
+
+    """
+    # ---------------------------------------------------------
+    if workers is None or workers <= 1 or len(jobs) <= 1:
+        return [func(**kwargs) for func, kwargs in jobs]
+
+    print(f'## running {len(jobs)} jobs with {workers} workers ...')
+    # fork so that workers dont re-run the calling script
+    with ProcessPoolExecutor(max_workers=min(workers, len(jobs)),
+                             mp_context=mp.get_context('fork'),
+                             initializer=_limit_memory,
+                             initargs=(mem_per_worker_gb,)
+                             ) as pool:
+        futures = [pool.submit(func, **kwargs) for func, kwargs in jobs]
+        # collect in job order; raises the first failure
+        return [future.result() for future in futures]
+
+###############################################################################
+def run_pool_tracked(jobs, state_path, workers=1, mem_per_worker_gb=None, max_retries=1,
+                     on_done=None):
+    """
+    run independent jobs in a pool of worker processes, keeping the state of
+    each job (pending/running/retrying/done/failed, attempts, last error) in
+    a json file as things progress; failed jobs are retried, and follow-up
+    jobs can be started as soon as a job is done. the results of the done
+    jobs are kept next to the state file, so that a re-run skips the jobs
+    done already (and only retries the rest). if a worker dies (e.g. killed
+    for running out of memory), the pool is rebuilt and the jobs that were
+    running in it are retried; each of them counts the attempt, since there
+    is no telling which one took the worker down.
+
+    required inputs
+    ---------------
+    * jobs: dict: key: (func, kwargs) for each job; keys must be strings.
+                  func must be importable (i.e., defined in a module).
+    * state_path: str: path to the json file for the job states
+
+    optional inputs
+    ---------------
+    * workers: int: number of worker processes. default: 1
+    * mem_per_worker_gb: float: address space limit for each worker (GB);
+                                as in run_pool. default: None
+    * max_retries: int: number of times to retry a failed job. default: 1
+    * on_done: func: called as on_done(key, result) when a job is done; can
+                     return a dict of follow-up jobs (as jobs) to run in the
+                     same pool. default: None
+
+    returns
+    -------
+    * dict: key: func(**kwargs) for each job, including the follow-up
+            ones; None for jobs that failed (after the retries)
+
+    """
+    # ---------------------------------------------------------
+    results_path = f'{os.path.splitext(state_path)[0]}_results.pickle'
+    all_jobs, state, results, done_before = {}, {}, {}, {}
+    # pick up from an earlier run
+    if os.path.exists(state_path) and os.path.exists(results_path):
+        with open(state_path, 'r') as f:
+            state = json.load(f)
+        with open(results_path, 'rb') as f:
+            done_before = pickle.load(f)
+        # everything not done gets a fresh set of attempts
+        for key in state:
+            if state[key]['status'] != 'done' or key not in done_before:
+                state[key].update({'status': 'pending', 'attempts': 0})
+        print(f'## read job states from {state_path}: ' +
+              f'{len(done_before)} jobs done already.')
+
+    def save_state():
+        # write to temp files first so that a reader never sees a partial file
+        with open(f'{state_path}.tmp', 'w') as f:
+            json.dump(state, f, indent=1)
+        os.replace(f'{state_path}.tmp', state_path)
+        with open(f'{results_path}.tmp', 'wb') as f:
+            pickle.dump({key: results[key] for key in results
+                         if state[key]['status'] == 'done'},
+                        f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f'{results_path}.tmp', results_path)
+
+    def new_pool():
+        # fork so that workers dont re-run the calling script
+        return ProcessPoolExecutor(max_workers=max(workers, 1),
+                                   mp_context=mp.get_context('fork'),
+                                   initializer=_limit_memory,
+                                   initargs=(mem_per_worker_gb,)
+                                   )
+
+    futures, to_submit = {}, []
+
+    def add(key, job):
+        # queue a job; ones done in an earlier run are done here right away
+        all_jobs[key] = job
+        if key not in state:
+            state[key] = {'func': job[0].__name__, 'attempts': 0, 'error': None}
+        if state[key].get('status') == 'done' and key in done_before:
+            print(f'## job {key} done already.')
+            finish(key, done_before[key])
+        else:
+            to_submit.append(key)
+
+    def finish(key, result):
+        state[key]['status'] = 'done'
+        state[key].setdefault('finished', time.time())
+        results[key] = result
+        if on_done is not None:
+            for new_key, new_job in (on_done(key, result) or {}).items():
+                add(new_key, new_job)
+
+    def fail(key, e):
+        print(f'## job {key} failed (attempt {state[key]["attempts"]}): {e!r}')
+        state[key]['error'] = repr(e)
+        if state[key]['attempts'] <= max_retries:
+            to_submit.append(key)
+        else:
+            state[key]['status'] = 'failed'
+            results[key] = None
+
+    print(f'## running {len(jobs)} jobs with {workers} workers; states in {state_path}')
+    pool = new_pool()
+    try:
+        for key, job in jobs.items():
+            add(key, job)
+        while len(to_submit) > 0 or len(futures) > 0:
+            # submit everything queued up
+            while len(to_submit) > 0:
+                key = to_submit.pop(0)
+                state[key]['status'] = 'running' if state[key]['attempts'] == 0 else 'retrying'
+                state[key]['attempts'] += 1
+                state[key]['started'] = time.time()
+                futures[pool.submit(all_jobs[key][0], **all_jobs[key][1])] = key
+            save_state()
+            done, _ = wait(list(futures), return_when=FIRST_COMPLETED)
+            broken = False
+            for future in done:
+                key = futures.pop(future)
+                try:
+                    result = future.result()
+                except BrokenProcessPool as e:
+                    broken = True
+                    fail(key, e)
+                    continue
+                except Exception as e:
+                    fail(key, e)
+                    continue
+                finish(key, result)
+            if broken:
+                # a worker died; everything else in the pool has failed too
+                print('## a worker died; restarting the pool ...')
+                for future in list(futures):
+                    fail(futures.pop(future), BrokenProcessPool('worker died'))
+                pool.shutdown(wait=True)
+                pool = new_pool()
+        save_state()
+    finally:
+        pool.shutdown(wait=True)
+
+    n_done = len([key for key in results if state[key]['status'] == 'done'])
+    print(f'## {n_done} jobs done; {len(results) - n_done} failed.')
+    return results
+
+###############################################################################
+def _limit_memory(mem_gb):
+    """
+    worker initializer: cap the address space of the worker at mem_gb.
+    """
+    if mem_gb is None:
+        return
+    limit = int(mem_gb * 1024**3)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# the scripts import each other as top-level modules; baseline.py is run as
+# a script too
+for subdir in ['scripts', 'baseline']:
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                    subdir))
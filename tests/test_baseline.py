@@ -0,0 +1,143 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+hp = pytest.importorskip('healpy')
+pytest.importorskip('rubin_scheduler')
+from astropy import units as u
+from astropy.coordinates import SkyCoord
+from rubin_scheduler.utils import _hpid2_ra_dec
+from rubin_scheduler.scheduler.surveys.base_survey import BaseMarkovSurvey
+from baseline import MaskFirstMixin, MemoMaskBasisFunction, ecliptic_target, _ecliptic_pole
+
+
+###############################################################################
+def _ecliptic_target_skycoord(nside, dist_to_eclip, dec_max):
+    """
+    ecliptic_target as it was, with the full astropy transformation.
+    """
+    ra, dec = _hpid2_ra_dec(nside, np.arange(hp.nside2npix(nside)))
+    result = np.zeros(ra.size)
+    coord = SkyCoord(ra=ra * u.rad, dec=dec * u.rad)
+    eclip_lat = coord.barycentrictrueecliptic.lat.radian
+    good = np.where((np.abs(eclip_lat) < np.radians(dist_to_eclip)) & (dec < np.radians(dec_max)))
+    result[good] += 1
+    return result
+
+###############################################################################
+@pytest.mark.parametrize('nside', [16, 32, 64])
+def test_ecliptic_pole_latitudes(nside):
+    ra, dec = _hpid2_ra_dec(nside, np.arange(hp.nside2npix(nside)))
+    expected = SkyCoord(ra=ra * u.rad, dec=dec * u.rad).barycentrictrueecliptic.lat.radian
+    xyz = np.array([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)])
+    eclip_lat = np.arcsin(np.clip(_ecliptic_pole() @ xyz, -1.0, 1.0))
+    # far closer than any pixel gets to the edges of the target maps
+    np.testing.assert_allclose(eclip_lat, expected, rtol=0, atol=1e-12)
+
+###############################################################################
+@pytest.mark.parametrize('nside', [16, 32, 64])
+@pytest.mark.parametrize('dist_to_eclip, dec_max', [(40.0, 30.0), (15.0, 5.0)])
+def test_ecliptic_target_matches_skycoord(nside, dist_to_eclip, dec_max):
+    expected = _ecliptic_target_skycoord(nside, dist_to_eclip, dec_max)
+    result = ecliptic_target(nside=nside, dist_to_eclip=dist_to_eclip, dec_max=dec_max)
+    assert 0 < expected.sum() < expected.size
+    np.testing.assert_array_equal(result, expected)
+
+    # the memoized map isnt changed by a mask
+    mask = np.zeros(result.size)
+    mask[::2] = 1
+    np.testing.assert_array_equal(ecliptic_target(nside=nside, dist_to_eclip=dist_to_eclip,
+                                                  dec_max=dec_max, mask=mask),
+                                  expected * mask)
+    np.testing.assert_array_equal(ecliptic_target(nside=nside, dist_to_eclip=dist_to_eclip,
+                                                  dec_max=dec_max), expected)
+
+###############################################################################
+class _CountingMask:
+    """mask basis function that counts its evaluations."""
+
+    nside = 16
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, conditions, indx=None):
+        self.calls += 1
+        npix = hp.nside2npix(self.nside)
+        return np.arange(npix, dtype=float)[slice(None) if indx is None else indx]
+
+
+class _Conditions:
+    def __init__(self, mjd):
+        self.mjd = mjd
+
+###############################################################################
+def test_memo_mask_basis_function():
+    mask = _CountingMask()
+    memo = MemoMaskBasisFunction(mask)
+    npix = hp.nside2npix(mask.nside)
+    conditions = _Conditions(60000.0)
+
+    # surveys pass all the pixels, each with its own array
+    for _ in range(3):
+        np.testing.assert_array_equal(memo(conditions, indx=np.arange(npix)), np.arange(npix))
+    assert mask.calls == 1
+    # another subset, then back
+    np.testing.assert_array_equal(memo(conditions, indx=np.arange(10)), np.arange(10))
+    np.testing.assert_array_equal(memo(conditions, indx=np.arange(npix)), np.arange(npix))
+    assert mask.calls == 3
+    np.testing.assert_array_equal(memo(conditions), np.arange(npix))
+    assert mask.calls == 4
+    # new conditions
+    memo(_Conditions(60000.1))
+    assert mask.calls == 5
+
+###############################################################################
+class _MapBasisFunction(_CountingMask):
+    """basis function with a fixed value, counting its evaluations."""
+
+    def __init__(self, value):
+        super().__init__()
+        self.value = value
+
+    def __call__(self, conditions, indx=None):
+        self.calls += 1
+        return self.value
+
+
+class _Survey:
+    nside = _CountingMask.nside
+    calc_reward_basic = BaseMarkovSurvey.calc_reward_basic
+
+    def __init__(self, basis_functions, basis_weights):
+        self.basis_functions = basis_functions
+        self.basis_weights = basis_weights
+
+
+class _MaskFirstSurvey(MaskFirstMixin, _Survey):
+    pass
+
+###############################################################################
+@pytest.mark.parametrize('fully_masked', [False, True])
+def test_mask_first_reward(fully_masked):
+    rng = np.random.default_rng(42)
+    npix = hp.nside2npix(_CountingMask.nside)
+    mask1, mask2 = np.zeros(npix), np.zeros(npix)
+    mask1[: npix // 2] = np.nan
+    mask2[npix // 3:] = -np.inf if fully_masked else 0
+    bfs = [_MapBasisFunction(rng.uniform(size=npix)), _MapBasisFunction(mask1),
+           _MapBasisFunction(rng.uniform(size=npix)), _MapBasisFunction(mask2),
+           _MapBasisFunction(1.5)]
+    weights = [3.0, 0.0, 1.5, 0, 2.0]
+
+    expected = _Survey(bfs, weights).calc_reward_basic(_Conditions(60000.0))
+    calls = [bf.calls for bf in bfs]
+    reward = _MaskFirstSurvey(bfs, weights).calc_reward_basic(_Conditions(60000.0))
+    np.testing.assert_array_equal(reward, expected)
+    # each basis function once; the weighted ones not at all if fully masked
+    calls = [bf.calls - n for bf, n in zip(bfs, calls)]
+    if fully_masked:
+        assert np.isnan(reward).all()
+        assert calls == [0, 1, 0, 1, 0]
+    else:
+        assert np.isfinite(reward).sum() == npix - npix // 2
+        assert calls == [1, 1, 1, 1, 1]
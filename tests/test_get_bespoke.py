@@ -0,0 +1,75 @@
+import sqlite3
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('rubin_scheduler')
+from rubin_scheduler.scheduler.utils import SchemaConverter, ObservationArray
+from get_bespoke import _load_obs_in, _load_checkpoint, _save_checkpoint
+
+
+###############################################################################
+def _make_db(path, n_obs=50):
+    """
+    small opsim database with n_obs visits, one per night.
+    """
+    rng = np.random.default_rng(42)
+    obs = ObservationArray(n=n_obs)
+    obs['ID'] = np.arange(n_obs)
+    obs['mjd'] = 60000.2 + np.arange(n_obs)
+    obs['night'] = np.arange(n_obs) + 1
+    obs['RA'] = rng.uniform(0, 2 * np.pi, n_obs)
+    obs['dec'] = rng.uniform(-np.pi / 2, 0, n_obs)
+    obs['alt'] = rng.uniform(0.5, 1.5, n_obs)
+    obs['az'] = rng.uniform(0, 2 * np.pi, n_obs)
+    obs['rotSkyPos'] = rng.uniform(0, 2 * np.pi, n_obs)
+    obs['exptime'] = 30.
+    obs['slewtime'] = rng.uniform(4, 10, n_obs)
+    obs['FWHMeff'] = rng.uniform(0.6, 1.2, n_obs)
+    obs['fivesigmadepth'] = rng.uniform(22, 25, n_obs)
+    obs['filter'] = rng.choice(list('ugrizy'), n_obs)
+    conn = sqlite3.connect(path)
+    SchemaConverter().obs2opsim(obs).to_sql('observations', conn, index=False)
+    conn.close()
+    return obs
+
+###############################################################################
+def test_load_obs_in_matches_opsim2obs(tmp_path):
+    path = str(tmp_path / 'test.db')
+    _make_db(path)
+    expected = SchemaConverter().opsim2obs(path)
+    obs_in = _load_obs_in(path, cutoff_mjd=expected['mjd'].max() + 1, chunk_size=7)
+
+    assert len(obs_in) == len(expected)
+    for field in ['ID', 'mjd', 'night', 'RA', 'dec', 'alt', 'az', 'rotSkyPos',
+                  'exptime', 'slewtime', 'FWHMeff', 'fivesigmadepth']:
+        np.testing.assert_allclose(obs_in[field], expected[field], err_msg=field)
+    np.testing.assert_array_equal(obs_in['filter'], expected['filter'])
+
+###############################################################################
+def test_load_obs_in_cutoff(tmp_path):
+    path = str(tmp_path / 'test.db')
+    obs = _make_db(path)
+    cutoff_mjd = obs['mjd'][19] + 0.1
+    obs_in = _load_obs_in(path, cutoff_mjd=cutoff_mjd)
+
+    assert len(obs_in) == 20
+    assert obs_in['mjd'].max() <= cutoff_mjd
+    np.testing.assert_array_equal(obs_in['ID'], obs['ID'][:20])
+
+###############################################################################
+def test_load_checkpoint_stream_mode(tmp_path):
+    out_path = str(tmp_path / 'bespoke.db')
+    _save_checkpoint(out_path, {'nights_done': 30, 'observations_new': [],
+                                'stream_nights': 30, 'n_rows': 10})
+    # the visits streamed before the checkpoint are only in the partial db
+    assert _load_checkpoint(out_path, stream_nights=30) is None
+    open(f'{out_path}.partial', 'w').close()
+    assert _load_checkpoint(out_path, stream_nights=30)['nights_done'] == 30
+    # not streaming (or streaming differently) now
+    assert _load_checkpoint(out_path, stream_nights=None) is None
+    assert _load_checkpoint(out_path, stream_nights=60) is None
+
+    # checkpoints written without streaming keep their visits
+    _save_checkpoint(out_path, {'nights_done': 60, 'observations_new': [],
+                                'stream_nights': None})
+    assert _load_checkpoint(out_path, stream_nights=None)['nights_done'] == 60
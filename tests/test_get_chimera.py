@@ -0,0 +1,55 @@
+import os
+import sqlite3
+import pytest
+
+np = pytest.importorskip('numpy')
+pd = pytest.importorskip('pandas')
+from get_chimera import _write_chimera_sql, _write_chimeras_stream
+
+
+###############################################################################
+def _make_db(path, mjd0, n_obs=200, extra_col=None):
+    """
+    small observations table with rowids out of mjd order and some gaps.
+    """
+    rng = np.random.default_rng(int(mjd0))
+    df = pd.DataFrame({'observationId': np.arange(n_obs),
+                       'observationStartMJD': mjd0 + rng.uniform(0, 100, n_obs),
+                       'fieldRA': rng.uniform(0, 360, n_obs),
+                       'band': rng.choice(list('ugrizy'), n_obs)})
+    if extra_col is not None:
+        df[extra_col] = rng.integers(0, 10, n_obs)
+    conn = sqlite3.connect(path)
+    df.to_sql('observations', conn, index=False)
+    # holes in the rowids
+    conn.execute('delete from observations where observationId % 17 = 3')
+    conn.commit()
+    conn.close()
+
+###############################################################################
+def _read(path):
+    conn = sqlite3.connect(path)
+    schema = conn.execute('pragma table_info(observations)').fetchall()
+    rows = conn.execute('select * from observations order by rowid').fetchall()
+    conn.close()
+    return schema, rows
+
+###############################################################################
+@pytest.mark.parametrize('n_cutoffs', [3, 11])
+def test_stream_matches_sql(tmp_path, n_cutoffs):
+    cut_path, base_path = str(tmp_path / 'cut.db'), str(tmp_path / 'base.db')
+    _make_db(cut_path, mjd0=60000, extra_col='cut_only')
+    _make_db(base_path, mjd0=60000.5, extra_col='base_only')
+    # more cutoffs than can be attached at once too
+    cutoff_mjds = list(np.linspace(60010, 60090, n_cutoffs))
+
+    out_paths = [str(tmp_path / f'stream_{i}.db') for i in range(n_cutoffs)]
+    _write_chimeras_stream(baseline_path=base_path, sim_to_cut_path=cut_path,
+                           cutoff_mjds=cutoff_mjds, out_paths=out_paths, chunk_size=16)
+    for cutoff_mjd, out_path in zip(cutoff_mjds, out_paths):
+        expected_path = str(tmp_path / 'expected.db')
+        _write_chimera_sql(baseline_path=base_path, sim_to_cut_path=cut_path,
+                           cutoff_mjd=cutoff_mjd, out_path=expected_path)
+        assert _read(out_path) == _read(expected_path)
+        os.remove(expected_path)
+    assert not [fname for fname in os.listdir(tmp_path) if fname.endswith('.tmp')]
@@ -0,0 +1,161 @@
+import os
+import sqlite3
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('healpy')
+pytest.importorskip('rubin_sim')
+from rubin_scheduler.data import get_data_dir
+from get_chimera import get_chimera, get_cutoff_mjd
+from get_fonvtime import (get_fonvtime, get_fonvtime_split, get_fonvtime_chimera,
+                          _chimera_counts, _split_counts_maf, _split_counts_numpy,
+                          _maf_counts, _tag_constraint)
+
+# the camera footprint comes with the rubin_scheduler data
+needs_fov_map = pytest.mark.skipif(
+    not os.path.exists(os.path.join(get_data_dir(), 'utils', 'fov_map.npz')),
+    reason='no rubin_scheduler fov_map.npz')
+
+
+###############################################################################
+def _make_db(path, n_obs=300, ra_range=(0, 40), dec_range=(-40, -10), filter_p=None):
+    """
+    small opsim database with n_obs visits spread over a patch of sky, so
+    that many visits overlap. filter_p: probabilities for ugrizy; None for
+    all the same.
+    """
+    rng = np.random.default_rng(42)
+    rows = [(i, 60000.2 + i // 3, i // 3 + 1,
+             rng.uniform(*ra_range), rng.uniform(*dec_range), rng.uniform(0, 360),
+             'ugrizy'[rng.choice(6, p=filter_p)], 'DD:test' if i % 50 == 0 else 'pair_33',
+             30.)
+            for i in range(n_obs)]
+    conn = sqlite3.connect(path)
+    conn.execute('create table observations (observationId INTEGER, ' +
+                 'observationStartMJD REAL, night INTEGER, fieldRA REAL, fieldDec REAL, ' +
+                 'rotSkyPos REAL, filter TEXT, scheduler_note TEXT, ' +
+                 'visitExposureTime REAL)')
+    conn.executemany('insert into observations values (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    conn.commit()
+    conn.close()
+
+###############################################################################
+@pytest.mark.parametrize('use_camera', [False, pytest.param(True, marks=needs_fov_map)])
+@pytest.mark.parametrize('index', [False, True])
+def test_numpy_counts_match_maf(tmp_path, index, use_camera):
+    path = str(tmp_path / 'test.db')
+    _make_db(path)
+    kwargs = dict(nside=16, time_points=np.linspace(0, 100, 11), opsim_path=path,
+                  base_constraint="scheduler_note not like '%DD%'",
+                  split_col='filter', split_vals='ugrizy', all_tag='allfilts',
+                  use_camera=use_camera)
+    maf_counts = _split_counts_maf(**kwargs)
+    numpy_counts, totals = _split_counts_numpy(
+        **kwargs, index_dir=str(tmp_path / 'index') if index else None)
+
+    assert maf_counts['allfilts'].sum() > 0
+    for tag in maf_counts:
+        np.testing.assert_array_equal(_maf_counts(numpy_counts[tag], totals[tag]),
+                                      maf_counts[tag], err_msg=tag)
+
+###############################################################################
+@pytest.mark.parametrize('use_camera', [False, pytest.param(True, marks=needs_fov_map)])
+def test_numpy_fonv_matches_maf(tmp_path, use_camera):
+    path = str(tmp_path / 'test.db')
+    # enough of the sky (and visits) for FONv's 18000 sq deg to not be all zero
+    _make_db(path, n_obs=6000, ra_range=(0, 360), dec_range=(-80, 10))
+    kwargs = dict(nside=32, time_points=np.linspace(0, 2000, 21), opsim_path=path,
+                  outdir=str(tmp_path), use_camera=use_camera)
+    maf_fonv = get_fonvtime_split(engine='maf', **kwargs)
+    numpy_fonv = get_fonvtime_split(engine='numpy', **kwargs)
+
+    assert maf_fonv['allfilts'][-1] > 0
+    for tag in maf_fonv:
+        np.testing.assert_array_equal(numpy_fonv[tag], maf_fonv[tag], err_msg=tag)
+
+###############################################################################
+@pytest.mark.parametrize('engine', ['maf', 'numpy'])
+def test_split_matches_fonvtime(tmp_path, engine):
+    path = str(tmp_path / 'test.db')
+    # mostly r and i, so that their curves arent all zero either
+    _make_db(path, n_obs=6000, ra_range=(0, 360), dec_range=(-80, 10),
+             filter_p=[0.02, 0.03, 0.5, 0.4, 0.03, 0.02])
+    kwargs = dict(nside=32, time_points=np.linspace(0, 2000, 21), opsim_path=path,
+                  outdir=str(tmp_path), engine=engine, use_camera=False)
+    base_constraint = "scheduler_note not like '%DD%'"
+    split = get_fonvtime_split(base_constraint=base_constraint, split_col='filter',
+                               split_vals='ugrizy', all_tag='allfilts', **kwargs)
+
+    assert split['r'][-1] > 0 and split['i'][-1] > 0
+    assert set(split) == set(['allfilts'] + list('ugrizy'))
+    for tag in split:
+        fonv = get_fonvtime(constraint=_tag_constraint(base_constraint, 'filter', tag,
+                                                       'allfilts'), **kwargs)
+        np.testing.assert_array_equal(split[tag], fonv, err_msg=tag)
+
+###############################################################################
+def _make_survey_db(path, seed, nights, n_per_night=40):
+    """
+    opsim database with n_per_night visits on each of nights, all over the
+    southern sky; night 1 starts at mjd 60000.
+    """
+    rng = np.random.default_rng(seed)
+    rows = []
+    for night in nights:
+        for j in range(n_per_night):
+            rows.append((len(rows), 60000 + night - 1 + 0.1 + 0.3 * j / n_per_night, night,
+                         rng.uniform(0, 360), rng.uniform(-80, 10), rng.uniform(0, 360),
+                         'ugrizy'[rng.choice(6, p=[0.02, 0.03, 0.5, 0.4, 0.03, 0.02])],
+                         'DD:test' if j == 0 else 'pair_33', 30.))
+    conn = sqlite3.connect(path)
+    conn.execute('create table observations (observationId INTEGER, ' +
+                 'observationStartMJD REAL, night INTEGER, fieldRA REAL, fieldDec REAL, ' +
+                 'rotSkyPos REAL, filter TEXT, scheduler_note TEXT, ' +
+                 'visitExposureTime REAL)')
+    conn.executemany('insert into observations values (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    conn.commit()
+    conn.close()
+
+###############################################################################
+@pytest.mark.parametrize('weather_gap', [False, True])
+def test_chimera_matches_chimera_db(tmp_path, weather_gap):
+    # time bins of 20 nights; the cutoff is after night 47, inside (40, 60]
+    time_points = np.linspace(0, 200, 11)
+    cutoff_date, cutoff_night = '2023-04-12', 47
+    # with the gap, neither sim has visits on nights 48-70, so the saved
+    # counts for the sim to cut are exact upto night 60
+    nights = [night for night in range(1, 201)
+              if not (weather_gap and cutoff_night < night <= 70)]
+    cut_path, base_path = str(tmp_path / 'cut.db'), str(tmp_path / 'base.db')
+    _make_survey_db(cut_path, seed=1, nights=nights)
+    _make_survey_db(base_path, seed=2, nights=nights)
+    chimera_path = get_chimera(baseline_path=base_path, sim_to_cut_path=cut_path,
+                               cutoff_date=cutoff_date, cutoff_date_format='isot',
+                               outdir=str(tmp_path))
+    cutoff_mjd = get_cutoff_mjd(cutoff_date, 'isot')
+    assert 60000 + cutoff_night - 1 < cutoff_mjd < 60000 + cutoff_night
+
+    kwargs = dict(nside=32, time_points=time_points,
+                  base_constraint="scheduler_note not like '%DD%'", split_col='filter', split_vals='ugrizy', all_tag='allfilts',
+                  use_camera=False)
+    counts, totals = _chimera_counts(baseline_path=base_path, sim_to_cut_path=cut_path,
+                                     cutoff_mjd=cutoff_mjd,
+                                     counts_dir=str(tmp_path / 'counts'), counts_tag='cut',
+                                     **kwargs)
+    expected_counts, expected_totals = _split_counts_numpy(opsim_path=chimera_path,
+                                                           **kwargs)
+    for tag in expected_counts:
+        np.testing.assert_array_equal(counts[tag], expected_counts[tag], err_msg=tag)
+        np.testing.assert_array_equal(totals[tag], expected_totals[tag], err_msg=tag)
+
+    # and the curves, against MAF on the chimera database; the cut sim's
+    # counts are read back from counts_dir this time
+    fonv = get_fonvtime_chimera(baseline_path=base_path, sim_to_cut_path=cut_path,
+                                cutoff_mjd=cutoff_mjd, outdir=str(tmp_path),
+                                counts_dir=str(tmp_path / 'counts'), counts_tag='cut',
+                                **kwargs)
+    expected = get_fonvtime_split(opsim_path=chimera_path, outdir=str(tmp_path),
+                                  engine='maf', **kwargs)
+    assert expected['allfilts'][-1] > 0
+    for tag in expected:
+        np.testing.assert_array_equal(fonv[tag], expected[tag], err_msg=tag)
@@ -15,6 +15,7 @@ import argparse
 import os
 import subprocess
 import sys
+import traceback
 
 import healpy as hp
 import numpy as np
@@ -45,6 +46,7 @@ from rubin_scheduler.scheduler.utils import (
     make_rolling_footprints,
 )
 from rubin_scheduler.site_models import Almanac
+from rubin_scheduler.skybrightness_pre import SkyModelPre
 from rubin_scheduler.utils import DEFAULT_NSIDE, SURVEY_START_MJD, _hpid2_ra_dec
 
 # So things don't fail on hyak
@@ -52,6 +54,10 @@ iers.conf.auto_download = False
 # XXX--note this line probably shouldn't be in production
 iers.conf.auto_max_age = None
 
+# Nside for the preview profile (--preview); much faster than the default,
+# for triaging runs before doing them at full resolution
+PREVIEW_NSIDE = 16
+
 
 def example_scheduler(
     nside: int = DEFAULT_NSIDE,
@@ -1559,12 +1565,14 @@ def run_sched(
     event_table=None,
     sim_to_o=None,
     cloud_offset_year=0,
+    sky_model=None,
 ):
     """Run survey"""
     n_visit_limit = None
     fs = SimpleBandSched(illum_limit=illum_limit)
     observatory = ModelObservatory(nside=nside, mjd_start=mjd_start, sim_to_o=sim_to_o,
-                                   cloud_offset_year=cloud_offset_year,)
+                                   cloud_offset_year=cloud_offset_year,
+                                   sky_model=sky_model,)
     observatory, scheduler, observations = sim_runner(
         observatory,
         scheduler,
@@ -1581,6 +1589,82 @@ def run_sched(
     return observatory, scheduler, observations
 
 
+def run_ensemble(scheduler, cloud_offset_years, filenames, workers=1, **kwargs):
+    """Run the survey for several cloud offsets with one scheduler.
+
+    The scheduler (footprints, DDF scripts, ...) and the sky brightness
+    model are only built once; a worker is forked for each cloud offset,
+    sharing them copy-on-write, so only the `ModelObservatory` (whose
+    cloud data depends on the offset) is built per run. The sky model
+    loads its data in chunks as the survey goes on, so only the chunk
+    loaded before forking is shared.
+
+    Parameters
+    ----------
+    scheduler : `rubin_scheduler.scheduler.CoreScheduler`
+        The scheduler to run, for each cloud offset.
+    cloud_offset_years : `list` [`float`]
+        Cloud offsets (years) to run.
+    filenames : `list` [`str`]
+        Output database for each of cloud_offset_years.
+    workers : `int`
+        Max number of runs at a time; each needs memory for its own
+        observatory and sky data chunks. Default 1.
+    **kwargs
+        Passed on to `run_sched`.
+
+    Returns
+    -------
+    failed : `list` [`float`]
+        Cloud offsets whose runs failed.
+    """
+    if kwargs.get("sky_model") is None:
+        # Build it before forking, so the runs share what it has loaded
+        kwargs["sky_model"] = SkyModelPre()
+    children = {}
+    failed = []
+
+    def wait_for_one():
+        pid, status = os.wait()
+        cloud_offset_year = children.pop(pid, None)
+        exit_code = os.waitstatus_to_exitcode(status)
+        if cloud_offset_year is not None and exit_code != 0:
+            print(
+                "Run for cloud_offset_year %g failed (exit code %i)"
+                % (cloud_offset_year, exit_code)
+            )
+            failed.append(cloud_offset_year)
+
+    for cloud_offset_year, filename in zip(cloud_offset_years, filenames):
+        while len(children) >= max(workers, 1):
+            wait_for_one()
+        # So the workers don't repeat buffered output
+        sys.stdout.flush()
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                run_sched(
+                    scheduler,
+                    filename=filename,
+                    cloud_offset_year=cloud_offset_year,
+                    **kwargs,
+                )
+                status = 0
+            except BaseException:
+                # os._exit would swallow the traceback otherwise
+                traceback.print_exc()
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(status)
+        children[pid] = cloud_offset_year
+    while len(children) > 0:
+        wait_for_one()
+
+    return failed
+
+
 def gen_scheduler(args):
     survey_length = args.survey_length  # Days
     out_dir = args.out_dir
@@ -1588,6 +1672,9 @@ def gen_scheduler(args):
     nexp = args.nexp
     dbroot = args.dbroot
     nside = args.nside
+    preview = getattr(args, "preview", False)
+    if preview:
+        nside = PREVIEW_NSIDE
     mjd_plus = args.mjd_plus
     split_long = args.split_long
     too = ~args.no_too
@@ -1619,6 +1706,8 @@ def gen_scheduler(args):
     fileroot, extra_info = set_run_info(
         dbroot=dbroot, file_end="v4.3.1_", out_dir=out_dir, cloud_offset_year=cloud_offset_year
     )
+    if preview:
+        fileroot += "preview_"
 
     pattern_dict = {
         1: [True],
@@ -1774,6 +1863,32 @@ def gen_scheduler(args):
 
     if args.setup_only:
         return scheduler
+    elif getattr(args, "cloud_offset_years", None) is not None:
+        # One run per cloud offset, all sharing this scheduler
+        years = np.round(survey_length / 365.25)
+        cloud_offset_years = [float(val) for val in args.cloud_offset_years.split(",")]
+        filenames = [
+            fileroot.replace("cloudso%i" % cloud_offset_year, "cloudso%i" % val)
+            + "%iyrs.db" % years
+            for val in cloud_offset_years
+        ]
+        failed = run_ensemble(
+            scheduler,
+            cloud_offset_years,
+            filenames,
+            workers=getattr(args, "workers", 1),
+            survey_length=survey_length,
+            verbose=verbose,
+            extra_info=extra_info,
+            nside=nside,
+            illum_limit=illum_limit,
+            mjd_start=mjd_start,
+            event_table=event_table,
+            sim_to_o=sim_ToOs,
+        )
+        if len(failed) > 0:
+            raise RuntimeError("Runs failed for cloud_offset_years %s" % failed)
+        return filenames
     else:
         years = np.round(survey_length / 365.25)
         observatory, scheduler, observations = run_sched(
@@ -1819,6 +1934,13 @@ def sched_argparser():
         default=DEFAULT_NSIDE,
         help="Nside should be set to default (32) except for tests.",
     )
+    parser.add_argument(
+        "--preview",
+        dest="preview",
+        action="store_true",
+        help=f"Preview profile: run at nside {PREVIEW_NSIDE}, for triage only.",
+    )
+    parser.set_defaults(preview=False)
     parser.add_argument(
         "--mjd_plus",
         type=float,
@@ -1835,6 +1957,20 @@ def sched_argparser():
     parser.add_argument("--no_too", dest="no_too", action="store_true")
     parser.set_defaults(no_too=False)
     parser.add_argument("--cloud_offset_year", type=float, default=0.)
+    parser.add_argument(
+        "--cloud_offset_years",
+        type=str,
+        default=None,
+        help="Comma-separated cloud offsets to run, sharing one scheduler "
+        "(overrides --cloud_offset_year)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Max number of cloud offsets to run at a time; each needs its own "
+        "observatory in memory.",
+    )
 
     return parser
 
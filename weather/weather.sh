@@ -1,16 +1,6 @@
-python weather.py --cloud_offset_year 0
-python weather.py --cloud_offset_year 1
-python weather.py --cloud_offset_year 2
-python weather.py --cloud_offset_year 4
-python weather.py --cloud_offset_year 6
-python weather.py --cloud_offset_year 8
-python weather.py --cloud_offset_year 10
-python weather.py --cloud_offset_year 12
-python weather.py --cloud_offset_year 14
-python weather.py --cloud_offset_year 16
-python weather.py --cloud_offset_year 18
-python weather.py --cloud_offset_year 20
-python weather.py --cloud_offset_year 30
-python weather.py --cloud_offset_year 31
-python weather.py --cloud_offset_year 35
-python weather.py --cloud_offset_year 36
+# all the cloud offsets in one process: the scheduler is built once and a worker
+# is forked for each offset, WORKERS at a time (each needs its own observatory +
+# sky data in memory, so keep this well below the cores on a shared node).
+# to run a single offset instead: python weather.py --cloud_offset_year N
+WORKERS=${WORKERS:-4}
+python weather.py --cloud_offset_years 0,1,2,4,6,8,10,12,14,16,18,20,30,31,35,36 --workers $WORKERS